@@ -44,9 +44,10 @@ running program, are packed in a tar file.
 
 ## import a few standard Python modules
 import sys, os, os.path, hashlib, subprocess, tempfile, shutil, stat, multiprocessing
-import platform, cPickle, glob, tarfile, copy, gzip, Queue
+import platform, cPickle, glob, tarfile, copy, gzip, Queue, threading, itertools
 from optparse import OptionParser
-import datetime, re, struct, ConfigParser
+import datetime, re, struct, ConfigParser, time
+import multiprocessing.managers
 from multiprocessing import Process, Lock
 from multiprocessing.sharedctypes import Value, Array
 
@@ -58,7 +59,7 @@ import magic
 import psycopg2
 
 ## finally import a few BAT specific modules
-import extractor, prerun, fsmagic
+import extractor, prerun, fsmagic, dedup, leafcache, knownfiles, reportstore, reportrecord, dispatchplan
 
 ## load the magic library. Some versions of libmagic are too old
 ## to have the NO_CHECK_CDF magic flag, which might be problematic
@@ -74,8 +75,19 @@ ms.load()
 try:
 	import tlsh
 	tlshscan = True
+	## newer versions of the TLSH module can compute TLSH incrementally
+	tlshincremental = hasattr(tlsh, 'Tlsh')
+	import tlshindex
 except Exception, e:
 	tlshscan = False
+	tlshincremental = False
+
+## size of the buffers used for reading files when computing checksums.
+## Files that fit in a single buffer are kept in memory for the marker search.
+ingestbuffersize = 10000000
+
+## amount of bytes at the start of a file that is used by libmagic
+magicheadersize = 1048576
 
 ## Method to run a setup scan. Returns the result of the setup
 ## scan, which is in the form of a tuple (boolean, environment).
@@ -101,30 +113,300 @@ def runSetup(setupscan, usedatabase, cursor, conn, debug=False):
 def paralleloffsetsearch((filedir, filename, magicscans, optmagicscans, offset, length)):
 	return prerun.genericMarkerSearch(os.path.join(filedir, filename), magicscans, optmagicscans, offset, length)
 
+## split the marker search for a file into chunks that can be searched
+## in parallel. Chunks do not need to overlap (see genericMarkerSearch)
+def markersearchtasks(filedir, filename, magicscans, optmagicscans, filesize, chunksize):
+	offsettasks = []
+	for i in xrange(0, filesize, chunksize):
+		offsettasks.append((filedir, filename, magicscans, optmagicscans, i, chunksize))
+	return offsettasks
+
+## combine the results of a marker search that was split in chunks
+## into a dictionary with sorted offsets per marker and a flag to
+## indicate whether or not all data was ASCII.
+def mergemarkersearch(res):
+	offsets = {}
+	isascii = True
+	for offsetresult in res:
+		(i, offsettokeys, offsetisascii) = offsetresult
+		for j in i:
+			if j in offsets:
+				offsets[j] += i[j]
+			else:
+				offsets[j] = copy.deepcopy(i[j])
+		isascii = isascii and offsetisascii
+	for i in offsets:
+		offsets[i] = sorted(list(set(offsets[i])))
+	return (offsets, isascii)
+
+## Marker search service: continuously grab chunks of files from a queue,
+## search them for markers and send the result back to the scan process that
+## requested the search. This is used for big files that are found during
+## unpacking, so the marker search for a single big file does not have to be
+## done by a single process. Every result is sent with the sequence number of
+## the search and the offset of the chunk.
+def markersearchservice(markertaskqueue, markerresultqueues):
+	while True:
+		(processid, sequence, offsettask) = markertaskqueue.get()
+		try:
+			res = paralleloffsetsearch(offsettask)
+		except Exception, e:
+			res = None
+		markerresultqueues[processid].put((sequence, offsettask[4], res))
+
+## sequence numbers for the searches of a process that are handed to the
+## marker search service
+markersearchsequence = itertools.count()
+
+## hand the marker search for a file to the marker search service and wait
+## for all the results. Returns None if any of the chunks could not be
+## searched, so the caller can fall back to a regular marker search.
+## Results of an earlier search (for example one that timed out) that
+## are still in the queue are dropped.
+def servicemarkersearch(filedir, filename, magicscans, optmagicscans, filesize, chunksize, processid, markertaskqueue, markerresultqueue, timeout):
+	sequence = markersearchsequence.next()
+	offsettasks = markersearchtasks(filedir, filename, magicscans, optmagicscans, filesize, chunksize)
+	for offsettask in offsettasks:
+		markertaskqueue.put((processid, sequence, offsettask))
+	res = {}
+	while len(res) != len(offsettasks):
+		(ressequence, chunkoffset, chunkres) = markerresultqueue.get(timeout=timeout)
+		if ressequence != sequence:
+			continue
+		if chunkres == None:
+			return None
+		res[chunkoffset] = chunkres
+	return mergemarkersearch(map(lambda x: res[x], sorted(res)))
+
+## Manager for the scan queue if the 'priority' scheduling policy is used. The
+## queue is a priority queue that lives in the manager process, so all scan
+## processes take the task with the highest priority.
+class SchedulerManager(multiprocessing.managers.BaseManager):
+	pass
+
+SchedulerManager.register('PriorityQueue', Queue.PriorityQueue)
+
+## tags of files that are expected to contain other files and take a long
+## time to scan, and of files that are expected to be cheap to scan.
+expensivetags = set(['compressed', 'filesystem', 'temporary'])
+cheaptags = set(['graphics', 'audio', 'video', 'font', 'resource', 'text'])
+
+## unpack scans with a known file method that only check resources (such as
+## pictures) and that do not unpack other files
+resourceknownscans = set(['png'])
+
+## Compute the priority of a scan task, lower values are scanned first:
+## 1. files that are expected to contain other files before regular files,
+##    and files that were already scanned by an unpacker, or that are
+##    resources (pictures, fonts, etc.) last, to fill the gaps.
+## 2. bigger files before smaller files
+## 3. deeper nested files before files that are less deeply nested
+## Most tags are only set by the prerun scans, after the task is taken from
+## the queue, so whether or not a file is expected to contain other files is
+## mostly determined by looking at the extension of the file and the marker
+## at the start of the file, like is done for the known file methods.
+def scanpriority(scantask, scanplan=None):
+	(dirname, filename, lenscandir, debug, tags, scanhints, offsets, scancontext) = scantask
+	filetoscan = os.path.join(dirname, filename)
+	try:
+		filestat = os.lstat(filetoscan)
+		filesize = filestat.st_size
+	except Exception, e:
+		filestat = None
+		filesize = 0
+	depth = dirname[len(scancontext['tempdir']):].count(os.sep)
+	if scanhints.get('knownfile', False) or cheaptags.intersection(tags) != set():
+		scanclass = 2
+	elif expensivetags.intersection(tags) != set():
+		scanclass = 0
+	else:
+		scanclass = 1
+		if scanplan != None and filestat != None and stat.S_ISREG(filestat.st_mode):
+			knownheader = None
+			if scanplan.knownheadersize != 0:
+				try:
+					scanfile = open(filetoscan, 'rb')
+					knownheader = scanfile.read(scanplan.knownheadersize)
+					scanfile.close()
+				except Exception, e:
+					pass
+			knownscans = set(map(lambda x: x.name, scanplan.knownfilescans(filename, knownheader)))
+			if knownscans.difference(resourceknownscans) != set():
+				scanclass = 0
+			elif knownscans != set():
+				scanclass = 2
+	return (scanclass, -filesize, -depth)
+
+## put a task in the scan queue. With the 'priority' scheduling policy
+## the task is wrapped with its priority and the time it was added, so
+## tasks with the same priority are processed in order.
+def queuescantask(scanqueue, scantask, schedulingpolicy, scanplan=None):
+	if schedulingpolicy == 'priority':
+		scanqueue.put((scanpriority(scantask, scanplan), time.time(), scantask))
+	else:
+		scanqueue.put(scantask)
+
+## get the next task from the scan queue
+def getscantask(scanqueue, schedulingpolicy, timeout):
+	scantask = scanqueue.get(timeout=timeout)
+	if schedulingpolicy == 'priority':
+		return scantask[-1]
+	return scantask
+
+## Collect results from the scan processes as soon as they are available and
+## append them to a log on disk, so they are not buffered in memory until all
+## files have been scanned. This runs in a separate thread in the main process
+## and stops when None is received.
+def collectreports(reportqueue, reportlogname):
+	reportlog = open(reportlogname, 'ab')
+	while True:
+		val = reportqueue.get()
+		if val == None:
+			reportqueue.task_done()
+			break
+		cPickle.dump(val, reportlog, 2)
+		reportlog.flush()
+		reportqueue.task_done()
+	reportlog.close()
+
+## read the results from a log written by collectreports(). A damaged
+## result at the end of the log (for example because BAT was killed while
+## writing it) is treated as the end of the log.
+def readreports(reportlogname):
+	reportlog = open(reportlogname, 'rb')
+	while True:
+		try:
+			val = cPickle.load(reportlog)
+		except (EOFError, ValueError, cPickle.UnpicklingError), e:
+			break
+		yield val
+	reportlog.close()
+
+## name of the file of a scan task, relative to the directory
+## with the unpacked data
+def scantaskname(scantask, tempdir):
+	relname = os.path.join(scantask[0], scantask[1])[len(tempdir):]
+	if relname.startswith('/'):
+		relname = relname[1:]
+	return relname
+
+## Replay the log with results of a scan that was interrupted, so the scan can
+## be resumed. Besides the results of files the log contains a record for every
+## scan task that was queued, with the name of the file it was unpacked from.
+##
+## Results are only kept if the file and all the files it was unpacked from
+## were scanned completely: if a file was not completely scanned then it is
+## unpacked again, so results for files unpacked from it earlier are thrown
+## away, together with the directories that they were unpacked in.
+##
+## The log is rewritten with only the results that are kept and the checksums
+## of these files are added to the hash set. Returns the tasks that still have
+## to be done.
+def replayjournal(reportlogname, roottask, tempdir, scancontext, hashset):
+	reports = {}
+	childtasks = {}
+	if os.path.exists(reportlogname):
+		for val in readreports(reportlogname):
+			if isinstance(val, tuple):
+				(recordtype, parentname, scantask) = val
+				if not parentname in childtasks:
+					childtasks[parentname] = []
+				childtasks[parentname].append(scantask)
+			else:
+				reports.update(val)
+
+	## walk the tree of files, starting with the top level file
+	keptreports = {}
+	livetasks = {}
+	pendingtasks = [roottask]
+	while pendingtasks != []:
+		scantask = pendingtasks.pop()
+		relname = scantaskname(scantask, tempdir)
+		livetasks[relname] = scantask
+		if relname in reports:
+			keptreports[relname] = reports[relname]
+			pendingtasks += childtasks.get(relname, [])
+
+	## duplicates are only kept if the original file was kept
+	checksums = set()
+	for relname in keptreports:
+		if 'checksum' in keptreports[relname] and not 'duplicate' in keptreports[relname].get('tags', []):
+			checksums.add(keptreports[relname]['checksum'])
+	for relname in keptreports.keys():
+		if 'duplicate' in keptreports[relname].get('tags', []):
+			if not keptreports[relname].get('checksum') in checksums:
+				del keptreports[relname]
+
+	scantasks = []
+	for relname in livetasks:
+		if relname in keptreports:
+			continue
+		## the file will be scanned in the context of this scan
+		scantask = livetasks[relname][:7] + (scancontext,)
+		scantasks.append(scantask)
+
+		## remove the directories that the file was unpacked in, as
+		## long as no other file that was kept is stored in there
+		(dirname, filename) = scantask[:2]
+		if not os.path.isdir(dirname):
+			continue
+		unpackdirre = re.compile("%s-[^/]+-\d+$" % re.escape(filename))
+		for d in os.listdir(dirname):
+			if unpackdirre.match(d) == None:
+				continue
+			unpackdir = os.path.join(dirname, d)
+			if os.path.islink(unpackdir) or not os.path.isdir(unpackdir):
+				continue
+			relunpackdir = "%s/" % scantaskname((dirname, d), tempdir)
+			if filter(lambda x: x.startswith(relunpackdir), livetasks.keys()) != []:
+				continue
+			shutil.rmtree(unpackdir)
+
+	## rewrite the log, so it only contains what is kept
+	reportlog = open("%s.tmp" % reportlogname, 'wb')
+	for relname in keptreports:
+		cPickle.dump({relname: keptreports[relname]}, reportlog, 2)
+		for scantask in childtasks.get(relname, []):
+			cPickle.dump(('task', relname, scantask), reportlog, 2)
+	reportlog.close()
+	os.rename("%s.tmp" % reportlogname, reportlogname)
+
+	for checksum in checksums:
+		hashset.claim(checksum)
+	return scantasks
+
 ## method to filter scans, based on the tags that were found for a
 ## file, plus a list of tags that the scan should skip.
 ## This is done to avoid scans running unnecessarily.
+## Tags are compared as bit masks (see reportrecord.py).
 def filterScans(scans, tags):
 	filteredscans = []
+	tagsmask = reportrecord.tagmask(tags)
 	for scan in scans:
+		(scanonlymask, noscanmask) = reportrecord.scanmasks(scan)
 		if scan['scanonly'] != None:
-			scanonly = scan['scanonly'].split(':')
-			if set(tags).intersection(set(scanonly)) == set():
-				continue
-		if scan['noscan'] != None:
-			noscans = scan['noscan'].split(':')
-			if set(noscans).intersection(set(tags)) != set():
+			if tagsmask & scanonlymask == 0:
 				continue
-			else:
-				filteredscans.append(scan)
-		else:
-			filteredscans.append(scan)
+		if tagsmask & noscanmask != 0:
+			continue
+		filteredscans.append(scan)
 	return filteredscans
 
 ## compute a SHA256, and possibly other hashes as well. This is done in chunks
 ## to prevent a big file from being read in its entirety at once, slowing down
 ## the machine.
 def gethash(filepath, filename, hashtypes, tlshmaxsize):
+	(hashresults, header, filedata) = ingestfile(filepath, filename, hashtypes, tlshmaxsize)
+	return hashresults
+
+## Read a file once and compute all the checksums, including TLSH. While
+## reading the file some of the data is kept, so it does not need to be read
+## again:
+## * the first 'headersize' bytes, which are used by libmagic
+## * all the data, if the file is at most 'datamaximum' bytes, which can
+##   be used for the marker search
+## Returns a tuple with the checksums, the header and the data (or None).
+def ingestfile(filepath, filename, hashtypes, tlshmaxsize, headersize=0, datamaximum=0):
 	hashestocompute = set()
 	## always compute SHA256
 	hashestocompute.add('sha256')
@@ -141,78 +423,194 @@ def gethash(filepath, filename, hashtypes, tlshmaxsize):
 			continue
 		hashdict[h] = hashlib.new(h)
 
+	filesize = os.stat(os.path.join(filepath, filename)).st_size
+
+	## compute TLSH, as long as it is not too big (determined by tlshmaxsize).
+	## If the TLSH module cannot compute TLSH incrementally, then
+	## the data has to be kept to compute TLSH at the end.
+	computetlsh = False
+	tlshhash = None
+	if 'tlsh' in hashestocompute and tlshscan:
+		hashresults['tlsh'] = None
+		if filesize >= 256 and filesize <= tlshmaxsize:
+			computetlsh = True
+			if tlshincremental:
+				tlshhash = tlsh.Tlsh()
+
+	keepdata = filesize <= datamaximum or (computetlsh and tlshhash == None)
+	datachunks = []
+	header = ''
+
 	scanfile = open(os.path.join(filepath, filename), 'rb')
 	scanfile.seek(0)
-	hashdata = scanfile.read(10000000)
+	hashdata = scanfile.read(ingestbuffersize)
 	while hashdata != '':
-		for h in hashestocompute:
-			## CRC32 is not yet supported, TLSH is
-			## processed later
-			if h == 'crc32' or h == 'tlsh':
-				continue
+		for h in hashdict:
 			hashdict[h].update(hashdata)
-		hashdata = scanfile.read(10000000)
+		if tlshhash != None:
+			tlshhash.update(hashdata)
+		if keepdata:
+			datachunks.append(hashdata)
+		if len(header) < headersize:
+			header += hashdata[:headersize - len(header)]
+		hashdata = scanfile.read(ingestbuffersize)
 	scanfile.close()
-	for h in hashestocompute:
-		if h == 'crc32' or h == 'tlsh':
-			continue
+	for h in hashdict:
 		hashresults[h] = hashdict[h].hexdigest()
-	filesize = os.stat(os.path.join(filepath, filename)).st_size
-
-	## compute TLSH, as long as it is not too big (determined by tlshmaxsize)
-	if 'tlsh' in hashestocompute:
-		if tlshscan:
-			if filesize >= 256 and filesize <= tlshmaxsize:
-				scanfile = open(os.path.join(filepath, filename), 'rb')
-				scanfile.seek(0)
-				hashdata = scanfile.read()
-				scanfile.close()
-				hashresults['tlsh'] = tlsh.hash(hashdata)
-			else:
-				hashresults['tlsh'] = None
-	return hashresults
 
-## continuously grab tasks (files) from a queue, tag ('prerun phase'), possibly unpack
-## and recurse ('unpack'). Then run different scans per file ('leaf').
-def scan(scanqueue, reportqueue, scans, leafscans, prerunscans, prerunignore, prerunmagic, magicscans, optmagicscans, processid, hashdict, llock, template, unpacktempdir, topleveldir, tempdir, outputhash, cursor, conn, scansourcecode, dumpoffsets, offsetdir, compressed, timeout, scan_binary_basename, tlshmaxsize):
-	lentempdir = len(tempdir)
-	sourcecodequery = "select checksum from processed_file where checksum=%s limit 1"
+	filedata = None
+	if keepdata:
+		filedata = ''.join(datachunks)
+		datachunks = []
 
-	## import all methods defined in the scans, once per thread
-	## ignore all scans that cannot be loaded successfully
-	blacklistscans = set()
-	for prerunscan in prerunscans:
-		module = prerunscan['module']
-		method = prerunscan['method']
+	if computetlsh:
+		if tlshhash != None:
+			try:
+				tlshhash.final()
+				hashresults['tlsh'] = tlshhash.hexdigest()
+			except Exception, e:
+				hashresults['tlsh'] = None
+		else:
+			hashresults['tlsh'] = tlsh.hash(filedata)
+
+	if filesize > datamaximum:
+		filedata = None
+	return (hashresults, header, filedata)
+
+## Use libmagic to find out the 'magic' of a file for reporting. If the
+## header of the file is given, then libmagic uses that instead of reading
+## the file again. ELF files are an exception: libmagic can only report
+## details about ELF files (linking, stripped, etc.) if it can read the file.
+def getmagic(filetoscan, header=None):
+	if header != None and not header.startswith('\x7fELF'):
 		try:
-			exec "from %s import %s as bat_%s" % (module, method, method)
+			return ms.buffer(header)
 		except Exception, e:
-			blacklistscans.add((module, method))
+			pass
+	## libmagic cannot properly handle file names with 'exotic'
+	## encodings, so wrap it in a try statement and provide a
+	## default value of 'data'.
+	magic = 'data'
+	try:
+		magic = ms.file(filetoscan)
+	except Exception, e:
+		## libmagic could not handle it, likely because of an encoding
+		## issue (name with 'weird' characters, so try to workaround the
+		## problem. In case of a regular file (anything but a link) copy
+		## the file to a temporary location with a file name that libmagic
+		## will be able to handle.
+		if not os.path.islink(filetoscan):
+			tmpmagic = tempfile.mkstemp()
+			os.fdopen(tmpmagic[0]).close()
+			shutil.copy(filetoscan, tmpmagic[1])
+			magic = ms.file(tmpmagic[1])
+			os.unlink(tmpmagic[1])
+		else:
+			## TODO: create a better value for 'magic'
+			magic = 'symbolic link'
+	return magic
+
+## Load the reports that were stored for a file (see maintenance/storeresults.py)
+## and for all the files that were unpacked from it. Returns a dictionary with
+## the reports per SHA256, or None if not all reports are available. The leaf
+## reports are needed for every file, as the files are not scanned again.
+def loadstoredresults(cursor, checksum):
+	storedreports = {}
+	checksums = [checksum]
+	while checksums != []:
+		storedchecksum = checksums.pop()
+		if storedchecksum in storedreports:
 			continue
-
-	for unpackscan in scans:
-		module = unpackscan['module']
-		method = unpackscan['method']
+		cursor.execute("select report from batresult_report where checksum=%s", (storedchecksum,))
+		res = cursor.fetchone()
+		if res == None:
+			return None
 		try:
-			exec "from %s import %s as bat_%s" % (module, method, method)
+			storedreports[storedchecksum] = cPickle.loads(str(res[0]))
 		except Exception, e:
-			blacklistscans.add((module, method))
-			continue
+			return None
+		if storedreports[storedchecksum]['filereport'] == None:
+			return None
+		checksums += storedreports[storedchecksum]['children'].values()
+	return storedreports
+
+## Use the stored reports instead of scanning a file and the files that were
+## unpacked from it. The names of the files are changed to where they would
+## have been unpacked in this scan. The files themselves are not unpacked.
+## All files are tagged with 'storedresult', so aggregate and postrun scans
+## (which need the files) can skip them.
+def reusestoredresults(storedreports, checksum, unpackreports, relfiletoscan, tempdir, topleveldir, outputhash, hashset, reportqueue):
+	newreports = [(checksum, relfiletoscan, unpackreports)]
+	while newreports != []:
+		(storedchecksum, relativename, report) = newreports.pop()
+		storedreport = storedreports[storedchecksum]
+		if report == None:
+			report = copy.deepcopy(storedreport['unpackreport'])
+			report['relativename'] = relativename
+			report['realpath'] = os.path.dirname(os.path.join(tempdir, relativename))
+			report['checksum'] = report.get(outputhash, report['sha256'])
+			## files that are found more than once in this scan
+			## are treated as duplicates as usual
+			if not hashset.claim(report['checksum']):
+				report['tags'] = ['duplicate']
+				report['scans'] = []
+				reportqueue.put({relativename: report})
+				continue
+			report['tags'] = list(set(report['tags'] + ['storedresult']))
+		else:
+			report['tags'] = list(set(report['tags'] + storedreport['unpackreport']['tags'] + ['storedresult']))
+
+		report['scans'] = copy.deepcopy(storedreport['unpackreport'].get('scans', []))
+		for unpackscan in report['scans']:
+			unpackscan['scanreports'] = map(lambda x: relativename + x, unpackscan['scanreports'])
+		for suffix in storedreport['children']:
+			newreports.append((storedreport['children'][suffix], relativename + suffix, None))
+		## files without a checksum (symbolic links, empty files)
+		## are stored with the report of the file they were unpacked from
+		for suffix in storedreport.get('inlinechildren', {}):
+			inlinereport = copy.deepcopy(storedreport['inlinechildren'][suffix])
+			inlinereport['relativename'] = relativename + suffix
+			inlinereport['realpath'] = os.path.dirname(os.path.join(tempdir, relativename + suffix))
+			inlinereport['tags'] = list(set(inlinereport.get('tags', []) + ['storedresult']))
+			reportqueue.put({relativename + suffix: inlinereport})
+
+		if storedreport['filereport'] != None:
+			filereportname = os.path.join(topleveldir, 'filereports', '%s-filereport.pickle' % report['checksum'])
+			if not os.path.exists(filereportname):
+				picklefile = open(filereportname, 'wb')
+				cPickle.dump(storedreport['filereport'], picklefile)
+				picklefile.close()
+		reportqueue.put({relativename: report})
 
-	for leafscan in leafscans:
-		module = leafscan['module']
-		method = leafscan['method']
-		try:
-			exec "from %s import %s as bat_%s" % (module, method, method)
-		except Exception, e:
-			blacklistscans.add((module, method))
-			continue
+## continuously grab tasks (files) from a queue, tag ('prerun phase'), possibly unpack
+## and recurse ('unpack'). Then run different scans per file ('leaf').
+## Scan files taken from the scan queue. The scan processes are started once
+## and used for all binaries that are scanned. Everything that is specific for
+## a binary (directories, name of the binary) is passed with each task in a
+## scan context, which is inherited by the tasks for files that are unpacked.
+def scan(scanqueue, reportqueue, scanplan, magicscans, optmagicscans, processid, hashset, template, outputhash, cursor, conn, scansourcecode, dumpoffsets, compressed, timeout, tlshmaxsize, markertaskqueue, markerresultqueue, markersearchminimum, markersearchchunksize, schedulingpolicy, leafresultcache, reusestored, knownfilefilter):
+	sourcecodequery = "select checksum from processed_file where checksum=%s limit 1"
+
+	## whether or not the table with the TLSH bands exists is only
+	## checked once per process, when it is first needed
+	tlshbandtable = None
+
+	## all methods defined in the scans were imported once when the
+	## dispatch plan was created (see dispatchplan.py). Scans that
+	## could not be loaded successfully are ignored.
 
 	## grab tasks from the queue continuously until there are no more tasks left
 	while True:
 		## reset the reports, blacklist, offsets and tags for each new scan
-		blacklist = []
-		(dirname, filename, lenscandir, debug, tags, scanhints, offsets) = scanqueue.get(timeout=timeout)
+		blacklist = extractor.Blacklist()
+		(dirname, filename, lenscandir, debug, tags, scanhints, offsets, scancontext) = getscantask(scanqueue, schedulingpolicy, timeout)
+
+		## settings for the binary that the file belongs to
+		topleveldir = scancontext['topleveldir']
+		tempdir = scancontext['tempdir']
+		unpacktempdir = scancontext['unpacktempdir']
+		offsetdir = scancontext['offsetdir']
+		lentempdir = len(tempdir)
 
 		if debug:
 			## record the time when processing of the file started
@@ -231,29 +629,11 @@ def scan(scanqueue, reportqueue, scans, leafscans, prerunscans, prerunignore, pr
 		unpackreports = {}
 		unpackreports['name'] = filename
 
-		## use libmagic to find out the 'magic' of the file for reporting
-		## It cannot properly handle file names with 'exotic' encodings,
-		## so wrap it in a try statement and provide a default value of
-		## 'data'.
-		magic = 'data'
-		try:
-			magic = ms.file(filetoscan)
-		except Exception, e:
-			## libmagic could not handle it, likely because of an encoding
-			## issue (name with 'weird' characters, so try to workaround the
-			## problem. In case of a regular file (anything but a link) copy
-			## the file to a temporary location with a file name that libmagic
-			## will be able to handle.
-			if not os.path.islink(filetoscan):
-				tmpmagic = tempfile.mkstemp()
-				os.fdopen(tmpmagic[0]).close()
-				shutil.copy(filetoscan, tmpmagic[1])
-				magic = ms.file(tmpmagic[1])
-				os.unlink(tmpmagic[1])
-			else:
-				## TODO: create a better value for 'magic'
-				magic = 'symbolic link'
-		unpackreports['magic'] = magic
+		## use libmagic to find out the 'magic' of the file for reporting.
+		## For regular files that are not empty this is done later, with
+		## the data that is read when computing the checksums.
+		if os.path.islink(filetoscan) or not os.path.isfile(filetoscan) or os.lstat(filetoscan).st_size == 0:
+			unpackreports['magic'] = getmagic(filetoscan)
 
 		## Add both the path to indicate the position inside the file sytem
         	## or file that was unpacked, as well as the position of the files as unpacked
@@ -294,8 +674,14 @@ def scan(scanqueue, reportqueue, scans, leafscans, prerunscans, prerunignore, pr
 			continue
 
 		## Store the hash of the file for identification and for possibly
-		## querying the knowledgebase later on.
-		filehashresults = gethash(dirname, filename, [outputhash, 'sha1', 'md5', 'tlsh'], tlshmaxsize)
+		## querying the knowledgebase later on. The file is read only
+		## once: the header is kept for libmagic and the data of small
+		## files is kept for the marker search.
+		(filehashresults, fileheader, filedata) = ingestfile(dirname, filename, [outputhash, 'sha1', 'md5', 'tlsh'], tlshmaxsize, magicheadersize, ingestbuffersize)
+		unpackreports['magic'] = getmagic(filetoscan, fileheader)
+		## keep the first bytes to look up methods for known files
+		knownheader = fileheader[:scanplan.knownheadersize]
+		fileheader = None
 		unpackreports['checksum'] = filehashresults[outputhash]
 		for u in filehashresults:
 			unpackreports[u] = filehashresults[u]
@@ -304,39 +690,43 @@ def scan(scanqueue, reportqueue, scans, leafscans, prerunscans, prerunignore, pr
 		exactmatches = []
 		seenbefore = False
 		if cursor != None:
-			cursor.execute("select pathname, parentname, parentchecksum from batresult where checksum=%s", (filehash,))
+			cursor.execute("select pathname, parentname, parentchecksum from batresult where checksum=%s", (filehashresults['sha256'],))
 			res = cursor.fetchall()
 			if res != []:
 				seenbefore = True
 				for r in res:
-					exactmatches.append(res)
+					exactmatches.append(r)
 
-		blacklistedfiles = []
-		if cursor != None:
-			pass
-		## blacklisted file, not interested in further scanning
-		if filehash in blacklistedfiles:
+		## blacklisted file (for example a file from a stock
+		## distribution), not interested in further scanning
+		if knownfilefilter != None and filehashresults['sha256'] in knownfilefilter:
 			tags.append('blacklisted')
 			unpackreports['tags'] = tags
 			reportqueue.put({relfiletoscan: unpackreports})
 			scanqueue.task_done()
 			continue
 
-		## acquire the lock for the shared dictionary to see if this file was already
-		## scanned, or is in the process of being scanned.
-		llock.acquire()
-		if filehash in hashdict:
-			llock.release()
+		## claim the checksum in the shared hash set to see if this file
+		## was already scanned, or is in the process of being scanned.
+		## The first process to claim the checksum scans the file.
+		if not hashset.claim(filehash):
 			## if the hash is already there mark it as a
 			## duplicate and stop scanning.
 			unpackreports['tags'] = ['duplicate']
 			reportqueue.put({relfiletoscan: unpackreports})
 			scanqueue.task_done()
 			continue
-		else:
-			## add the file to the shared dictionary
-			hashdict[filehash] = relfiletoscan
-			llock.release()
+
+		## the file was scanned before and the results were stored in
+		## the database, so optionally reuse the results instead of
+		## unpacking and scanning the file again.
+		if reusestored and seenbefore:
+			storedreports = loadstoredresults(cursor, filehashresults['sha256'])
+			if storedreports != None:
+				unpackreports['tags'] = tags
+				reusestoredresults(storedreports, filehashresults['sha256'], unpackreports, relfiletoscan, tempdir, topleveldir, outputhash, hashset, reportqueue)
+				scanqueue.task_done()
+				continue
 
 		## look up the file in the BAT database to see if it is
 		## a known source code file.
@@ -359,22 +749,12 @@ def scan(scanqueue, reportqueue, scans, leafscans, prerunscans, prerunignore, pr
 			if "blacklistignorescans" in scanhints:
 				blacklistignorescans = scanhints['blacklistignorescans']
 
-			for unpackscan in scans:
-				if not 'knownfilemethod' in unpackscan:
+			for knownscan in scanplan.knownfilescans(filename, knownheader):
+				unpackscan = knownscan.scan
+				if filesize < knownscan.minimumsize:
 					continue
-				fileextensions = filename.lower().rsplit('.', 1)
-				if len(fileextensions) != 2:
-					continue
-				fileextension = fileextensions[1]
-				if not fileextension in unpackscan['extensions']:
-					continue
-				module = unpackscan['module']
-				method = unpackscan['knownfilemethod']
-				if 'minimumsize' in unpackscan:
-					if filesize < unpackscan['minimumsize']:
-						continue
 				if debug:
-					print >>sys.stderr, module, method, filetoscan, datetime.datetime.utcnow().isoformat()
+					print >>sys.stderr, knownscan.module, unpackscan['knownfilemethod'], filetoscan, datetime.datetime.utcnow().isoformat()
 					sys.stderr.flush()
 
 				## make a copy before changing the environment
@@ -388,18 +768,14 @@ def scan(scanqueue, reportqueue, scans, leafscans, prerunscans, prerunignore, pr
 						newenv['TEMPLATE'] = template % unpackscan['name']
 					else:
 						newenv['TEMPLATE'] = template
-				try:
-					exec "from %s import %s as bat_%s" % (module, method, method)
-				except Exception, e:
-					continue
 
 				## run the known unpack method
-				scanres = eval("bat_%s(filetoscan, tempdir, newenv, debug=debug)" % (method))
+				scanres = knownscan.knownfunction(filetoscan, tempdir, newenv, debug=debug)
 				if scanres == ([], [], [], {}):
 					## no result, so move on to the next scan
 					continue
 				(diroffsets, blacklist, scantags, hints) = scanres
-				newblacklist = []
+				newblacklist = extractor.Blacklist()
 				for b in blacklist:
 					if len(b) == 2:
 						b = b + (unpackscan['name'],)
@@ -454,8 +830,11 @@ def scan(scanqueue, reportqueue, scans, leafscans, prerunscans, prerunignore, pr
 											scannerhints[sc] = copy.deepcopy(hints[filepathname][sc])
 									if "temporary" in tags and diroffset[1] == 0 and diroffset[2] == filesize:
 										leaftags.append('temporary')
-									scantask = (i[0], p, len(scandir), debug, leaftags, scannerhints, {})
-									scanqueue.put(scantask)
+									scantask = (i[0], p, len(scandir), debug, leaftags, scannerhints, {}, scancontext)
+									## record the task in the log before it is
+									## queued, so an interrupted scan can be resumed
+									reportqueue.put(('task', relfiletoscan, scantask))
+									queuescantask(scanqueue, scantask, schedulingpolicy, scanplan)
 									relscanpath = "%s/%s" % (i[0][lentempdir:], p)
 									if relscanpath.startswith('/'):
 										relscanpath = relscanpath[1:]
@@ -470,12 +849,26 @@ def scan(scanqueue, reportqueue, scans, leafscans, prerunscans, prerunignore, pr
 		if not knownfile or 'blacklistignorescans' in scanhints:
 			## scan for markers in case they are not already known
 			if offsets == {}:
-				(offsets, offsetkeys, isascii) = prerun.genericMarkerSearch(filetoscan, magicscans, optmagicscans)
+				markerres = None
+				## big files are searched in parallel by the marker search
+				## service, if it is available.
+				if markertaskqueue != None and filesize > markersearchminimum:
+					try:
+						markerres = servicemarkersearch(dirname, filename, magicscans, optmagicscans, filesize, markersearchchunksize, processid, markertaskqueue, markerresultqueue, timeout)
+					except Exception, e:
+						markerres = None
+				if markerres != None:
+					(offsets, isascii) = markerres
+				else:
+					(offsets, offsetkeys, isascii) = prerun.genericMarkerSearch(filetoscan, magicscans, optmagicscans, filedata=filedata)
 				if isascii:
 					tags.append('text')
 				else:
 					tags.append('binary')
 
+		## the data of the file is not needed anymore
+		filedata = None
+
 		if dumpoffsets:
 			## write pickles with offsets to disk
 			offsetpicklename = os.path.join(offsetdir, '%s-offsets.pickle' % filehash)
@@ -516,31 +909,20 @@ def scan(scanqueue, reportqueue, scans, leafscans, prerunscans, prerunignore, pr
 						zerooffsets.add(magictype)
 
 			## prerun scans should be run before any of the other scans
-			for prerunscan in prerunscans:
-				ignore = False
-				if 'extensionsignore' in prerunscan:
-					extensionsignore = prerunscan['extensionsignore'].split(':')
-					for e in extensionsignore:
-						if filetoscan.endswith(e):
-							ignore = True
-							break
-				if ignore:
+			for prerunscan in scanplan.prerunscans:
+				if prerunscan.function == None:
 					continue
-				if prerunscan['name'] in prerunignore:
-					if set(tags).intersection(set(prerunignore[prerunscan['name']])) != set():
-						continue
-				if prerunscan['name'] in prerunmagic:
-					if set(prerunmagic[prerunscan['name']]).intersection(filterscans) == set():
-						continue
-				module = prerunscan['module']
-				method = prerunscan['method']
-				if (module, method) in blacklistscans:
+				if prerunscan.ignoresfile(filetoscan):
+					continue
+				if reportrecord.tagmask(tags) & prerunscan.noscanmask != 0:
+					continue
+				if prerunscan.markers != frozenset() and prerunscan.markers.isdisjoint(filterscans):
 					continue
 				if debug:
-					print >>sys.stderr, module, method, filetoscan, datetime.datetime.utcnow().isoformat()
+					print >>sys.stderr, prerunscan.module, prerunscan.method, filetoscan, datetime.datetime.utcnow().isoformat()
 					sys.stderr.flush()
 
-				scantags = locals()['bat_%s' % method](filetoscan, cursor, conn, tempdir, tags, offsets, prerunscan['environment'], debug=debug, unpacktempdir=unpacktempdir, filehashes=filehashresults)
+				scantags = prerunscan.function(filetoscan, cursor, conn, tempdir, tags, offsets, prerunscan.scan['environment'], debug=debug, unpacktempdir=unpacktempdir, filehashes=filehashresults)
 				## append the tag results. These will be used later to be able to specifically filter
 				## out files
 				if scantags != []:
@@ -553,33 +935,31 @@ def scan(scanqueue, reportqueue, scans, leafscans, prerunscans, prerunignore, pr
 			unpackscans = []
 			scanfirst = []
 
-			## Filter scans
-			filteredscans = filterScans(scans, tags)
-			for unpackscan in filteredscans:
-				## filter the scan again as the tags might have changed
-				if unpackscan['noscan'] != None:
-					noscans = unpackscan['noscan'].split(':')
-					if set(noscans).intersection(set(tags)) != set():
-						continue
-				if unpackscan['magic'] != None:
-					scanmagic = unpackscan['magic'].split(':')
-					if set(scanmagic).intersection(filterscans) != set():
-						if set(scanmagic).intersection(zerooffsets) != set():
-							if unpackscan['name'] != 'lzma':
-								scanfirst.append(unpackscan)
+			## Filter scans, using the index of scans per marker
+			tagsmask = reportrecord.tagmask(tags)
+			markerscans = scanplan.markerscans(filterscans)
+			zerooffsetscans = scanplan.markerscans(zerooffsets)
+			for compiledscan in scanplan.unpackscans:
+				if not compiledscan.wantstags(tagsmask):
+					continue
+				if compiledscan.magic != None:
+					if compiledscan.index in markerscans:
+						if compiledscan.index in zerooffsetscans:
+							if compiledscan.name != 'lzma':
+								scanfirst.append(compiledscan)
 							else:
-								unpackscans.append(unpackscan)
+								unpackscans.append(compiledscan)
 						else:
-							unpackscans.append(unpackscan)
+							unpackscans.append(compiledscan)
 				else:
-					unpackscans.append(unpackscan)
+					unpackscans.append(compiledscan)
 
 			## sort 'unpackscans' in decreasing priority, so highest
 			## priority scans are run first.
-			unpackscans = sorted(unpackscans, key=lambda x: x['priority'], reverse=True)
+			unpackscans = sorted(unpackscans, key=lambda x: x.priority, reverse=True)
 
 			## prepend the most promising scans at offset 0 (if any)
-			scanfirst = sorted(scanfirst, key=lambda x: x['priority'], reverse=True)
+			scanfirst = sorted(scanfirst, key=lambda x: x.priority, reverse=True)
 			unpackscans = scanfirst + unpackscans
 
 			unpackreports['scans'] = []
@@ -589,9 +969,10 @@ def scan(scanqueue, reportqueue, scans, leafscans, prerunscans, prerunignore, pr
 				blacklistignorescans = scanhints['blacklistignorescans']
 
 			unpacked = False
-			for unpackscan in unpackscans:
+			for compiledscan in unpackscans:
+				unpackscan = compiledscan.scan
 				blacklistignored = False
-				if extractor.inblacklist(0, blacklist) == filesize:
+				if blacklist.covers(0, filesize):
 					## the whole file has already been scanned by other scans, so
 					## continue with the leaf scans.
 					blacklisted = True
@@ -603,32 +984,20 @@ def scan(scanqueue, reportqueue, scans, leafscans, prerunscans, prerunignore, pr
 					## store a copy of the old blacklist
 					blacklistignored = True
 					oldblacklist = copy.deepcopy(blacklist)
-					blacklist = []
+					blacklist = extractor.Blacklist()
 
-				if 'minimumsize' in unpackscan:
-					if filesize < unpackscan['minimumsize']:
-						continue
+				if filesize < compiledscan.minimumsize:
+					continue
 
-				if unpackscan['noscan'] != None:
-					noscans = unpackscan['noscan'].split(':')
-					if list(set(tags).intersection(set(noscans))) != []:
-						continue
-		
-				ignore = False
-				if 'extensionsignore' in unpackscan:
-					extensionsignore = unpackscan['extensionsignore'].split(':')
-					for e in extensionsignore:
-						if filetoscan.endswith(e):
-							ignore = True
-						break
-				if ignore:
+				if reportrecord.tagmask(tags) & compiledscan.noscanmask != 0:
+					continue
+
+				if compiledscan.ignoresfile(filetoscan):
 					continue
-				module = unpackscan['module']
-				method = unpackscan['method']
-				if (module, method) in blacklistscans:
+				if compiledscan.function == None:
 					continue
 				if debug:
-					print >>sys.stderr, module, method, filetoscan, datetime.datetime.utcnow().isoformat()
+					print >>sys.stderr, compiledscan.module, compiledscan.method, filetoscan, datetime.datetime.utcnow().isoformat()
 					sys.stderr.flush()
 
 				## make a copy before changing the environment
@@ -647,15 +1016,18 @@ def scan(scanqueue, reportqueue, scans, leafscans, prerunscans, prerunignore, pr
 				## return value is the temporary dir, plus offset in the parent file
 				## plus a blacklist containing blacklisted ranges for the *original*
 				## file and a hash with offsets for each marker.
-				scanres = locals()["bat_%s" % method](filetoscan, tempdir, blacklist, offsets, newenv, debug=debug)
+				scanres = compiledscan.function(filetoscan, tempdir, blacklist, offsets, newenv, debug=debug)
 				## result is either empty, or contains offsets, blacklist, tags and hints
 				if len(scanres) == 0:
 					continue
 				if len(scanres) != 4:
 					continue
 				(diroffsets, blacklist, scantags, hints) = scanres
+				## unpack scans could return a regular list
+				if not isinstance(blacklist, extractor.Blacklist):
+					blacklist = extractor.Blacklist(blacklist)
 				tags = list(set(tags + scantags))
-				if extractor.inblacklist(0, blacklist) == filesize:
+				if blacklist.covers(0, filesize):
 					blacklisted = True
 
 				## special case: the whole file was unpacked and blacklisted
@@ -701,8 +1073,11 @@ def scan(scanqueue, reportqueue, scans, leafscans, prerunscans, prerunignore, pr
 											scannerhints[sc] = copy.deepcopy(hints[filepathname][sc])
 									if "temporary" in tags and diroffset[1] == 0 and diroffset[2] == filesize:
 										leaftags.append('temporary')
-									scantask = (i[0], p, len(scandir), debug, leaftags, scannerhints, {})
-									scanqueue.put(scantask)
+									scantask = (i[0], p, len(scandir), debug, leaftags, scannerhints, {}, scancontext)
+									## record the task in the log before it is
+									## queued, so an interrupted scan can be resumed
+									reportqueue.put(('task', relfiletoscan, scantask))
+									queuescantask(scanqueue, scantask, schedulingpolicy, scanplan)
 									relscanpath = "%s/%s" % (i[0][lentempdir:], p)
 									if relscanpath.startswith('/'):
 										relscanpath = relscanpath[1:]
@@ -712,7 +1087,7 @@ def scan(scanqueue, reportqueue, scans, leafscans, prerunscans, prerunignore, pr
 					except StopIteration:
 						pass
 					unpackreports['scans'].append({'scanname': unpackscan['name'], 'scanreports': scanreports, 'offset': diroffset[1], 'size': diroffset[2]})
-				newblacklist = []
+				newblacklist = extractor.Blacklist()
 				for b in blacklist:
 					if len(b) == 2:
 						b = b + (unpackscan['name'],)
@@ -787,7 +1162,6 @@ def scan(scanqueue, reportqueue, scans, leafscans, prerunscans, prerunignore, pr
 				if tlshscan and not seenbefore:
 					if 'tlsh' in filehashresults:
 						if filehashresults['tlsh'] != None:
-							tlshminimum = sys.maxint
 							decoded = False
 							for i in ['utf-8','ascii','latin-1','euc_jp', 'euc_jis_2004', 'jisx0213', 'iso2022_jp', 'iso2022_jp_1', 'iso2022_jp_2', 'iso2022_jp_2004', 'iso2022_jp_3', 'iso2022_jp_ext', 'iso2022_kr','shift_jis','shift_jis_2004','shift_jisx0213']:
 								try:
@@ -797,20 +1171,24 @@ def scan(scanqueue, reportqueue, scans, leafscans, prerunscans, prerunignore, pr
 								except Exception, e:
 									pass
 
-							if decoded:
-								cursor.execute("select tlsh, pathname, parentname, parentchecksum from batresult where filename=%s", (decodefilename,))
-							else:
-								cursor.execute("select tlsh, pathname, parentname, parentchecksum from batresult where filename=%s", (filename,))
-							res = cursor.fetchall()
-							for r in res:
-								(tlshchecksum, tlshpathname, parentname, parentchecksum) = r
-								if tlshchecksum == None:
-									continue
-								tlshdistance = tlsh.diff(filehashresults['tlsh'], tlshchecksum)
-								if tlshdistance < tlshminimum:
-									tlshminimum = tlshdistance
-							if tlshminimum < tlshthreshold:
-								closestfile = (tlshpathname, parentname, tlshdistance)
+							if tlshbandtable == None:
+								try:
+									tlshbandtable = tlshindex.hasbandtable(cursor)
+								except Exception, e:
+									conn.rollback()
+									tlshbandtable = False
+
+							## only files that share a part of the TLSH
+							## checksum, or that have the same name, are
+							## compared. With older databases only files
+							## with the same name are compared.
+							if not decoded:
+								decodefilename = filename
+							try:
+								closestfile = tlshindex.closestmatch(cursor, filehashresults['tlsh'], decodefilename, tlshthreshold, tlshbandtable)
+							except Exception, e:
+								conn.rollback()
+								closestfile = None
 			if closestfile != None:
 				reports['closematch'] = closestfile
 				tags.append('closematch')
@@ -820,27 +1198,18 @@ def scan(scanqueue, reportqueue, scans, leafscans, prerunscans, prerunignore, pr
 				tags.append('exactbinarymatch')
 
 			## run the leaf scans for the file
-			for leafscan in filterScans(leafscans, tags):
+			tagsmask = reportrecord.tagmask(tags)
+			for compiledscan in filter(lambda x: x.wantstags(tagsmask), scanplan.leafscans):
+				leafscan = compiledscan.scan
 				## filter the scan again as the tags might have changed
-				if leafscan['noscan'] != None:
-					noscans = leafscan['noscan'].split(':')
-					if set(noscans).intersection(set(tags)) != set():
-						continue
+				if reportrecord.tagmask(tags) & compiledscan.noscanmask != 0:
+					continue
 
-				ignore = False
-				if 'extensionsignore' in leafscan:
-					extensionsignore = leafscan['extensionsignore'].split(':')
-					for e in extensionsignore:
-						if filetoscan.endswith(e):
-							ignore = True
-							break
-				if ignore:
+				if compiledscan.ignoresfile(filetoscan):
 					continue
 				report = {}
-				module = leafscan['module']
-				method = leafscan['method']
 
-				if (module, method) in blacklistscans:
+				if compiledscan.function == None:
 					continue
 
 				scandebug = False
@@ -849,15 +1218,25 @@ def scan(scanqueue, reportqueue, scans, leafscans, prerunscans, prerunignore, pr
 					debug = True
 
 				if debug:
-					print >>sys.stderr, module, method, filetoscan, datetime.datetime.utcnow().isoformat()
+					print >>sys.stderr, compiledscan.module, compiledscan.method, filetoscan, datetime.datetime.utcnow().isoformat()
 					sys.stderr.flush()
 					scandebug = True
 
-				res = eval("bat_%s(filetoscan, tags, cursor, conn, filehashresults, blacklist, leafscan['environment'], scandebug=scandebug, unpacktempdir=unpacktempdir)" % (method))
+				## first see if the result for this file was already
+				## computed during an earlier scan
+				usecache = leafresultcache != None and leafscan.get('cache', True)
+				if usecache:
+					(cached, res) = leafresultcache.get(filehashresults['sha256'], leafscan['name'], leafscan['cachefingerprint'], tags, blacklist)
+				else:
+					cached = False
+				if not cached:
+					res = compiledscan.function(filetoscan, tags, cursor, conn, filehashresults, blacklist, leafscan['environment'], scandebug=scandebug, unpacktempdir=unpacktempdir)
+					if usecache:
+						leafresultcache.put(filehashresults['sha256'], leafscan['name'], leafscan['cachefingerprint'], tags, blacklist, res)
 				if res != None:
 					(nt, leafres) = res
 					reports[leafscan['name']] = leafres
-					tags += list(set(tags + nt))
+					tags = list(set(tags + nt))
 
 			reports['tags'] = list(set(tags))
 			unpackreports['tags'] = list(set(unpackreports['tags'] + reports['tags']))
@@ -1070,6 +1449,14 @@ def scanconfigsection(config, section, scanenv, batconf):
 			conf['setup'] = config.get(section, 'setup')
 		except:
 			pass
+		try:
+			cache = config.get(section, 'cache')
+			if cache == 'no':
+				conf['cache'] = False
+			else:
+				conf['cache'] = True
+		except:
+			conf['cache'] = True
 		try:
 			needsdatabase = config.get(section, 'needsdatabase')
 			if needsdatabase == 'yes':
@@ -1218,6 +1605,14 @@ def readconfig(config, configfilename):
 				batconf['reporthash'] = reporthash
 		except:
 			pass
+		try:
+			schedulingpolicy = config.get(section, 'schedulingpolicy')
+			if schedulingpolicy in ['fifo', 'priority']:
+				batconf['schedulingpolicy'] = schedulingpolicy
+			else:
+				batconf['schedulingpolicy'] = 'fifo'
+		except:
+			batconf['schedulingpolicy'] = 'fifo'
 		try:
 			batconf['processors'] = int(config.get(section, 'processors'))
 		except:
@@ -1270,6 +1665,83 @@ def readconfig(config, configfilename):
 		except:
 			## set a default minimum threshold of 20 million bytes
 			batconf['markersearchminimum'] = 20000000
+		try:
+			nestedmarkersearchminimum = int(config.get(section, 'nestedmarkersearchminimum'))
+			batconf['nestedmarkersearchminimum'] = nestedmarkersearchminimum
+		except:
+			## default to the same threshold as for the top level file
+			batconf['nestedmarkersearchminimum'] = batconf['markersearchminimum']
+		try:
+			unpackprocessors = int(config.get(section, 'unpackprocessors'))
+			if unpackprocessors <= 0:
+				raise Exception("invalid amount of processors")
+			batconf['unpackprocessors'] = unpackprocessors
+		except:
+			## by default as many as there are processors
+			batconf['unpackprocessors'] = multiprocessing.cpu_count()
+		try:
+			dedupslots = int(config.get(section, 'dedupslots'))
+			if dedupslots <= 0:
+				raise Exception("invalid amount of slots")
+			batconf['dedupslots'] = dedupslots
+		except:
+			## by default room for 262144 checksums (8 MiB)
+			batconf['dedupslots'] = 262144
+		try:
+			knownfilefilter = config.get(section, 'knownfilefilter')
+			if knownfilefilter == 'yes':
+				batconf['knownfilefilter'] = True
+			else:
+				batconf['knownfilefilter'] = False
+		except:
+			batconf['knownfilefilter'] = False
+		try:
+			reuseresults = config.get(section, 'reusestoredresults')
+			if reuseresults == 'yes':
+				batconf['reusestoredresults'] = True
+			else:
+				batconf['reusestoredresults'] = False
+		except:
+			batconf['reusestoredresults'] = False
+		try:
+			reportstoretype = config.get(section, 'reportstore')
+			if reportstoretype in ['memory', 'sqlite']:
+				batconf['reportstore'] = reportstoretype
+			else:
+				batconf['reportstore'] = 'memory'
+		except:
+			batconf['reportstore'] = 'memory'
+		try:
+			reportstorecache = int(config.get(section, 'reportstorecache'))
+			if reportstorecache <= 0:
+				raise Exception("invalid cache size")
+			batconf['reportstorecache'] = reportstorecache
+		except:
+			batconf['reportstorecache'] = 10000
+		try:
+			leafcachedir = config.get(section, 'leafcachedirectory')
+			if not os.path.isdir(leafcachedir):
+				batconf['leafcachedirectory'] = None
+			else:
+				batconf['leafcachedirectory'] = leafcachedir
+		except:
+			batconf['leafcachedirectory'] = None
+		try:
+			leafcachesize = int(config.get(section, 'leafcachesize'))
+			if leafcachesize <= 0:
+				raise Exception("invalid cache size")
+			batconf['leafcachesize'] = leafcachesize
+		except:
+			## by default 1 GiB
+			batconf['leafcachesize'] = 1073741824
+		try:
+			markersearchchunksize = int(config.get(section, 'markersearchchunksize'))
+			if markersearchchunksize <= 0:
+				raise Exception("invalid chunk size")
+			batconf['markersearchchunksize'] = markersearchchunksize
+		except:
+			## set a default chunk size of 2 million bytes
+			batconf['markersearchchunksize'] = 2000000
 		try:
 			tasktimeout = int(config.get(section, 'tasktimeout'))
 			batconf['tasktimeout'] = tasktimeout
@@ -1655,7 +2127,7 @@ def dumpData(unpackreports, scans, tempdir, packpickles):
 
 	if packpickles:
 		picklefile = open(os.path.join(tempdir, 'scandata.pickle'), 'wb')
-		cPickle.dump(unpackreports, picklefile)
+		reportstore.dumpreports(unpackreports, picklefile)
 		picklefile.close()
 
 def compressPickle((infile)):
@@ -1797,27 +2269,6 @@ def runscan(scans, binaries, batversion):
 				magicscans = magicscans + s['magic'].split(':')
 			if s['optmagic'] != None:
 				optmagicscans = optmagicscans + s['optmagic'].split(':')
-	prerunignore = {}
-	prerunmagic = {}
-	for prerunscan in scans['prerunscans']:
-		if 'noscan' in prerunscan:
-			if not prerunscan['noscan'] == None:
-				noscans = prerunscan['noscan'].split(':')
-				prerunignore[prerunscan['name']] = noscans
-		if 'magic' in prerunscan:
-			if not prerunscan['magic'] == None:
-				magics = prerunscan['magic'].split(':')
-				if not prerunscan['name'] in prerunmagic:
-					prerunmagic[prerunscan['name']] = magics
-				else:
-					prerunmagic[prerunscan['name']] = prerunmagic[prerunscan['name']] + magics
-		if 'optmagic' in prerunscan:
-			if not prerunscan['optmagic'] == None:
-				magics = prerunscan['optmagic'].split(':')
-				if not prerunscan['name'] in prerunmagic:
-					prerunmagic[prerunscan['name']] = magics
-				else:
-					prerunmagic[prerunscan['name']] = prerunmagic[prerunscan['name']] + magics
 
 	magicscans = list(set(magicscans))
 	optmagicscans = list(set(optmagicscans))
@@ -2026,189 +2477,351 @@ def runscan(scans, binaries, batversion):
 
 	timeout=scans['batconfig']['tasktimeout']
 
-	## record the original working directory, as that is
-	## what BAT will start at for each scan.
-	origcwd = os.getcwd()
-
-	## now process each of the binaries individually
-	for bins in binaries:
-		statistics = {}
-		(scan_binary, writeconfig) = bins
-
-		## extra sanity check, in case the binary was removed
-		if not os.path.exists(scan_binary):
-			continue
-		scan_binary_basename = os.path.basename(scan_binary)
-
-		## force the cwd to a known value. This is to prevent mysterious
-		## errors in case some old results are cleaned up and the cwd is not
-		## restored in the code that had to change cwd for some reason.
-		os.chdir(origcwd)
-		scandate = datetime.datetime.utcnow()
-
-		## Per binary scanned a list with results is returned.
-		## Each file system or compressed file inside the binary returns a list
-		## with reports back as its result, so we have a list of lists.
-		## Within the inner list there is a result tuple, which could contain
-		## more lists in some fields, like libraries, or more result lists if
-		## the file inside a file system we looked at was in fact a file system.
-		unpackreports = {}
-
+	## settings for searching markers in big files in parallel
+	markersearchchunksize = scans['batconfig']['markersearchchunksize']
+	nestedmarkersearchminimum = scans['batconfig']['nestedmarkersearchminimum']
+
+	template = scans['batconfig']['template']
+
+	## results of leaf scans can be cached on disk and reused for
+	## files that were already scanned before.
+	leafresultcache = None
+	if scans['batconfig']['leafcachedirectory'] != None and scans['leafscans'] != []:
+		leafresultcache = leafcache.LeafCache(scans['batconfig']['leafcachedirectory'], scans['batconfig']['leafcachesize'])
+		for sscan in finalleafscans:
+			sscan['cachefingerprint'] = leafcache.configfingerprint(sscan, scans['prerunscans'] + finalunpackscans)
+
+	## Some unpack scans unpack big files in parallel with a pool of
+	## processes. The pools are created in the scan processes, so the size
+	## of each pool is bounded, to use at most 'unpackprocessors' processes
+	## for all scan processes together.
+	unpackpoolsize = max(1, scans['batconfig']['unpackprocessors'] / processamount)
+	for sscan in finalunpackscans:
+		sscan['environment']['UNPACK_POOLSIZE'] = unpackpoolsize
+
+	## compile the final configuration of the scans once, so the scan
+	## processes do not have to import methods and split values from
+	## the configuration for every file.
+	scanplan = dispatchplan.DispatchPlan(scans['prerunscans'], finalunpackscans, finalleafscans)
+
+	## Files that are blacklisted in the database are not scanned. All
+	## checksums are read once and written to a file, which is mapped in
+	## memory, so the scan processes do not need to query the database for
+	## every file. The file is removed right away, as the mapping stays
+	## valid and is inherited by the scan processes.
+	knownfilefilter = None
+	if scans['batconfig']['knownfilefilter'] and usedatabase:
+		(filterfd, filtername) = tempfile.mkstemp()
+		os.fdopen(filterfd).close()
 		try:
-			## test if unpackdirectory is actually writable
-			topleveldir = tempfile.mkdtemp(dir=unpackdirectory)
-		except:
-			unpackdirectory = None
-			topleveldir = tempfile.mkdtemp(dir=unpackdirectory)
-
-		## reset the environment to a fresh copy
-		scanenv = copy.deepcopy(scans['batconfig']['environment'])
+			knownfiles.buildknownfiles(batcursors[0], filtername)
+			knownfilefilter = knownfiles.KnownFiles(filtername)
+		except Exception, e:
+			## for example the table does not exist
+			batcons[0].rollback()
+		os.unlink(filtername)
+
+	## Start the scan processes. These processes are used for all the
+	## binaries, so scan modules only have to be imported once per
+	## process and database connections can be reused.
+	## The scan processes get their own database connections, as the
+	## connections in batcons are used by the main process, for example
+	## for the aggregate scans, while the scan processes are waiting
+	## for the next binary.
+	scancons = []
+	scancursors = []
+	if usedatabase:
+		for i in range(0,processamount):
+			try:
+				c = psycopg2.connect(database=scanenv['POSTGRESQL_DB'], user=scanenv['POSTGRESQL_USER'], password=scanenv['POSTGRESQL_PASSWORD'], host=scanenv.get('POSTGRESQL_HOST', None), port=scanenv.get('POSTGRESQL_PORT', None))
+				cursor = c.cursor()
+				scancons.append(c)
+				scancursors.append(cursor)
+			except Exception, e:
+				break
 
-		## create the top level directory where all the unpacked data
-		## will be stored
-		scantempdir = os.path.join(topleveldir, "data")
-		os.makedirs(scantempdir)
+	## use a queue made with a manager to avoid some issues, see:
+	## http://docs.python.org/2/library/multiprocessing.html#pipes-and-queues
+	scanmanager = multiprocessing.Manager()
+
+	## By default the scan queue is processed in order. With the
+	## 'priority' scheduling policy big files and files that are
+	## likely to contain other files are scanned first, so one big
+	## file that is found late does not keep a single process busy
+	## long after the other processes have finished.
+	schedulingpolicy = scans['batconfig']['schedulingpolicy']
+	schedulermanager = None
+	if schedulingpolicy == 'priority':
+		schedulermanager = SchedulerManager()
+		schedulermanager.start()
+		scanqueue = schedulermanager.PriorityQueue()
+	else:
+		scanqueue = multiprocessing.JoinableQueue(maxsize=0)
+	reportqueue = scanmanager.Queue(maxsize=0)
+	processpool = []
+	processargs = []
+
+	## keep a set of hashes in shared memory, to see which ones
+	## have already been processed, so duplicates can be
+	## detected. It is cleared for every binary.
+	hashset = dedup.HashSet(scans['batconfig']['dedupslots'])
+
+	## Start the marker search service, so big files (including the top
+	## level files) can be searched for markers in parallel as well.
+	## Every scan process gets its own queue for the results, the last
+	## queue is used by the main process.
+	markertaskqueue = None
+	markerresultqueues = []
+	markerpool = []
+	if processamount > 1:
+		markertaskqueue = multiprocessing.Queue(maxsize=0)
+		for i in range(0,processamount+1):
+			markerresultqueues.append(multiprocessing.Queue(maxsize=0))
+		for i in range(0,processamount):
+			p = multiprocessing.Process(target=markersearchservice, args=(markertaskqueue, markerresultqueues))
+			markerpool.append(p)
+			p.start()
 
-		## copy the binary to the root of the unpack directory
-		starttime = datetime.datetime.utcnow()
-		if debug:
-			print >>sys.stderr, "COPYING BEGIN", starttime.isoformat()
-			sys.stderr.flush()
+	for i in range(0,processamount):
+		if i < len(scancursors):
+			cursor = scancursors[i]
+			conn = scancons[i]
+		else:
+			cursor = None
+			conn = None
+		if markertaskqueue != None:
+			markerresultqueue = markerresultqueues[i]
+		else:
+			markerresultqueue = None
+		args = (scanqueue, reportqueue, scanplan, magicscans, optmagicscans, i, hashset, template, outputhash, cursor, conn, scansourcecode, scans['batconfig']['dumpoffsets'], compressed, timeout, tlshmaxsize, markertaskqueue, markerresultqueue, nestedmarkersearchminimum, markersearchchunksize, schedulingpolicy, leafresultcache, scans['batconfig']['reusestoredresults'], knownfilefilter)
+		p = multiprocessing.Process(target=scan, args=args)
+		processargs.append(args)
+		processpool.append(p)
+		p.start()
 
-		shutil.copy(scan_binary, scantempdir)
-		os.chmod(os.path.join(scantempdir, scan_binary_basename), stat.S_IRWXU)
+	## record the original working directory, as that is
+	## what BAT will start at for each scan.
+	origcwd = os.getcwd()
 
-		endtime = datetime.datetime.utcnow()
-		if debug:
-			print >>sys.stderr, "COPYING END", endtime.isoformat()
-			sys.stderr.flush()
+	## the scan processes are stopped at the end, even if scanning
+	## one of the binaries failed, as otherwise BAT would not exit.
+	try:
+		## now process each of the binaries individually
+		for bins in binaries:
+			statistics = {}
+			(scan_binary, writeconfig) = bins
 
-		statistics['copying'] = endtime - starttime
-
-		## create the directory where result files (internal use) will be stored
-		if not os.path.exists(os.path.join(topleveldir, 'filereports')):
-			os.mkdir(os.path.join(topleveldir, 'filereports'))
-
-		## create the directory where result files (external) will be stored
-		if not os.path.exists(os.path.join(topleveldir, 'reports')):
-			os.mkdir(os.path.join(topleveldir, 'reports'))
-
-		## initialize a few data structures for the top level file:
-		## * tags    :: a list of tags that BAT will keep for the file
-		## * offsets :: a dictionary with offsets for each file type
-		##              found and which is used by unpacking scans
-		## * hints   :: a dictionary to pass extra information back
-		##              to the code launching the unpackers
-		tags = []
-		offsets = {}
-		hints = {}
-
-		## check if the file has an extension try to find if there
-		## is a special method defined for processing fies with that
-		## extension: often files with a particular extension will
-		## actually be of that file type, and it is possible to take
-		## a shortcut in those cases and skip many scans.
-		knownextension = False
-		fileextensions = scan_binary.lower().rsplit('.', 1)
-		if len(fileextensions) == 2:
-			fileextension = fileextensions[1]
-			for unpackscan in finalunpackscans:
-				if 'knownfilemethod' in unpackscan:
-					if fileextension in unpackscan['extensions']:
-						knownextension = True
-						break
+			## extra sanity check, in case the binary was removed
+			if not os.path.exists(scan_binary):
+				continue
+			scan_binary_basename = os.path.basename(scan_binary)
+
+			## force the cwd to a known value. This is to prevent mysterious
+			## errors in case some old results are cleaned up and the cwd is not
+			## restored in the code that had to change cwd for some reason.
+			os.chdir(origcwd)
+			scandate = datetime.datetime.utcnow()
+
+			## Per binary scanned a list with results is returned.
+			## Each file system or compressed file inside the binary returns a list
+			## with reports back as its result, so we have a list of lists.
+			## Within the inner list there is a result tuple, which could contain
+			## more lists in some fields, like libraries, or more result lists if
+			## the file inside a file system we looked at was in fact a file system.
+			unpackreports = {}
+
+			## a scan that was interrupted can be resumed in the
+			## directory that was used for that scan
+			resume = False
+			if 'resume' in writeconfig:
+				if writeconfig['resume'] != None:
+					resume = True
+
+			if resume:
+				topleveldir = writeconfig['resume']
+			else:
+				try:
+					## test if unpackdirectory is actually writable
+					topleveldir = tempfile.mkdtemp(dir=unpackdirectory)
+				except:
+					unpackdirectory = None
+					topleveldir = tempfile.mkdtemp(dir=unpackdirectory)
 
-		## In case the extension is not known (and it is not possible to
-		## take a shortcut) try to do the marker search for the top level
-		## file in parallel if the file is big enough. For very big files
-		## this can save quite a bit of time.
-		if not knownextension:
-			offsetcutoff = scans['batconfig']['markersearchminimum']
-			if os.stat(scan_binary).st_size > offsetcutoff:
-				offsettasks = []
-				for i in range(0, os.stat(scan_binary).st_size, 100000):
-					offsettasks.append((scantempdir, scan_binary_basename, magicscans, optmagicscans, max(i-50, 0), 100000+50))
-				pool = multiprocessing.Pool(processes=processamount)
-				res = pool.map(paralleloffsetsearch, offsettasks)
-				pool.terminate()
-
-				isascii = True
-
-				for offsetresult in res:
-					(i, offsettokeys, offsetisascii) = offsetresult
-					for j in i:
-						if j in offsets:
-							offsets[j] += i[j]
-						else:
-							offsets[j] = copy.deepcopy(i[j])
-					isascii = isascii and offsetisascii
-				for i in offsets:
-					offsets[i] = sorted(list(set(offsets[i])))
-				if isascii:
-					tags.append('text')
-				else:
-					tags.append('binary')
+			## reset the environment to a fresh copy
+			scanenv = copy.deepcopy(scans['batconfig']['environment'])
 
-		## fill the scan task list with the first entry
-		scantasks = [(scantempdir, scan_binary_basename, len(scantempdir), tmpdebug, tags, hints, offsets)]
+			## create the top level directory where all the unpacked data
+			## will be stored
+			scantempdir = os.path.join(topleveldir, "data")
+			if not os.path.exists(scantempdir):
+				os.makedirs(scantempdir)
 
-		template = scans['batconfig']['template']
+			## copy the binary to the root of the unpack directory
+			starttime = datetime.datetime.utcnow()
+			if debug:
+				print >>sys.stderr, "COPYING BEGIN", starttime.isoformat()
+				sys.stderr.flush()
 
-		starttime = datetime.datetime.utcnow()
-		if debug:
-			print >>sys.stderr, "PRERUN UNPACK BEGIN", starttime.isoformat()
-			sys.stderr.flush()
+			## when resuming the binary was possibly already copied
+			copybinary = True
+			if resume and os.path.exists(os.path.join(scantempdir, scan_binary_basename)):
+				if os.stat(os.path.join(scantempdir, scan_binary_basename)).st_size == os.stat(scan_binary).st_size:
+					copybinary = False
+			if copybinary:
+				shutil.copy(scan_binary, scantempdir)
+				os.chmod(os.path.join(scantempdir, scan_binary_basename), stat.S_IRWXU)
 
-		## create the directory to dump offsets in case they need
-		## to be dumped for later reference.
-		offsetdir = os.path.join(topleveldir, "offsets")
-		if scans['batconfig']['dumpoffsets']:
-			os.makedirs(offsetdir)
+			endtime = datetime.datetime.utcnow()
+			if debug:
+				print >>sys.stderr, "COPYING END", endtime.isoformat()
+				sys.stderr.flush()
 
-		## use a queue made with a manager to avoid some issues, see:
-		## http://docs.python.org/2/library/multiprocessing.html#pipes-and-queues
-		lock = Lock()
-		scanmanager = multiprocessing.Manager()
-		scanqueue = multiprocessing.JoinableQueue(maxsize=0)
-		reportqueue = scanmanager.Queue(maxsize=0)
-		processpool = []
+			statistics['copying'] = endtime - starttime
+
+			## create the directory where result files (internal use) will be stored
+			if not os.path.exists(os.path.join(topleveldir, 'filereports')):
+				os.mkdir(os.path.join(topleveldir, 'filereports'))
+
+			## create the directory where result files (external) will be stored
+			if not os.path.exists(os.path.join(topleveldir, 'reports')):
+				os.mkdir(os.path.join(topleveldir, 'reports'))
+
+			## initialize a few data structures for the top level file:
+			## * tags    :: a list of tags that BAT will keep for the file
+			## * offsets :: a dictionary with offsets for each file type
+			##              found and which is used by unpacking scans
+			## * hints   :: a dictionary to pass extra information back
+			##              to the code launching the unpackers
+			tags = []
+			offsets = {}
+			hints = {}
+
+			## check if the file has an extension try to find if there
+			## is a special method defined for processing fies with that
+			## extension: often files with a particular extension will
+			## actually be of that file type, and it is possible to take
+			## a shortcut in those cases and skip many scans. The same
+			## is done for files that start with a known marker.
+			knownheader = None
+			if scanplan.knownheadersize != 0:
+				scanbinaryfile = open(scan_binary, 'rb')
+				knownheader = scanbinaryfile.read(scanplan.knownheadersize)
+				scanbinaryfile.close()
+			knownextension = scanplan.knownfilescans(scan_binary, knownheader) != []
+
+			## In case the extension is not known (and it is not possible to
+			## take a shortcut) try to do the marker search for the top level
+			## file in parallel if the file is big enough. For very big files
+			## this can save quite a bit of time.
+			if not knownextension:
+				offsetcutoff = scans['batconfig']['markersearchminimum']
+				if os.stat(scan_binary).st_size > offsetcutoff:
+					markerres = None
+					if markertaskqueue != None:
+						## use the marker search service, with the result
+						## queue that is reserved for the main process
+						try:
+							markerres = servicemarkersearch(scantempdir, scan_binary_basename, magicscans, optmagicscans, os.stat(scan_binary).st_size, markersearchchunksize, processamount, markertaskqueue, markerresultqueues[processamount], timeout)
+						except Exception, e:
+							markerres = None
+					if markerres == None:
+						offsettasks = markersearchtasks(scantempdir, scan_binary_basename, magicscans, optmagicscans, os.stat(scan_binary).st_size, markersearchchunksize)
+						pool = multiprocessing.Pool(processes=processamount)
+						res = pool.map(paralleloffsetsearch, offsettasks)
+						pool.terminate()
+						markerres = mergemarkersearch(res)
+
+					(offsets, isascii) = markerres
+					if isascii:
+						tags.append('text')
+					else:
+						tags.append('binary')
 
-		## keep a dictionary for hashes, to see which ones
-		## have already been processed, so duplicates can be
-		## detected.
-		hashdict = scanmanager.dict()
+			starttime = datetime.datetime.utcnow()
+			if debug:
+				print >>sys.stderr, "PRERUN UNPACK BEGIN", starttime.isoformat()
+				sys.stderr.flush()
 
-		map(lambda x: scanqueue.put(x), scantasks)
-		for i in range(0,processamount):
-			if usedatabase:
-				cursor = batcursors[i]
-				conn = batcons[i]
-			else:
-				cursor = None
-				conn = None
-			p = multiprocessing.Process(target=scan, args=(scanqueue, reportqueue, finalunpackscans, finalleafscans, scans['prerunscans'], prerunignore, prerunmagic, magicscans, optmagicscans, i, hashdict, lock, template, unpackdirectory, topleveldir, scantempdir, outputhash, cursor, conn, scansourcecode, scans['batconfig']['dumpoffsets'], offsetdir, compressed, timeout, scan_binary_basename, tlshmaxsize))
-			processpool.append(p)
-			p.start()
+			## create the directory to dump offsets in case they need
+			## to be dumped for later reference.
+			offsetdir = os.path.join(topleveldir, "offsets")
+			if scans['batconfig']['dumpoffsets'] and not os.path.exists(offsetdir):
+				os.makedirs(offsetdir)
+
+			## the scan processes are shared by all binaries, so make sure
+			## that processes that died (for example because of a time out
+			## while waiting for tasks) are replaced.
+			for i in range(0,processamount):
+				if not processpool[i].is_alive():
+					p = multiprocessing.Process(target=scan, args=processargs[i])
+					processpool[i] = p
+					p.start()
 
-		scanqueue.join()
-
-		## Sometimes there are identical files inside a blob.
-		## To minimize time spent on scanning these should only be
-		## scanned once. Since the results are independent anyway (the
-		## unpacking phase is where unique paths are determined after all)
-		## each sha256 can be scanned only once. If there are more files
-		## with the same sha256 the result can simply be copied
-		## with some data changed.
-		##
-		## * keep a list of which sha256 have duplicates.
-		## * filter out the checksums
-		## * for each sha256 scan once
-		## * copy results in case there are duplicates
-		dupes = []
-
-		while True:
-			try:
-				val = reportqueue.get_nowait()
+			## everything that is specific for this binary is passed to
+			## the scan processes with the tasks, and inherited by the tasks
+			## for any files that are unpacked from it.
+			scancontext = {'topleveldir': topleveldir, 'tempdir': scantempdir, 'unpacktempdir': unpackdirectory, 'offsetdir': offsetdir}
+
+			## duplicates are only detected within a binary
+			hashset.clear()
+
+			## fill the scan task list with the first entry
+			scantasks = [(scantempdir, scan_binary_basename, len(scantempdir), tmpdebug, tags, hints, offsets, scancontext)]
+
+			## start collecting the results, which are written to a
+			## log in the top level directory
+			reportlogname = os.path.join(topleveldir, 'unpackreports.log')
+
+			## when resuming only the files that were not completely
+			## scanned are scanned again
+			if resume:
+				scantasks = replayjournal(reportlogname, scantasks[0], scantempdir, scancontext, hashset)
+			collector = threading.Thread(target=collectreports, args=(reportqueue, reportlogname))
+			collector.start()
+
+			map(lambda x: queuescantask(scanqueue, x, schedulingpolicy, scanplan), scantasks)
+
+			scanqueue.join()
+
+			## all results are in the report queue, so tell the collector
+			## to stop after it has processed the last result.
+			reportqueue.put(None)
+			collector.join()
+
+			## keep the leaf scan result cache within its size limit
+			if leafresultcache != None:
+				leafresultcache.evict()
+
+			## Sometimes there are identical files inside a blob.
+			## To minimize time spent on scanning these should only be
+			## scanned once. Since the results are independent anyway (the
+			## unpacking phase is where unique paths are determined after all)
+			## each sha256 can be scanned only once. If there are more files
+			## with the same sha256 the result can simply be copied
+			## with some data changed.
+			##
+			## * keep a list of which sha256 have duplicates.
+			## * filter out the checksums
+			## * for each sha256 scan once
+			## * copy results in case there are duplicates
+			dupes = []
+
+			## the checksums of the files that were scanned and the
+			## name of the file, to look up the originals of duplicates
+			scannedhashes = {}
+
+			## optionally keep the reports on disk instead of in memory
+			if scans['batconfig']['reportstore'] == 'sqlite':
+				unpackreportsdb = os.path.join(topleveldir, 'unpackreports.sqlite3')
+				## left over from an interrupted scan
+				if os.path.exists(unpackreportsdb):
+					os.unlink(unpackreportsdb)
+				unpackreports = reportstore.ReportStore(unpackreportsdb, scans['batconfig']['reportstorecache'])
+
+			for val in readreports(reportlogname):
+				## records of scan tasks are only needed to resume scans
+				if isinstance(val, tuple):
+					continue
 				for k in val:
 					if 'tags' in val[k]:
 						## the file is a duplicate, so store
@@ -2217,174 +2830,190 @@ def runscan(scans, binaries, batversion):
 						if 'duplicate' in val[k]['tags']:
 							dupes.append(val)
 							continue
-					unpackreports[k] = val[k]
-				reportqueue.task_done()
-			except Queue.Empty, e:
-				## Queue is empty
-				break
+					## store the report in a compact form
+					unpackreports[k] = reportrecord.UnpackReport(val[k])
+					if 'checksum' in val[k]:
+						if not val[k]['checksum'] in scannedhashes:
+							scannedhashes[val[k]['checksum']] = k
+
+			## for duplicate files copy some information into
+			## unpackreports, except for the name and path
+			for i in dupes:
+				for k in i:
+					dupesha256 = i[k]['checksum']
+					origname = i[k]['name']
+					origrealpath = i[k]['realpath']
+					origpath = i[k]['path']
+					origrelativename = i[k]['relativename']
+					## keep name, realpath, relativename, path for
+					## the duplicate, and copy the rest of the
+					## data from the original.
+					dupecopy = copy.deepcopy(unpackreports[scannedhashes[dupesha256]])
+					dupecopy['name'] = origname
+					dupecopy['path'] = origpath
+					dupecopy['realpath'] = origrealpath
+					dupecopy['relativename'] = origrelativename
+					dupecopy['tags'].append('duplicate')
+					unpackreports[k] = dupecopy
+
+			endtime = datetime.datetime.utcnow()
+			if debug:
+				print >>sys.stderr, "PRERUN UNPACK END", endtime.isoformat()
+			if scans['batconfig']['reportendofphase']:
+				print "PRERUN UNPACK END %s" % scan_binary_basename, endtime.isoformat()
+			statistics['prerununpack'] = endtime - starttime
+
+			## always add an extra tag 'toplevel' for the top level item
+			if 'checksum' in unpackreports[scan_binary_basename]:
+				filehash = unpackreports[scan_binary_basename]['checksum']
+				leaf_file_path = os.path.join(topleveldir, "filereports", "%s-filereport.pickle" % filehash)
 
-		## block here until the reportqueue is empty
-		reportqueue.join()
-	
-		## for duplicate files copy some information into
-		## unpackreports, except for the name and path
-		for i in dupes:
-			for k in i:
-				dupesha256 = i[k]['checksum']
-				origname = i[k]['name']
-				origrealpath = i[k]['realpath']
-				origpath = i[k]['path']
-				origrelativename = i[k]['relativename']
-				## keep name, realpath, relativename, path for
-				## the duplicate, and copy the rest of the
-				## data from the original.
-				dupecopy = copy.deepcopy(unpackreports[hashdict[dupesha256]])
-				dupecopy['name'] = origname
-				dupecopy['path'] = origpath
-				dupecopy['realpath'] = origrealpath
-				dupecopy['relativename'] = origrelativename
-				dupecopy['tags'].append('duplicate')
-				unpackreports[k] = dupecopy
+				## first record what the top level element is. This will be used by other scans
+				leaf_file = open(leaf_file_path, 'rb')
+				leafreports = cPickle.load(leaf_file)
+				leaf_file.close()
 
-		## finally shut down all the processes and the scanmanager
-		for p in processpool:
-			p.terminate()
+				unpackreports[scan_binary_basename]['tags'].append('toplevel')
+				unpackreports[scan_binary_basename]['scandate'] = scandate
+				leafreports['tags'].append('toplevel')
 
-		scanmanager.shutdown()
+				leaf_file = open(leaf_file_path, 'wb')
+				leafreports = cPickle.dump(leafreports, leaf_file)
+				leaf_file.close()
 
-		endtime = datetime.datetime.utcnow()
-		if debug:
-			print >>sys.stderr, "PRERUN UNPACK END", endtime.isoformat()
-		if scans['batconfig']['reportendofphase']:
-			print "PRERUN UNPACK END %s" % scan_binary_basename, endtime.isoformat()
-		statistics['prerununpack'] = endtime - starttime
-
-		## always add an extra tag 'toplevel' for the top level item
-		if 'checksum' in unpackreports[scan_binary_basename]:
-			filehash = unpackreports[scan_binary_basename]['checksum']
-			leaf_file_path = os.path.join(topleveldir, "filereports", "%s-filereport.pickle" % filehash)
-
-			## first record what the top level element is. This will be used by other scans
-			leaf_file = open(leaf_file_path, 'rb')
-			leafreports = cPickle.load(leaf_file)
-			leaf_file.close()
-
-			unpackreports[scan_binary_basename]['tags'].append('toplevel')
-			unpackreports[scan_binary_basename]['scandate'] = scandate
-			leafreports['tags'].append('toplevel')
-
-			leaf_file = open(leaf_file_path, 'wb')
-			leafreports = cPickle.dump(leafreports, leaf_file)
-			leaf_file.close()
-
-		## LEGACY: Now the next phase starts, namely scanning each individual
-		## file. This is done once per unique file (based on checksum).
-		## CURRENT: this is a NOP and just there to satisfy a few older use cases
-		if scans['batconfig']['reportendofphase']:
-			print "LEAF END %s" % scan_binary_basename, datetime.datetime.utcnow().isoformat()
-			sys.stdout.flush()
-
-		## Scan the files in context
-		starttime = datetime.datetime.utcnow()
-		if debug:
-			print >>sys.stderr, "AGGREGATE BEGIN", starttime.isoformat()
-			sys.stderr.flush()
-		if scans['aggregatescans'] != []:
-			## because there are 'eval' statements the code to call aggregate scans
-			## has to be in a separate method
-			aggregatestatistics = aggregatescan(unpackreports, finalaggregatescans, processamount, scantempdir, topleveldir, scan_binary_basename, scandate, batcursors, batcons, aggregatedebug, unpackdirectory)
-			statistics.update(aggregatestatistics)
-		endtime = datetime.datetime.utcnow()
-		if debug:
-			print >>sys.stderr, "AGGREGATE END", endtime.isoformat()
-			sys.stderr.flush()
-		if scans['batconfig']['reportendofphase']:
-			print "AGGREGATE END %s" % scan_binary_basename, endtime.isoformat()
-			sys.stdout.flush()
-		statistics['aggregate'] = endtime - starttime
+			## LEGACY: Now the next phase starts, namely scanning each individual
+			## file. This is done once per unique file (based on checksum).
+			## CURRENT: this is a NOP and just there to satisfy a few older use cases
+			if scans['batconfig']['reportendofphase']:
+				print "LEAF END %s" % scan_binary_basename, datetime.datetime.utcnow().isoformat()
+				sys.stdout.flush()
 
-		for i in unpackreports:
-			if 'tags' in unpackreports[i]:
-				unpackreports[i]['tags'] = list(set(unpackreports[i]['tags']))
+			## Scan the files in context
+			starttime = datetime.datetime.utcnow()
+			if debug:
+				print >>sys.stderr, "AGGREGATE BEGIN", starttime.isoformat()
+				sys.stderr.flush()
+			if scans['aggregatescans'] != []:
+				## Files for which stored results were reused were not
+				## unpacked, so these are hidden from the aggregate scans.
+				## If the stored results for the binary itself were reused
+				## the results of the aggregate scans are already known.
+				storednames = set(filter(lambda x: 'storedresult' in unpackreports[x].get('tags', []), unpackreports))
+				if not scan_binary_basename in storednames:
+					aggregatereports = unpackreports
+					if storednames != set():
+						aggregatereports = reportstore.ReportView(unpackreports, storednames)
+					## because there are 'eval' statements the code to call aggregate scans
+					## has to be in a separate method
+					aggregatestatistics = aggregatescan(aggregatereports, finalaggregatescans, processamount, scantempdir, topleveldir, scan_binary_basename, scandate, batcursors, batcons, aggregatedebug, unpackdirectory)
+					statistics.update(aggregatestatistics)
+			endtime = datetime.datetime.utcnow()
+			if debug:
+				print >>sys.stderr, "AGGREGATE END", endtime.isoformat()
+				sys.stderr.flush()
+			if scans['batconfig']['reportendofphase']:
+				print "AGGREGATE END %s" % scan_binary_basename, endtime.isoformat()
+				sys.stdout.flush()
+			statistics['aggregate'] = endtime - starttime
 
-		starttime = datetime.datetime.utcnow()
-		if debug:
-			print >>sys.stderr, "POSTRUN BEGIN", starttime.isoformat()
-		## run postrunscans here, again in parallel, if needed/wanted
-		## These scans typically only have a few side effects, but don't change
-		## the reporting/scanning, just process the results. Examples: generate
-		## fancier reports, use microblogging to post scan results, etc.
-		## Duplicates that are tagged as 'duplicate' are not processed.
-		if scans['postrunscans'] != [] and unpackreports != {}:
-			scanqueue = multiprocessing.JoinableQueue(maxsize=0)
-
-			havetask = False
 			for i in unpackreports:
-				if not 'checksum' in unpackreports[i]:
-					continue
-				if not 'tags' in unpackreports[i]:
-					continue
-				if 'duplicate' in unpackreports[i]['tags']:
-					continue
-				tmpdebug = False
-				if debug:
-					tmpdebug = True
-					if debugphases != []:
-						if not 'postrun' in debugphases:
-							tmpdebug = False
-				havetask = True
-				scanqueue.put((i, unpackreports[i]))
-
-			if havetask:
-				processpool = []
-				parallel = True
-				if tmpdebug:
-					if debugphases == []:
-						parallel = False
-					else:
-						if 'postrun' in debugphases:
+				if 'tags' in unpackreports[i]:
+					unpackreports[i]['tags'] = list(set(unpackreports[i]['tags']))
+
+			starttime = datetime.datetime.utcnow()
+			if debug:
+				print >>sys.stderr, "POSTRUN BEGIN", starttime.isoformat()
+			## run postrunscans here, again in parallel, if needed/wanted
+			## These scans typically only have a few side effects, but don't change
+			## the reporting/scanning, just process the results. Examples: generate
+			## fancier reports, use microblogging to post scan results, etc.
+			## Duplicates that are tagged as 'duplicate' are not processed,
+			## nor are files for which stored results were reused, as these
+			## were not unpacked.
+			if scans['postrunscans'] != [] and len(unpackreports) != 0:
+				postrunqueue = multiprocessing.JoinableQueue(maxsize=0)
+
+				havetask = False
+				for i in unpackreports:
+					if not 'checksum' in unpackreports[i]:
+						continue
+					if not 'tags' in unpackreports[i]:
+						continue
+					if 'duplicate' in unpackreports[i]['tags']:
+						continue
+					if 'storedresult' in unpackreports[i]['tags']:
+						continue
+					tmpdebug = False
+					if debug:
+						tmpdebug = True
+						if debugphases != []:
+							if not 'postrun' in debugphases:
+								tmpdebug = False
+					havetask = True
+					postrunqueue.put((i, unpackreports[i]))
+
+				if havetask:
+					postrunpool = []
+					parallel = True
+					if tmpdebug:
+						if debugphases == []:
 							parallel = False
-				if not parallel:
-					postrunprocessamount = 1
-				else:
-					postrunprocessamount = processamount
-				for i in range(0,postrunprocessamount):
-					if usedatabase:
-						cursor = batcursors[i]
-						conn = batcons[i]
+						else:
+							if 'postrun' in debugphases:
+								parallel = False
+					if not parallel:
+						postrunprocessamount = 1
 					else:
-						cursor = None
-						conn = None
-					p = multiprocessing.Process(target=postrunscan, args=(scanqueue, scans['postrunscans'], topleveldir, scantempdir, cursor, conn, tmpdebug, timeout))
-					processpool.append(p)
-					p.start()
-
-				scanqueue.join()
+						postrunprocessamount = processamount
+					for i in range(0,postrunprocessamount):
+						if usedatabase:
+							cursor = batcursors[i]
+							conn = batcons[i]
+						else:
+							cursor = None
+							conn = None
+						p = multiprocessing.Process(target=postrunscan, args=(postrunqueue, scans['postrunscans'], topleveldir, scantempdir, cursor, conn, tmpdebug, timeout))
+						postrunpool.append(p)
+						p.start()
 
-				for p in processpool:
-					p.terminate()
+					postrunqueue.join()
 
-		endtime = datetime.datetime.utcnow()
-		if debug:
-			print >>sys.stderr, "POSTRUN END", endtime.isoformat()
-		if scans['batconfig']['reportendofphase']:
-			print "POSTRUN END %s" % scan_binary_basename, endtime.isoformat()
-		statistics['postrun'] = endtime - starttime
+					for p in postrunpool:
+						p.terminate()
 
-		endtime = datetime.datetime.utcnow()
-		statistics['total'] = endtime - scandate
+			endtime = datetime.datetime.utcnow()
+			if debug:
+				print >>sys.stderr, "POSTRUN END", endtime.isoformat()
+			if scans['batconfig']['reportendofphase']:
+				print "POSTRUN END %s" % scan_binary_basename, endtime.isoformat()
+			statistics['postrun'] = endtime - starttime
+
+			endtime = datetime.datetime.utcnow()
+			statistics['total'] = endtime - scandate
+
+			## finally write an archive file with all the data, if configured to do so
+			if scans['batconfig']['writeoutputfile']:
+				writeDumpfile(unpackreports, scans, processamount, writeconfig['outputfile'], writeconfig['config'], topleveldir, batversion, statistics, scans['batconfig']['packpickles'], scans['batconfig']['outputlite'], scans['batconfig']['debug'], compressed)
+			if isinstance(unpackreports, reportstore.ReportStore):
+				unpackreports.close()
+			if scans['batconfig']['cleanup']:
+				try:
+					shutil.rmtree(topleveldir)
+				except Exception, e:
+					pass
+			if scans['batconfig']['reportendofphase']:
+				print "done", scan_binary, datetime.datetime.utcnow().isoformat()
+				sys.stdout.flush()
+	finally:
+		## finally shut down all the processes and the scanmanager
+		for p in processpool:
+			p.terminate()
+		for p in markerpool:
+			p.terminate()
 
-		## finally write an archive file with all the data, if configured to do so
-		if scans['batconfig']['writeoutputfile']:
-			writeDumpfile(unpackreports, scans, processamount, writeconfig['outputfile'], writeconfig['config'], topleveldir, batversion, statistics, scans['batconfig']['packpickles'], scans['batconfig']['outputlite'], scans['batconfig']['debug'], compressed)
-		if scans['batconfig']['cleanup']:
-			try:
-				shutil.rmtree(topleveldir)
-			except Exception, e:
-				pass
-		if scans['batconfig']['reportendofphase']:
-			print "done", scan_binary, datetime.datetime.utcnow().isoformat()
-			sys.stdout.flush()
+		scanmanager.shutdown()
+		if schedulermanager != None:
+			schedulermanager.shutdown()
 
 	## clean up the database connections and
 	## close all connections to the database
@@ -2392,3 +3021,7 @@ def runscan(scans, binaries, batversion):
 		c.close()
 	for c in batcons:
 		c.close()
+	for c in scancursors:
+		c.close()
+	for c in scancons:
+		c.close()
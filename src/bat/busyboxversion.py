@@ -16,39 +16,26 @@ def busybox_version(filename, tags, cursor, conn, filehashes, blacklist=[], scan
                 filesize = os.stat(filename).st_size
 		## if the whole file is blacklisted, we don't have to scan
 		if blacklist != []:
-                	if extractor.inblacklist(0, blacklist) == filesize:
+			if not isinstance(blacklist, extractor.Blacklist):
+				blacklist = extractor.Blacklist(blacklist)
+			if blacklist.covers(0, filesize):
 				return None
-			## make a copy and add a bogus value for the last
-			## byte to a temporary blacklist to make the loop work
-			## well.
-			blacklist_tmp = copy.deepcopy(blacklist)
-			blacklist_tmp.append((filesize,filesize))
 			datafile = open(filename, 'rb')
-			lastindex = 0
-			datafile.seek(lastindex)
-			for i in blacklist_tmp:
-				if i[0] == lastindex:
-					lastindex = i[1] - 1
-					datafile.seek(lastindex)
+			bbres = None
+			for (lower, upper) in blacklist.gaps(0, filesize):
+				## check if there actually is enough data to do a search first
+				## "BusyBox v" has length 9, has at least 2 digits and a dot
+				if (upper - lower) < 12:
 					continue
-				if i[0] > lastindex:
-					## check if there actually is enough data to do a search first
-					## "BusyBox v" has length 9, has at least 2 digits and a dot
-					if (i[0] - lastindex) < 12:
-						lastindex = i[1] - 1
-						datafile.seek(lastindex)
-						continue
-					data = datafile.read(i[0] - lastindex)
-					tmpfile = tempfile.mkstemp()
-					os.write(tmpfile[0], data)
-					os.fdopen(tmpfile[0]).close()
-					bbres = busybox.extract_version(tmpfile[1])
-					os.unlink(tmpfile[1])
-					## set lastindex to the next
-					lastindex = i[1] - 1
-					datafile.seek(lastindex)
-					if bbres != None:
-						break
+				datafile.seek(lower)
+				data = datafile.read(upper - lower)
+				tmpfile = tempfile.mkstemp()
+				os.write(tmpfile[0], data)
+				os.fdopen(tmpfile[0]).close()
+				bbres = busybox.extract_version(tmpfile[1])
+				os.unlink(tmpfile[1])
+				if bbres != None:
+					break
 			datafile.close()
 		else:
 			bbres = busybox.extract_version(filename)
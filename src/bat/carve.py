@@ -0,0 +1,143 @@
+#!/usr/bin/python
+
+## Binary Analysis Tool
+## Licensed under Apache 2.0, see LICENSE file for details
+
+'''
+This module contains methods to carve a range of bytes from a file into a new
+file, without reading the data into Python and without launching external
+programs such as dd or tail.
+
+Depending on what the kernel and file system support the data is either:
+
+1. cloned (reflink) using the FICLONERANGE ioctl, which only works if the
+range is aligned to the block size of the file system and both files are on the
+same (btrfs, XFS, etc.) file system
+2. copied by the kernel using copy_file_range()
+3. copied by the kernel using sendfile()
+4. copied in small chunks, as a last resort
+'''
+
+import os, stat, struct, errno, fcntl, ctypes, ctypes.util
+
+## ioctl to clone a range of bytes from one file into another, see
+## <linux/fs.h>: _IOW(0x94, 13, struct file_clone_range)
+FICLONERANGE = 0x4020940d
+
+## size of the chunks that are copied at once by the kernel, or in Python
+## if the kernel cannot copy the data.
+carvechunksize = 8388608
+
+## load the C library and look up copy_file_range() (glibc 2.27 and later)
+## and sendfile(). If any of these cannot be found the next method is tried.
+try:
+	libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+except Exception, e:
+	libc = None
+
+libc_copy_file_range = None
+libc_sendfile = None
+if libc != None:
+	try:
+		libc_copy_file_range = libc.copy_file_range
+		libc_copy_file_range.argtypes = [ctypes.c_int, ctypes.POINTER(ctypes.c_longlong), ctypes.c_int, ctypes.POINTER(ctypes.c_longlong), ctypes.c_size_t, ctypes.c_uint]
+		libc_copy_file_range.restype = ctypes.c_ssize_t
+	except AttributeError, e:
+		libc_copy_file_range = None
+	try:
+		libc_sendfile = libc.sendfile64
+		libc_sendfile.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.POINTER(ctypes.c_longlong), ctypes.c_size_t]
+		libc_sendfile.restype = ctypes.c_ssize_t
+	except AttributeError, e:
+		libc_sendfile = None
+
+## clone the range with a reflink. Returns True if successful.
+def reflinkrange(srcfd, dstfd, offset, length, filesize):
+	blocksize = os.fstat(srcfd).st_blksize
+	if blocksize <= 0:
+		return False
+	## the start of the range always has to be aligned, the end only
+	## if it is not the end of the file
+	if offset % blocksize != 0:
+		return False
+	if (offset + length) != filesize and length % blocksize != 0:
+		return False
+	try:
+		fcntl.ioctl(dstfd, FICLONERANGE, struct.pack('=qQQQ', srcfd, offset, length, 0))
+	except (IOError, OSError), e:
+		return False
+	return True
+
+## copy the range with copy_file_range(). Returns the amount of bytes that
+## were copied, which could be less than length if the kernel gave up.
+def copyfilerange(srcfd, dstfd, offset, length):
+	if libc_copy_file_range == None:
+		return 0
+	srcoffset = ctypes.c_longlong(offset)
+	dstoffset = ctypes.c_longlong(0)
+	copied = 0
+	while copied < length:
+		res = libc_copy_file_range(srcfd, ctypes.byref(srcoffset), dstfd, ctypes.byref(dstoffset), min(carvechunksize, length - copied), 0)
+		if res <= 0:
+			break
+		copied += res
+	return copied
+
+## copy the range with sendfile(), starting at the current position in
+## the destination file. Returns the amount of bytes that were copied.
+def sendfilerange(srcfd, dstfd, offset, length):
+	if libc_sendfile == None:
+		return 0
+	srcoffset = ctypes.c_longlong(offset)
+	copied = 0
+	while copied < length:
+		res = libc_sendfile(dstfd, srcfd, ctypes.byref(srcoffset), min(carvechunksize, length - copied))
+		if res <= 0:
+			break
+		copied += res
+	return copied
+
+## copy the range in chunks, starting at the current position in the
+## destination file. Returns the amount of bytes that were copied.
+def readwriterange(srcfd, dstfd, offset, length):
+	os.lseek(srcfd, offset, os.SEEK_SET)
+	copied = 0
+	while copied < length:
+		data = os.read(srcfd, min(carvechunksize, length - copied))
+		if data == '':
+			break
+		os.write(dstfd, data)
+		copied += len(data)
+	return copied
+
+## Carve 'length' bytes starting at 'offset' from 'filename' and write them
+## to 'outfile'. If length is 0 all the data until the end of the file is
+## carved. Returns the amount of bytes that were written to 'outfile'.
+def carveFile(filename, offset, outfile, length=0):
+	srcfd = os.open(filename, os.O_RDONLY)
+	try:
+		filesize = os.fstat(srcfd).st_size
+		offset = min(offset, filesize)
+		if length == 0 or offset + length > filesize:
+			length = filesize - offset
+		dstfd = os.open(outfile, os.O_WRONLY|os.O_CREAT|os.O_TRUNC, stat.S_IRUSR|stat.S_IWUSR)
+		try:
+			if length == 0:
+				return 0
+			if reflinkrange(srcfd, dstfd, offset, length, filesize):
+				return length
+
+			copied = copyfilerange(srcfd, dstfd, offset, length)
+			if copied < length:
+				## continue where copy_file_range() stopped (if it
+				## was used at all), with the next best method.
+				os.lseek(dstfd, copied, os.SEEK_SET)
+				copied += sendfilerange(srcfd, dstfd, offset + copied, length - copied)
+			if copied < length:
+				os.lseek(dstfd, copied, os.SEEK_SET)
+				copied += readwriterange(srcfd, dstfd, offset + copied, length - copied)
+			return copied
+		finally:
+			os.close(dstfd)
+	finally:
+		os.close(srcfd)
@@ -23,41 +23,26 @@ def genericSearch(filename, markerDict, blacklist=[], unpacktempdir=None):
 	carved = False
 	foundmarkers = set()
 	if blacklist != []:
-		if extractor.inblacklist(0, blacklist) == filesize:
+		if not isinstance(blacklist, extractor.Blacklist):
+			blacklist = extractor.Blacklist(blacklist)
+		if blacklist.covers(0, filesize):
 			return None
 		datafile = open(filename, 'rb')
-		lastindex = 0
-		datafile.seek(lastindex)
-		## make a copy and add a bogus value for the last
-		## byte to a temporary blacklist to make the loop work
-		## well.
-		blacklist_tmp = copy.deepcopy(blacklist)
-		blacklist_tmp.append((filesize,filesize))
-		for i in blacklist_tmp:
-			if i[0] == lastindex:
-				lastindex = i[1] - 1
-				datafile.seek(lastindex)
+		## only search the parts of the file that are not blacklisted
+		for (lower, upper) in blacklist.gaps(0, filesize):
+			if upper - lower <= 1:
 				continue
-			if i[0] > lastindex:
-				## read the data, then search for markers
-				data = datafile.read(i[0] - lastindex)
-				if len(data) <=1:
-					## set lastindex to the next
-					lastindex = i[1] - 1
-					datafile.seek(lastindex)
+			datafile.seek(lower)
+			data = datafile.read(upper - lower)
+			for marker in markerDict.keys():
+				if marker in foundmarkers:
 					continue
-				for marker in markerDict.keys():
-					if marker in foundmarkers:
-						continue
-					for markerstring in markerDict[marker]:
-						markeroffset = data.find(markerstring)
-						if markeroffset != -1:
-							results.append(marker)
-							foundmarkers.add(marker)
-							break
-				## set lastindex to the next
-				lastindex = i[1] - 1
-				datafile.seek(lastindex)
+				for markerstring in markerDict[marker]:
+					markeroffset = data.find(markerstring)
+					if markeroffset != -1:
+						results.append(marker)
+						foundmarkers.add(marker)
+						break
 		datafile.close()
 	else:
 		datafile = open(filename, 'rb')
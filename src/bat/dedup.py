@@ -0,0 +1,72 @@
+#!/usr/bin/python
+
+## Binary Analysis Tool
+## Licensed under Apache 2.0, see LICENSE file for details
+
+'''
+This module contains a set of checksums in shared memory, which is used by the
+scan processes to find out if a file with the same checksum was already
+scanned (or is being scanned) by another process.
+
+The set is split into shards. Every shard has its own lock and a fixed amount
+of slots, so processes only wait for each other if they access the same shard
+at the same time. No separate (manager) process is involved.
+
+Checksums are stored in binary form in slots of 32 bytes (big enough for
+SHA256). Within a shard open addressing with linear probing is used. If a
+shard is full a checksum cannot be claimed, and the file it belongs to is
+treated as not seen before: it is then scanned again instead of being marked
+as a duplicate, which is slower, but still correct.
+'''
+
+import multiprocessing, ctypes, binascii, hashlib, struct
+
+## size of a slot, enough for a SHA256 checksum
+slotsize = 32
+
+class HashSet(object):
+	def __init__(self, slots=262144, shards=64):
+		self.shards = shards
+		self.shardslots = max(1, slots/shards)
+		self.checksums = multiprocessing.RawArray(ctypes.c_char, self.shards * self.shardslots * slotsize)
+		self.used = multiprocessing.RawArray(ctypes.c_ubyte, self.shards * self.shardslots)
+		self.locks = map(lambda x: multiprocessing.Lock(), range(0, self.shards))
+
+	## Claim a checksum. Returns True if the checksum was not seen before,
+	## False if another process (or this process) already claimed it.
+	def claim(self, checksum):
+		## checksums are hexadecimal strings, convert them to
+		## binary. Anything else is first hashed with SHA256.
+		try:
+			key = binascii.unhexlify(checksum)
+		except TypeError, e:
+			key = hashlib.sha256(checksum).digest()
+		if len(key) > slotsize:
+			key = hashlib.sha256(key).digest()
+		key = key.ljust(slotsize, '\x00')
+
+		## the checksums are (cryptographic) hashes, so the bytes
+		## can be used directly to find the shard and the first slot
+		(shardkey, slotkey) = struct.unpack('<IQ', key[:12])
+		shard = shardkey % self.shards
+		firstslot = shard * self.shardslots
+
+		self.locks[shard].acquire()
+		try:
+			for i in xrange(0, self.shardslots):
+				slot = firstslot + (slotkey + i) % self.shardslots
+				if self.used[slot] == 0:
+					self.checksums[slot*slotsize:(slot+1)*slotsize] = key
+					self.used[slot] = 1
+					return True
+				if self.checksums[slot*slotsize:(slot+1)*slotsize] == key:
+					return False
+		finally:
+			self.locks[shard].release()
+		## the shard is full
+		return True
+
+	## Remove all checksums. This should only be done when none of
+	## the processes are using the set.
+	def clear(self):
+		ctypes.memset(self.used, 0, len(self.used))
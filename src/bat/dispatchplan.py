@@ -0,0 +1,161 @@
+#!/usr/bin/python
+
+## Binary Analysis Tool
+## Licensed under Apache 2.0, see LICENSE file for details
+
+'''
+This module contains the dispatch plan for the scan processes: the prerun,
+unpack and leaf scans from the configuration, compiled once before the scan
+processes are started, so for every file only cheap lookups are needed:
+
+* the methods of the scans are imported once, instead of for every file
+* 'magic', 'optmagic', 'noscan', 'scanonly' and 'extensionsignore', which are
+  strings with values separated by ':' in the configuration, are split once
+  and stored as sets, tuples or bit masks (see reportrecord)
+* a table with the unpack scans with a 'knownfilemethod' per file extension
+  and per marker at the start of the file (see fsmagic), so files that were
+  renamed (for example without an extension) are also unpacked directly
+* an index of the unpack scans per marker (see fsmagic)
+
+The dispatch plan is created in the main process and inherited by the scan
+processes.
+'''
+
+import importlib
+import reportrecord, fsmagic
+
+## Import a method from a module. Returns None if the method cannot be
+## imported, so the scan can be skipped.
+def resolvemethod(module, method):
+	try:
+		return getattr(importlib.import_module(module), method)
+	except Exception, e:
+		return None
+
+## split a value from the configuration into a list
+def splitvalue(value):
+	if value == None:
+		return []
+	return value.split(':')
+
+class CompiledScan(object):
+	def __init__(self, index, scan):
+		self.index = index
+		self.scan = scan
+		self.name = scan['name']
+		self.module = scan['module']
+		self.method = scan['method']
+		self.function = resolvemethod(self.module, self.method)
+		self.knownfunction = None
+		if 'knownfilemethod' in scan:
+			self.knownfunction = resolvemethod(self.module, scan['knownfilemethod'])
+		self.scanonly = scan['scanonly'] != None
+		(self.scanonlymask, self.noscanmask) = reportrecord.scanmasks(scan)
+		self.magic = None
+		if scan['magic'] != None:
+			self.magic = frozenset(splitvalue(scan['magic']))
+		self.markers = frozenset(splitvalue(scan['magic']) + splitvalue(scan['optmagic']))
+		self.extensionsignore = None
+		if 'extensionsignore' in scan:
+			self.extensionsignore = tuple(splitvalue(scan['extensionsignore']))
+		self.minimumsize = scan.get('minimumsize', 0)
+		self.priority = scan['priority']
+
+	## check if the scan should be run for a file with tags (as a bit mask)
+	def wantstags(self, tagsmask):
+		if self.scanonly and tagsmask & self.scanonlymask == 0:
+			return False
+		return tagsmask & self.noscanmask == 0
+
+	## check if the file should be ignored based on its extension
+	def ignoresfile(self, filetoscan):
+		if self.extensionsignore == None:
+			return False
+		return filetoscan.endswith(self.extensionsignore)
+
+class DispatchPlan(object):
+	def __init__(self, prerunscans, unpackscans, leafscans):
+		self.prerunscans = map(lambda x: CompiledScan(x[0], x[1]), enumerate(prerunscans))
+		self.unpackscans = map(lambda x: CompiledScan(x[0], x[1]), enumerate(unpackscans))
+		self.leafscans = map(lambda x: CompiledScan(x[0], x[1]), enumerate(leafscans))
+
+		## prerun scans are only run if one of the markers of any of the
+		## prerun scans with the same name was found
+		prerunmarkers = {}
+		for prerunscan in self.prerunscans:
+			prerunmarkers[prerunscan.name] = prerunmarkers.get(prerunscan.name, frozenset()).union(prerunscan.markers)
+		for prerunscan in self.prerunscans:
+			prerunscan.markers = prerunmarkers[prerunscan.name]
+
+		## unpack scans with a method for files with a known extension,
+		## in the order of the configuration
+		self.knownextensions = {}
+		for unpackscan in self.unpackscans:
+			if unpackscan.knownfunction == None:
+				continue
+			for extension in unpackscan.scan['extensions']:
+				if not extension in self.knownextensions:
+					self.knownextensions[extension] = []
+				if not unpackscan in self.knownextensions[extension]:
+					self.knownextensions[extension].append(unpackscan)
+
+		## unpack scans with a method for known files, per marker (at the
+		## offset where it should be found) in 'magic', so files can be
+		## looked up using the first bytes of the file
+		self.knownmarkers = {}
+		knownmarkerfields = set()
+		for unpackscan in self.unpackscans:
+			if unpackscan.knownfunction == None or unpackscan.magic == None:
+				continue
+			for marker in unpackscan.magic:
+				if not marker in fsmagic.fsmagic:
+					continue
+				markeroffset = fsmagic.correction.get(marker, 0)
+				markerbytes = fsmagic.fsmagic[marker]
+				knownmarkerfields.add((markeroffset, len(markerbytes)))
+				if not (markeroffset, markerbytes) in self.knownmarkers:
+					self.knownmarkers[(markeroffset, markerbytes)] = []
+				if not unpackscan in self.knownmarkers[(markeroffset, markerbytes)]:
+					self.knownmarkers[(markeroffset, markerbytes)].append(unpackscan)
+		self.knownmarkerfields = sorted(knownmarkerfields)
+
+		## the amount of bytes at the start of a file that are
+		## needed to look up the known file scans by marker
+		self.knownheadersize = 0
+		for (markeroffset, markerlength) in self.knownmarkerfields:
+			self.knownheadersize = max(self.knownheadersize, markeroffset + markerlength)
+
+		## unpack scans per marker in 'magic'
+		self.markerindex = {}
+		for unpackscan in self.unpackscans:
+			if unpackscan.magic == None:
+				continue
+			for marker in unpackscan.magic:
+				if not marker in self.markerindex:
+					self.markerindex[marker] = set()
+				self.markerindex[marker].add(unpackscan.index)
+
+	## The unpack scans with a known file method for a file, first the scans
+	## for the extension of the file name, then the scans for the markers
+	## at the start of the file (if the first bytes of the file are given).
+	def knownfilescans(self, filename, header=None):
+		knownscans = []
+		fileextensions = filename.lower().rsplit('.', 1)
+		if len(fileextensions) == 2:
+			knownscans += self.knownextensions.get(fileextensions[1], [])
+		if header == None:
+			return knownscans
+		for (markeroffset, markerlength) in self.knownmarkerfields:
+			markerbytes = header[markeroffset:markeroffset+markerlength]
+			for unpackscan in self.knownmarkers.get((markeroffset, markerbytes), []):
+				if not unpackscan in knownscans:
+					knownscans.append(unpackscan)
+		return knownscans
+
+	## the indexes of the unpack scans for which any of the markers was found
+	def markerscans(self, markers):
+		indexes = set()
+		for marker in markers:
+			if marker in self.markerindex:
+				indexes.update(self.markerindex[marker])
+		return indexes
@@ -2,15 +2,28 @@
 ## Copyright 2009-2016 Armijn Hemel for Tjaldur Software Governance Solutions
 ## Licensed under Apache 2.0, see LICENSE file for details
 
-import sys, os, subprocess, tempfile
+import sys, os, subprocess, tempfile, struct, stat, shutil
 
 '''
-Module to 'unpack' an ext2 file system. We are taking a shortcut. We're using
-e2cp to copy files, but we're recreating the directories in the file system
-ourselves. We can get this information from the output of el2s.
+Module to 'unpack' an ext2/ext3/ext4 file system.
 
-The second column displays the Ext2/linux mode flags which can be found in
-<ext2fs/ext2fs.h> from e2fsprogs.
+unpackext2fs() reads the file system itself: it parses the superblock, the
+group descriptors, the inodes (with block maps or extents) and the directories
+and writes the whole tree in one pass. Files are written in the order of their
+first data block, with consecutive data blocks read in big chunks, so the file
+system is mostly read sequentially. Symbolic links and permissions are kept,
+except setuid, setgid and sticky bits, as the file system cannot be trusted
+(for example when BAT runs as root). Device files, FIFOs and sockets are
+skipped.
+
+File systems that use features that are not supported (for example inline
+data, encryption or meta block groups) are not unpacked by unpackext2fs(). For
+these copyext2fs() can be used as a fallback. It uses e2cp to copy files, but
+recreates the directories in the file system itself. It gets this information
+from the output of e2ls.
+
+The second column in the output of e2ls displays the Ext2/linux mode flags
+which can be found in <ext2fs/ext2fs.h> from e2fsprogs.
 
 We are mostly interested in regular files and directories:
 
@@ -18,6 +31,307 @@ We are mostly interested in regular files and directories:
 #define LINUX_S_IFDIR  0040000
 '''
 
+## http://www.nongnu.org/ext2-doc/ext2.html
+## https://ext4.wiki.kernel.org/index.php/Ext4_Disk_Layout
+
+## incompatible features that unpackext2fs() can deal with: filetype,
+## needs_recovery, extents, 64bit, mmp, flex_bg, ea_inode, csum_seed and
+## large_dir. Any other incompatible feature (compression, journal_dev,
+## meta_bg, dirdata, inline_data, encrypt) means that the file system
+## cannot be read.
+supportedincompat = 0x0002 | 0x0004 | 0x0040 | 0x0080 | 0x0100 | 0x0200 | 0x0400 | 0x2000 | 0x4000
+
+## inode flags
+EXT4_EXTENTS_FL = 0x80000
+EXT4_INLINE_DATA_FL = 0x10000000
+EXT4_ENCRYPT_FL = 0x800
+
+## the root directory is always inode 2
+EXT2_ROOT_INO = 2
+
+## maximum amount of bytes read at once when copying data
+ext2chunksize = 1048576
+
+## error raised for corrupted or unsupported file systems
+class Ext2Error(Exception):
+	pass
+
+class Ext2FileSystem(object):
+	def __init__(self, fsfile):
+		self.fsfile = fsfile
+		superblock = self.read(1024, 1024)
+		if len(superblock) != 1024 or superblock[0x38:0x3a] != '\x53\xef':
+			raise Ext2Error("no valid superblock")
+		self.blocksize = 1024 << struct.unpack('<I', superblock[0x18:0x1c])[0]
+		if self.blocksize > 65536:
+			raise Ext2Error("invalid block size")
+		self.blockcount = struct.unpack('<I', superblock[0x04:0x08])[0]
+		self.firstdatablock = struct.unpack('<I', superblock[0x14:0x18])[0]
+		self.blockspergroup = struct.unpack('<I', superblock[0x20:0x24])[0]
+		self.inodespergroup = struct.unpack('<I', superblock[0x28:0x2c])[0]
+		self.inodecount = struct.unpack('<I', superblock[0x00:0x04])[0]
+		revision = struct.unpack('<I', superblock[0x4c:0x50])[0]
+		self.inodesize = 128
+		self.featureincompat = 0
+		if revision != 0:
+			self.inodesize = struct.unpack('<H', superblock[0x58:0x5a])[0]
+			self.featureincompat = struct.unpack('<I', superblock[0x60:0x64])[0]
+		if self.featureincompat & ~supportedincompat != 0:
+			raise Ext2Error("unsupported features")
+		self.filetype = self.featureincompat & 0x0002 != 0
+		self.descsize = 32
+		if self.featureincompat & 0x0080 != 0:
+			self.blockcount |= struct.unpack('<I', superblock[0x150:0x154])[0] << 32
+			self.descsize = struct.unpack('<H', superblock[0xfe:0x100])[0]
+			if self.descsize < 32:
+				raise Ext2Error("invalid group descriptor size")
+		if self.blockspergroup == 0 or self.inodespergroup == 0 or self.inodesize < 128 or self.blockcount == 0:
+			raise Ext2Error("invalid superblock")
+
+		## the group descriptors are in the block after the superblock
+		groupcount = (self.blockcount - self.firstdatablock + self.blockspergroup - 1) / self.blockspergroup
+		groupdescriptors = self.read((self.firstdatablock + 1) * self.blocksize, groupcount * self.descsize)
+		if len(groupdescriptors) != groupcount * self.descsize:
+			raise Ext2Error("group descriptors truncated")
+		self.inodetables = []
+		for i in xrange(0, groupcount):
+			groupdescriptor = groupdescriptors[i*self.descsize:(i+1)*self.descsize]
+			inodetable = struct.unpack('<I', groupdescriptor[0x08:0x0c])[0]
+			if self.descsize >= 64:
+				inodetable |= struct.unpack('<I', groupdescriptor[0x28:0x2c])[0] << 32
+			self.inodetables.append(inodetable)
+
+		## blocks of the inode tables that were read
+		self.inodetablecache = {}
+
+	def read(self, offset, size):
+		self.fsfile.seek(offset)
+		return self.fsfile.read(size)
+
+	## read a range of blocks, after checking that they are in the file system
+	def readblocks(self, block, blockcount):
+		if block == 0 or block + blockcount > self.blockcount:
+			raise Ext2Error("block outside of file system")
+		data = self.read(block * self.blocksize, blockcount * self.blocksize)
+		if len(data) != blockcount * self.blocksize:
+			raise Ext2Error("file system truncated")
+		return data
+
+	## read an inode, using the blocks of the inode tables that were read before
+	def readinode(self, inode):
+		if inode < 1 or inode > self.inodecount:
+			raise Ext2Error("invalid inode")
+		(group, index) = divmod(inode - 1, self.inodespergroup)
+		if group >= len(self.inodetables):
+			raise Ext2Error("invalid inode")
+		(tableblock, blockoffset) = divmod(index * self.inodesize, self.blocksize)
+		tableblock += self.inodetables[group]
+		if not tableblock in self.inodetablecache:
+			self.inodetablecache[tableblock] = self.readblocks(tableblock, 1)
+		return self.inodetablecache[tableblock][blockoffset:blockoffset + self.inodesize]
+
+	## The data of an inode as a list of runs of blocks:
+	## (logical block, physical block, amount of blocks). Holes and
+	## uninitialized extents are not in the list.
+	def blockruns(self, inodedata):
+		flags = struct.unpack('<I', inodedata[0x20:0x24])[0]
+		if flags & (EXT4_INLINE_DATA_FL | EXT4_ENCRYPT_FL) != 0:
+			raise Ext2Error("unsupported inode")
+		blockdata = inodedata[0x28:0x64]
+		runs = []
+		if flags & EXT4_EXTENTS_FL != 0:
+			self.extentruns(blockdata, runs, 0)
+		else:
+			blocks = struct.unpack('<15I', blockdata)
+			## 12 direct blocks, then a single, double and triple indirect block
+			for i in xrange(0, 12):
+				self.addrun(runs, i, blocks[i])
+			logicalblock = 12
+			for depth in xrange(0, 3):
+				logicalblock = self.indirectruns(blocks[12 + depth], depth, logicalblock, runs)
+		return runs
+
+	def addrun(self, runs, logicalblock, block, blockcount=1):
+		if block == 0:
+			return
+		if block + blockcount > self.blockcount:
+			raise Ext2Error("block outside of file system")
+		if runs != []:
+			(lastlogical, lastblock, lastcount) = runs[-1]
+			if lastlogical + lastcount == logicalblock and lastblock + lastcount == block:
+				runs[-1] = (lastlogical, lastblock, lastcount + blockcount)
+				return
+		runs.append((logicalblock, block, blockcount))
+
+	def indirectruns(self, block, depth, logicalblock, runs):
+		blocksperindirect = (self.blocksize / 4) ** (depth + 1)
+		if block == 0:
+			return logicalblock + blocksperindirect
+		blocks = struct.unpack('<%dI' % (self.blocksize / 4), self.readblocks(block, 1))
+		for i in blocks:
+			if depth == 0:
+				self.addrun(runs, logicalblock, i)
+				logicalblock += 1
+			else:
+				logicalblock = self.indirectruns(i, depth - 1, logicalblock, runs)
+		return logicalblock
+
+	def extentruns(self, extentdata, runs, level):
+		if level > 5:
+			raise Ext2Error("extent tree too deep")
+		if len(extentdata) < 12 or extentdata[0:2] != '\x0a\xf3':
+			raise Ext2Error("invalid extent header")
+		(entries, maxentries, depth) = struct.unpack('<HHH', extentdata[2:8])
+		if 12 + entries * 12 > len(extentdata):
+			raise Ext2Error("invalid extent header")
+		for i in xrange(0, entries):
+			entry = extentdata[12 + i*12:24 + i*12]
+			if depth == 0:
+				(logicalblock, blockcount, blockhi, blocklo) = struct.unpack('<IHHI', entry)
+				## uninitialized extents read as zeroes
+				if blockcount > 32768:
+					continue
+				self.addrun(runs, logicalblock, blocklo | (blockhi << 32), blockcount)
+			else:
+				(logicalblock, blocklo, blockhi) = struct.unpack('<IIH', entry[:10])
+				self.extentruns(self.readblocks(blocklo | (blockhi << 32), 1), runs, level + 1)
+
+	## read all data of an inode, for directories and symbolic links
+	def readdata(self, inodedata, size):
+		data = ''
+		for (logicalblock, block, blockcount) in self.blockruns(inodedata):
+			if logicalblock * self.blocksize >= size:
+				break
+			data = data.ljust(logicalblock * self.blocksize, '\x00')
+			data += self.readblocks(block, blockcount)
+		return data[:size].ljust(size, '\x00')
+
+	## the entries (name, inode) in a directory, without '.' and '..'
+	def readdirectory(self, inodedata, size):
+		data = self.readdata(inodedata, size)
+		entries = []
+		offset = 0
+		while offset + 8 <= len(data):
+			(inode, recordlength) = struct.unpack('<IH', data[offset:offset+6])
+			if self.filetype:
+				namelength = ord(data[offset+6])
+			else:
+				namelength = struct.unpack('<H', data[offset+6:offset+8])[0]
+			if recordlength < 8 or offset + recordlength > len(data) or 8 + namelength > recordlength:
+				raise Ext2Error("invalid directory entry")
+			name = data[offset+8:offset+8+namelength]
+			offset += recordlength
+			if inode == 0 or name == '.' or name == '..' or name == '':
+				continue
+			if '/' in name or '\x00' in name:
+				continue
+			entries.append((name, inode))
+		return entries
+
+	## Write the tree in the file system to a directory. First all directories
+	## and symbolic links are created, then the regular files are written in
+	## the order of their first data block.
+	def extract(self, targetdir):
+		regularfiles = []
+		directories = []
+		seendirectories = set([EXT2_ROOT_INO])
+		## regular files are only written after all directories were
+		## read, so the names are recorded to detect duplicates
+		filepaths = set()
+		scandirs = [(EXT2_ROOT_INO, targetdir)]
+		while len(scandirs) != 0:
+			newscandirs = []
+			for (dirinode, dirpath) in scandirs:
+				dirinodedata = self.readinode(dirinode)
+				for (name, inode) in self.readdirectory(dirinodedata, inodesize(dirinodedata)):
+					inodedata = self.readinode(inode)
+					mode = struct.unpack('<H', inodedata[0:2])[0]
+					size = inodesize(inodedata)
+					filepath = os.path.join(dirpath, name)
+					## a name can only be in a directory once in a valid
+					## file system. Duplicate names are ignored, so for
+					## example a file cannot be written to the target of
+					## a symbolic link with the same name.
+					if filepath in filepaths or os.path.lexists(filepath):
+						continue
+					if stat.S_ISDIR(mode):
+						## a directory can only be in the tree once
+						if inode in seendirectories:
+							continue
+						seendirectories.add(inode)
+						os.mkdir(filepath)
+						directories.append((filepath, mode))
+						newscandirs.append((inode, filepath))
+					elif stat.S_ISLNK(mode):
+						## fast symbolic links are stored in the inode itself
+						flags = struct.unpack('<I', inodedata[0x20:0x24])[0]
+						if size < 60 and flags & EXT4_EXTENTS_FL == 0:
+							linktarget = inodedata[0x28:0x28+size]
+						else:
+							linktarget = self.readdata(inodedata, size)
+						os.symlink(linktarget, filepath)
+					elif stat.S_ISREG(mode):
+						runs = self.blockruns(inodedata)
+						firstblock = 0
+						if runs != []:
+							firstblock = runs[0][1]
+						regularfiles.append((firstblock, filepath, mode, size, runs))
+						filepaths.add(filepath)
+			scandirs = newscandirs
+
+		regularfiles.sort()
+		for (firstblock, filepath, mode, size, runs) in regularfiles:
+			## never follow symbolic links when creating files
+			outfile = os.fdopen(os.open(filepath, os.O_WRONLY|os.O_CREAT|os.O_EXCL|os.O_NOFOLLOW, 0600), 'wb')
+			for (logicalblock, block, blockcount) in runs:
+				fileoffset = logicalblock * self.blocksize
+				if fileoffset >= size:
+					break
+				outfile.seek(fileoffset)
+				## read big runs in chunks
+				chunkblocks = max(1, ext2chunksize / self.blocksize)
+				for i in xrange(0, blockcount, chunkblocks):
+					data = self.readblocks(block + i, min(chunkblocks, blockcount - i))
+					if fileoffset + len(data) > size:
+						data = data[:size - fileoffset]
+					outfile.write(data)
+					fileoffset += len(data)
+					if fileoffset >= size:
+						break
+			## holes at the end of the file
+			outfile.truncate(size)
+			## setuid, setgid and sticky bits are not kept
+			os.fchmod(outfile.fileno(), (mode & 0777) | stat.S_IRUSR | stat.S_IWUSR)
+			outfile.close()
+		for (filepath, mode) in directories:
+			os.chmod(filepath, (mode & 0777) | stat.S_IRWXU)
+
+## the size of a file, directory or symbolic link
+def inodesize(inodedata):
+	return struct.unpack('<I', inodedata[0x04:0x08])[0] | (struct.unpack('<I', inodedata[0x6c:0x70])[0] << 32)
+
+## Unpack an ext2/ext3/ext4 file system from a file (or a file-like object,
+## such as a view of a bigger file) to a directory. Returns the size of the
+## file system, or None if the file system is corrupted or uses features that
+## are not supported, in which case anything that was written to the target
+## directory is removed again.
+def unpackext2fs(fsfile, targetdir):
+	existingfiles = set(os.listdir(targetdir))
+	try:
+		ext2fs = Ext2FileSystem(fsfile)
+		ext2fs.extract(targetdir)
+	except Exception, e:
+		for i in os.listdir(targetdir):
+			if i in existingfiles:
+				continue
+			filepath = os.path.join(targetdir, i)
+			if os.path.isdir(filepath) and not os.path.islink(filepath):
+				shutil.rmtree(filepath)
+			else:
+				os.unlink(filepath)
+		return None
+	return ext2fs.blockcount * ext2fs.blocksize
+
 def copyext2fs(source, target=None):
 	if target == None:
 		targetdir = tempfile.mkdtemp()
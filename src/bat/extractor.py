@@ -8,7 +8,7 @@
 This file contains a few convenience functions that are used throughout the code.
 '''
 
-import string, re, subprocess, sys
+import string, re, subprocess, sys, bisect
 from xml.dom import minidom
 
 def isPrintables(lines):
@@ -28,18 +28,154 @@ def check_nonprintable(lines, offset, word):
                         return True
         return False
 
+## Blacklists are composed of tuples (lower, upper) or (lower, upper, scanname)
+## which mark a region in the parent file(!) as a no go area. The tuples are
+## stored in a list (so existing code can simply append tuples and iterate over
+## the blacklist), but next to the list a sorted index of the lower bounds and
+## of the merged regions is kept, so lookups can be done with a binary search
+## instead of walking the whole blacklist. The index is (re)built lazily after
+## the blacklist was changed.
+class Blacklist(list):
+	def __init__(self, blacklist=[]):
+		list.__init__(self, blacklist)
+		self.invalidate()
+
+	def invalidate(self):
+		self.lowers = None
+		self.merged = None
+		self.mergedlowers = None
+
+	def buildindex(self):
+		ranges = sorted(map(lambda x: (x[0], x[1]), self))
+		self.lowers = map(lambda x: x[0], ranges)
+		## merge regions that overlap or are adjacent. Empty regions
+		## (lower == upper) do not cover any bytes.
+		merged = []
+		for (lower, upper) in ranges:
+			if upper <= lower:
+				continue
+			if merged != [] and lower <= merged[-1][1]:
+				if upper > merged[-1][1]:
+					merged[-1] = (merged[-1][0], upper)
+			else:
+				merged.append((lower, upper))
+		self.merged = merged
+		self.mergedlowers = map(lambda x: x[0], merged)
+
+	## return the upper bound of the blacklisted region that offset is
+	## in, or None if offset is not blacklisted.
+	def lookup(self, offset):
+		if self.merged == None:
+			self.buildindex()
+		i = bisect.bisect_right(self.mergedlowers, offset) - 1
+		if i >= 0 and offset < self.merged[i][1]:
+			return self.merged[i][1]
+		return None
+
+	## return the lowest lower bound of any entry that is bigger than
+	## offset, or 0 if there is no such entry.
+	def nextlower(self, offset):
+		if self.lowers == None:
+			self.buildindex()
+		i = bisect.bisect_right(self.lowers, offset)
+		if i == len(self.lowers):
+			return 0
+		return self.lowers[i]
+
+	## return the first offset at or after offset that is not blacklisted
+	def nextgap(self, offset):
+		upper = self.lookup(offset)
+		if upper == None:
+			return offset
+		return upper
+
+	## check if all bytes in the range [lower, upper) are blacklisted
+	def covers(self, lower, upper):
+		if upper <= lower:
+			return True
+		upperbound = self.lookup(lower)
+		if upperbound == None:
+			return False
+		return upperbound >= upper
+
+	## return a list of (lower, upper) tuples of all the ranges in
+	## [lower, upper) that are not blacklisted
+	def gaps(self, lower, upper):
+		if self.merged == None:
+			self.buildindex()
+		res = []
+		offset = lower
+		i = max(0, bisect.bisect_right(self.mergedlowers, lower) - 1)
+		for (blacklower, blackupper) in self.merged[i:]:
+			if blacklower >= upper:
+				break
+			if blackupper <= offset:
+				continue
+			if blacklower > offset:
+				res.append((offset, blacklower))
+			offset = blackupper
+		if offset < upper:
+			res.append((offset, upper))
+		return res
+
+	## all methods that change the list invalidate the index
+	def append(self, item):
+		list.append(self, item)
+		self.invalidate()
+
+	def extend(self, items):
+		list.extend(self, items)
+		self.invalidate()
+
+	def insert(self, index, item):
+		list.insert(self, index, item)
+		self.invalidate()
+
+	def remove(self, item):
+		list.remove(self, item)
+		self.invalidate()
+
+	def pop(self, *args):
+		item = list.pop(self, *args)
+		self.invalidate()
+		return item
+
+	def __setitem__(self, index, item):
+		list.__setitem__(self, index, item)
+		self.invalidate()
+
+	def __delitem__(self, index):
+		list.__delitem__(self, index)
+		self.invalidate()
+
+	def __setslice__(self, i, j, items):
+		list.__setslice__(self, i, j, items)
+		self.invalidate()
+
+	def __delslice__(self, i, j):
+		list.__delslice__(self, i, j)
+		self.invalidate()
+
+	def __iadd__(self, items):
+		list.extend(self, items)
+		self.invalidate()
+		return self
+
 ## convenience method to check if the offset we find is in a blacklist
-## Blacklists are composed of tuples (lower, upper) which mark a region
-## in the parent file(!) as a no go area.
 ## This method returns the upperbound from the tuple for which
-## lower <= offset < upper is True
+## lower <= offset < upper is True. For a Blacklist the upper bound
+## of the merged region is returned.
 def inblacklist(offset, blacklist):
+	if isinstance(blacklist, Blacklist):
+		return blacklist.lookup(offset)
 	for bl in blacklist:
 		if offset >= bl[0] and offset < bl[1]:
 			return bl[1]
 
 ## convenience method to find the next lowest entry in the blacklist
 def lowestnextblacklist(offset, blacklist):
+	if isinstance(blacklist, Blacklist):
+		return blacklist.nextlower(offset)
 	lowest = sys.maxint
 	for bl in blacklist:
 		if bl[0] > offset:
@@ -49,6 +185,14 @@ def lowestnextblacklist(offset, blacklist):
 		return 0
 	return lowest
 
+## convenience method to get the ranges in [lower, upper) that are not
+## in the blacklist, for example to carve the parts of a file that were
+## not unpacked.
+def blacklistgaps(lower, upper, blacklist):
+	if not isinstance(blacklist, Blacklist):
+		blacklist = Blacklist(blacklist)
+	return blacklist.gaps(lower, upper)
+
 ###
 ## The helper method below is to specifically analyse Microsoft Windows binaries
 ## and extract the XML that can usually be found in those installers. Based on
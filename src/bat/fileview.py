@@ -0,0 +1,84 @@
+#!/usr/bin/python
+
+## Binary Analysis Tool
+## Licensed under Apache 2.0, see LICENSE file for details
+
+'''
+This module contains a read only, seekable file-like object that represents a
+window (offset, length) of a bigger file. It can be passed to modules that
+accept file objects (zipfile, tarfile, etc.) so data that is embedded in a
+bigger file can be verified and unpacked without first carving it to a
+temporary file.
+
+Offsets used with the view are relative to the start of the window, and
+reading stops at the end of the window.
+'''
+
+import os
+
+class FileView(object):
+	def __init__(self, filename, offset, length=0):
+		self.filename = filename
+		self.fileobj = open(filename, 'rb')
+		filesize = os.fstat(self.fileobj.fileno()).st_size
+		self.offset = min(offset, filesize)
+		## if no length is given, or the length is larger than the data
+		## that is available, use everything until the end of the file
+		if length <= 0 or self.offset + length > filesize:
+			length = filesize - self.offset
+		self.size = length
+		self.position = 0
+		self.closed = False
+
+	def read(self, size=-1):
+		if self.position >= self.size:
+			return ''
+		if size < 0 or self.position + size > self.size:
+			size = self.size - self.position
+		self.fileobj.seek(self.offset + self.position)
+		data = self.fileobj.read(size)
+		self.position += len(data)
+		return data
+
+	## read data at a position in the window, without changing
+	## the current position
+	def pread(self, position, size):
+		if position < 0 or position >= self.size:
+			return ''
+		size = min(size, self.size - position)
+		self.fileobj.seek(self.offset + position)
+		return self.fileobj.read(size)
+
+	def readline(self, size=-1):
+		if self.position >= self.size:
+			return ''
+		if size < 0 or self.position + size > self.size:
+			size = self.size - self.position
+		self.fileobj.seek(self.offset + self.position)
+		data = self.fileobj.readline(size)
+		self.position += len(data)
+		return data
+
+	def seek(self, position, whence=os.SEEK_SET):
+		if whence == os.SEEK_CUR:
+			position += self.position
+		elif whence == os.SEEK_END:
+			position += self.size
+		if position < 0:
+			raise IOError("negative seek in file view")
+		self.position = position
+
+	def tell(self):
+		return self.position
+
+	def close(self):
+		if not self.closed:
+			self.fileobj.close()
+			self.closed = True
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
+		return False
@@ -15,12 +15,28 @@ Optionally return a range of bytes that should be excluded in same cases
 to prevent other scans from (re)scanning (part of) the data.
 '''
 
-import sys, os, subprocess, os.path, shutil, stat, array, struct, binascii, json, math
+import sys, os, subprocess, os.path, shutil, stat, array, struct, binascii, json, math, mmap
 import tempfile, bz2, re, magic, tarfile, zlib, copy, uu, hashlib, StringIO, zipfile
-import fsmagic, extractor, ext2, jffs2, prerun, javacheck, elfcheck
+import fsmagic, extractor, ext2, jffs2, prerun, javacheck, elfcheck, carve, fileview
+import multiprocessing
 from collections import deque
 import xml.dom
 
+## Try to load a Python LZMA module (standard in Python 3, backports.lzma for
+## Python 2) to decompress LZMA in process. If it is not available the lzma
+## program is used instead.
+try:
+	try:
+		import lzma
+	except ImportError:
+		from backports import lzma
+	## the older pyliblzma module is also called 'lzma', but has
+	## a different interface
+	lzma.FORMAT_ALONE
+	haslzma = True
+except Exception, e:
+	haslzma = False
+
 ## generic method to create temporary directories, with the correct filenames
 ## which is used throughout the code.
 def dirsetup(tempdir, filename, marker, counter):
@@ -42,6 +58,18 @@ def unpacksetup(tempdir):
 		tmpdir = tempdir
 	return tmpdir
 
+## The amount of processes in a pool for unpacking a file in parallel. Unpack
+## scans run in all scan processes at the same time, so BAT sets
+## UNPACK_POOLSIZE to the amount of processes for unpacking ('unpackprocessors'
+## in the configuration) divided by the amount of scan processes. If it is not
+## set (for example if the method is not called from BAT) all processors
+## are used.
+def unpackpoolsize(scanenv):
+	try:
+		return max(1, int(scanenv['UNPACK_POOLSIZE']))
+	except Exception, e:
+		return multiprocessing.cpu_count()
+
 ## Carve a file from a larger file, or simply copy or hardlink the file.
 def unpackFile(filename, offset, tmpfile, tmpdir, length=0, modify=False, unpacktempdir=None, blacklist=[]):
 	if blacklist != []:
@@ -57,10 +85,6 @@ def unpackFile(filename, offset, tmpfile, tmpdir, length=0, modify=False, unpack
 	if filesize == length:
 		length = 0
 
-	## don't use dd for stuff that is less than 50 million bytes
-	## TODO: make configurable
-	unpackcutoff = 50000000
-
 	## If the whole file needs to be scanned, then either copy it, or hardlink it.
 	## Hardlinking is only possible if the file resides on the same file system
 	## and if the file is not modified in a way.
@@ -83,88 +107,10 @@ def unpackFile(filename, offset, tmpfile, tmpdir, length=0, modify=False, unpack
 			shutil.copy(filename, templink[1])
 		shutil.move(templink[1], tmpfile)
 	else:
-		if length == 0:
-			if unpackcutoff < filesize and (filesize - offset) < unpackcutoff:
-				srcfile = open(filename, 'rb')
-				dstfile = open(tmpfile, 'wb')
-				srcfile.seek(offset)
-				dstfile.write(srcfile.read(length))
-				dstfile.flush()
-				dstfile.close()
-				srcfile.close()
-				return
-			## The tail end of the file is needed and the first bytes (indicated by 'offset') need
-			## to be ignored, while the rest needs to be copied. If the offset is small, it is
-			## faster to use 'tail' instead of 'dd', especially for big files.
-			if offset < 128:
-				tmptmpfile = open(tmpfile, 'wb')
-				p = subprocess.Popen(['tail', filename, '-c', "%d" % (filesize - offset)], stdout=tmptmpfile, stderr=subprocess.PIPE, close_fds=True)
-				(stanout, stanerr) = p.communicate()
-				tmptmpfile.close()
-			else:
-				p = subprocess.Popen(['dd', 'if=%s' % (filename,), 'of=%s' % (tmpfile,), 'bs=%s' % (offset,), 'skip=1'], stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True)
-				(stanout, stanerr) = p.communicate()
-				os.chmod(tmpfile, stat.S_IRWXU)
-		else:
-			if unpackcutoff < filesize and length < unpackcutoff:
-				srcfile = open(filename, 'rb')
-				dstfile = open(tmpfile, 'wb')
-				srcfile.seek(offset)
-				dstfile.write(srcfile.read(length))
-				dstfile.flush()
-				dstfile.close()
-				srcfile.close()
-				return
-			if offset == 0:
-				## sometimes there are some issues with dd and maximum file size
-				## see for example https://bugzilla.redhat.com/show_bug.cgi?id=612839
-				if (length+offset) >= 2147479552:
-					shutil.copy(filename, tmpfile)
-					truncfile = open(tmpfile, 'a+b')
-					truncfile.seek(length+offset)
-					truncfile.truncate()
-					truncfile.close()
-				else:
-					## bytes need be removed only from the end of the file
-					p = subprocess.Popen(['dd', 'if=%s' % (filename,), 'of=%s' % (tmpfile,), 'bs=%s' % (length,), 'count=1'], stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True)
-					(stanout, stanerr) = p.communicate()
-					os.chmod(tmpfile, stat.S_IRWXU)
-			else:
-				## bytes need to be removed on both sides of the file, so possibly
-				## use a two way pass
-				## First determine which side to cut first before cutting
-				if offset > (filesize - length):
-					p = subprocess.Popen(['dd', 'if=%s' % (filename,), 'of=%s' % (tmpfile,), 'bs=%s' % (offset,), 'skip=1'], stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True)
-					(stanout, stanerr) = p.communicate()
-					os.chmod(tmpfile, stat.S_IRWXU)
-					tmptmpfile = open(tmpfile, 'a+b')
-					tmptmpfile.seek(length)
-					tmptmpfile.truncate()
-					tmptmpfile.close()
-				else:
-					tmptmpfile = tempfile.mkstemp(dir=tmpdir)
-					os.fdopen(tmptmpfile[0]).close()
-
-					## sometimes there are some issues with dd and maximum file size
-					## see for example https://bugzilla.redhat.com/show_bug.cgi?id=612839
-					if (length+offset) >= 2147479552:
-						shutil.copy(filename, tmptmpfile[1])
-						os.chmod(tmptmpfile[1], stat.S_IRWXU)
-						truncfile = open(tmptmpfile[1], 'a+b')
-						truncfile.seek(length+offset)
-						truncfile.truncate()
-						truncfile.close()
-					else:
-						## first copy bytes from the front of the file up to a certain length
-						p = subprocess.Popen(['dd', 'if=%s' % (filename,), 'of=%s' % (tmptmpfile[1],), 'bs=%s' % (length+offset,), 'count=1'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-						(stanout, stanerr) = p.communicate()
-						os.chmod(tmptmpfile[1], stat.S_IRWXU)
-
-					## then copy bytes from the temporary file, but skip 'offset' bytes at the front
-					p = subprocess.Popen(['dd', 'if=%s' % (tmptmpfile[1],), 'of=%s' % (tmpfile,), 'bs=%s' % (offset,), 'skip=1'], stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True)
-					(stanout, stanerr) = p.communicate()
-					os.chmod(tmpfile, stat.S_IRWXU)
-					os.unlink(tmptmpfile[1])
+		## carve the bytes in process, without reading the data into
+		## memory and without launching dd or tail (see carve.py)
+		carve.carveFile(filename, offset, tmpfile, length)
+		os.chmod(tmpfile, stat.S_IRWXU)
 
 ## There are certain routers that have all bytes swapped, because they use 16
 ## bytes NOR flash instead of 8 bytes SPI flash. This is an ugly hack to first
@@ -1753,8 +1699,6 @@ def searchUnpackTar(filename, tempdir=None, blacklist=[], offsets={}, scanenv={}
 		return ([], blacklist, [], hints)
 	taroffsets.sort()
 
-	tar_tmpdir = scanenv.get('UNPACK_TEMPDIR', None)
-
 	diroffsets = []
 	counter = 1
 	for offset in taroffsets:
@@ -1767,7 +1711,7 @@ def searchUnpackTar(filename, tempdir=None, blacklist=[], offsets={}, scanenv={}
 			continue
 
 		tmpdir = dirsetup(tempdir, filename, "tar", counter)
-		(res, tarsize) = unpackTar(filename, offset, tmpdir, tar_tmpdir)
+		(res, tarsize) = unpackTar(filename, offset, tmpdir)
 		if res != None:
 			diroffsets.append((res, offset - 0x101, tarsize))
 			counter = counter + 1
@@ -1777,64 +1721,20 @@ def searchUnpackTar(filename, tempdir=None, blacklist=[], offsets={}, scanenv={}
 			shutil.rmtree(tmpdir)
 	return (diroffsets, blacklist, [], hints)
 
-def unpackTar(filename, offset, tempdir=None, tar_tmpdir=None):
-	tmpdir = unpacksetup(tempdir)
-	if tar_tmpdir != None:
-		tmpfile = tempfile.mkstemp(dir=tar_tmpdir)
-		testtar = tempfile.mkstemp(dir=tar_tmpdir)
-		os.fdopen(testtar[0]).close()
-	else:
-		tmpfile = tempfile.mkstemp(dir=tmpdir)
-		testtar = tempfile.mkstemp(dir=tmpdir)
-		os.fdopen(testtar[0]).close()
-
-	## first read about 1MB from the tar file and do a very simple rough check to
-	## filter out false positives
-	if os.stat(filename).st_size > 1024*1024:
-		tartest = open(testtar[1], 'wb')
-		testtarfile = open(filename, 'rb')
-		testtarfile.seek(offset - 0x101)
-		testtarbuffer = testtarfile.read(1024*1024)
-		testtarfile.close()
-		tartest.write(testtarbuffer)
-		tartest.close()
-		if not tarfile.is_tarfile(tartest.name):
-			os.unlink(testtar[1])
-			## not a tar file, so clean up
-			os.fdopen(tmpfile[0]).close()
-			os.unlink(tmpfile[1])
-			if tempdir == None:
-				os.rmdir(tmpdir)
-			return (None, None)
-	os.unlink(testtar[1])
-
-	if offset != 0x101:
-		p = subprocess.Popen(['dd', 'if=%s' % (filename,), 'of=%s' % (tmpfile[1],), 'bs=%s' % (offset - 0x101,), 'skip=1'], stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True)
-		(stanout, stanerr) = p.communicate()
-	else:
-		templink = tempfile.mkstemp(dir=tmpdir)
-		os.fdopen(templink[0]).close()
-		os.unlink(templink[1])
-		try:
-			os.link(filename, templink[1])
-		except OSError, e:
-			## if filename and tmpdir are on different devices it is
-			## not possible to use hardlinks
-			shutil.copy(filename, templink[1])
-		shutil.move(templink[1], tmpfile[1])
-
-	tarsize = 0
-	if not tarfile.is_tarfile(tmpfile[1]):
-		## not a tar file, so clean up
-		os.fdopen(tmpfile[0]).close()
-		os.unlink(tmpfile[1])
-		if tempdir == None:
-			os.rmdir(tmpdir)
+def unpackTar(filename, offset, tempdir=None):
+	## the tar archive is read directly from the file with a view, so
+	## no data has to be carved, not even for false positives.
+	tarview = fileview.FileView(filename, offset - 0x101)
+	try:
+		tar = tarfile.open(fileobj=tarview, mode='r')
+	except Exception, e:
+		## not a tar file
+		tarview.close()
 		return (None, None)
 
+	tmpdir = unpacksetup(tempdir)
+	tarsize = 0
 	try:
-		## tmpfile[1] cannot be a closed file for some reason. Strange.
-		tar = tarfile.open(tmpfile[1], 'r')
 		tarmembers = tar.getmembers()
 		## assume that the last member is also the last in the file
 		tarsize = tarmembers[-1].offset_data + tarmembers[-1].size
@@ -1851,13 +1751,11 @@ def unpackTar(filename, offset, tempdir=None, tar_tmpdir=None):
 		tar.close()
 	except Exception, e:
 		## not a tar file, so clean up
-		os.fdopen(tmpfile[0]).close()
-		os.unlink(tmpfile[1])
+		tarview.close()
 		if tempdir == None:
 			shutil.rmtree(tmpdir)
 		return (None, None)
-	os.fdopen(tmpfile[0]).close()
-	os.unlink(tmpfile[1])
+	tarview.close()
 	return (tmpdir, tarsize)
 
 ## yaffs2 is used frequently in Android and various mediaplayers based on
@@ -2158,21 +2056,28 @@ def searchUnpackCab(filename, tempdir=None, blacklist=[], offsets={}, scanenv={}
 ## a MINIX file system. We need to use more data from the metadata and perhaps
 ## adjust for certificates.
 def unpackCab(filename, offset, tempdir=None, blacklist=[]):
-	cab = file(filename, "r")
-	cab.seek(offset)
-	cabbuffer = cab.read(12)
-	cab.close()
+	cabview = fileview.FileView(filename, offset)
+	cabbuffer = cabview.read(36)
+	cabview.close()
 
-	if len(cabbuffer) != 12:
+	if len(cabbuffer) != 36:
 		return
 
-	filesize = os.stat(filename).st_size
-
-	cabsize = struct.unpack('<I', cabbuffer[8:])[0]
-	if filesize < cabsize:
+	cabsize = struct.unpack('<I', cabbuffer[8:12])[0]
+	if cabview.size < cabsize:
 		return
 
-	if filesize < cabsize + offset:
+	## sanity checks for the CFHEADER structure, so false positives
+	## do not have to be carved first:
+	## * version should be 1.3
+	## * there should be at least one folder and one file
+	## * the first CFFILE entry should be inside the cabinet
+	(offsetfiles, versionminor, versionmajor, cabfolders, cabfiles) = struct.unpack('<I4xBBHH', cabbuffer[16:30])
+	if versionmajor != 1 or versionminor != 3:
+		return
+	if cabfolders == 0 or cabfiles == 0:
+		return
+	if offsetfiles >= cabsize:
 		return
 
 	tmpdir = unpacksetup(tempdir)
@@ -2235,11 +2140,33 @@ def unpack7z(filename, offset, tempdir=None, blacklist=[]):
 	## first unpack things, write things to a file and return
 	## the directory if the file is not empty
 	## Assumes (for now) that 7z is in the path
+
+	## first verify the signature header, so false positives do not
+	## have to be carved first. The signature header is 32 bytes:
+	## * signature (6 bytes) and version (2 bytes)
+	## * CRC32 of the next 20 bytes
+	## * offset of the next header (relative to the end of the
+	##   signature header), size of the next header and its CRC32
+	sevenzipview = fileview.FileView(filename, offset)
+	sevenzipheader = sevenzipview.read(32)
+	sevenzipview.close()
+	if len(sevenzipheader) != 32:
+		return None
+	if ord(sevenzipheader[6]) != 0:
+		return None
+	startheadercrc = struct.unpack('<I', sevenzipheader[8:12])[0]
+	if binascii.crc32(sevenzipheader[12:32]) & 0xffffffff != startheadercrc:
+		return None
+	(nextheaderoffset, nextheadersize) = struct.unpack('<QQ', sevenzipheader[12:28])
+	sevenziplength = 32 + nextheaderoffset + nextheadersize
+	if sevenziplength > sevenzipview.size:
+		return None
+
 	tmpdir = unpacksetup(tempdir)
 	tmpfile = tempfile.mkstemp(dir=tmpdir)
 	os.fdopen(tmpfile[0]).close()
 
-	unpackFile(filename, offset, tmpfile[1], tmpdir, blacklist=blacklist)
+	unpackFile(filename, offset, tmpfile[1], tmpdir, length=sevenziplength, blacklist=blacklist)
 
 	param = "-o%s" % tmpdir
 	p = subprocess.Popen(['7z', param, '-l', '-y', 'x', tmpfile[1]], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True)
@@ -2309,6 +2236,25 @@ def unpackLzip(filename, offset, tempdir=None):
 	## first unpack things, write things to a file and return
 	## the directory if the file is not empty
 	## Assumes (for now) that lzip is in the path
+
+	## first check the header, so false positives do not have to be
+	## carved first. Byte 5 is the coded dictionary size: bits 4-0
+	## contain the base 2 logarithm of the base size (12 - 29),
+	## bits 7-5 the fraction (1/16th of the base size) to subtract.
+	lzipview = fileview.FileView(filename, offset)
+	lzipheader = lzipview.read(6)
+	if len(lzipheader) != 6:
+		lzipview.close()
+		return (None, None)
+	dictionarybase = ord(lzipheader[5]) & 0x1f
+	if dictionarybase < 12 or dictionarybase > 29:
+		lzipview.close()
+		return (None, None)
+	dictionarysize = pow(2, dictionarybase) - (pow(2, dictionarybase)/16) * (ord(lzipheader[5]) >> 5)
+	if dictionarysize < 4096:
+		lzipview.close()
+		return (None, None)
+
 	tmpdir = unpacksetup(tempdir)
 	tmpfile = tempfile.mkstemp(dir=tmpdir)
 	os.fdopen(tmpfile[0]).close()
@@ -2317,13 +2263,16 @@ def unpackLzip(filename, offset, tempdir=None):
 
 	p = subprocess.Popen(['lzip', "-d", "-c", tmpfile[1]], stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True)
 	(stanout, stanerr) = p.communicate()
+	## the carved data is only needed by lzip, the rest of the checks
+	## use the view
+	os.unlink(tmpfile[1])
 	outtmpfile = tempfile.mkstemp(dir=tmpdir)
 	os.write(outtmpfile[0], stanout)
 	os.fsync(outtmpfile[0])
 	os.fdopen(outtmpfile[0]).close()
 	if os.stat(outtmpfile[1]).st_size == 0:
+		lzipview.close()
 		os.unlink(outtmpfile[1])
-		os.unlink(tmpfile[1])
 		if tempdir == None:
 			os.rmdir(tmpdir)
 		return (None, None)
@@ -2344,7 +2293,7 @@ def unpackLzip(filename, offset, tempdir=None):
 	crc32packedsize = crc32+packedsize
 
 	## search the compressed data for the crc32 and uncompressed data size
-	datafile = open(tmpfile[1], 'rb')
+	datafile = lzipview
 	datafile.seek(0)
 	## read 1 million bytes
 	lzipdataread = 1000000
@@ -2374,8 +2323,6 @@ def unpackLzip(filename, offset, tempdir=None):
 		totalread += lzipdataread
 	datafile.close()
 
-	## clean up
-	os.unlink(tmpfile[1])
 	return (tmpdir, lzipsize)
 
 ## unpack lzop archives.
@@ -2436,10 +2383,62 @@ def searchUnpackLzop(filename, tempdir=None, blacklist=[], offsets={}, scanenv={
 			os.rmdir(tmpdir)
 	return (diroffsets, blacklist, tags, hints)
 
+## Verify the header of an lzop file, read from a file object that starts at
+## the lzop magic. The header (without the magic) is protected by a checksum,
+## which is either Adler32 or CRC32, depending on the flags. See lzop.c from
+## the lzop sources.
+def verifyLzopHeader(lzopfile):
+	lzopfile.seek(9)
+	headerbytes = lzopfile.read(4)
+	if len(headerbytes) != 4:
+		return False
+	(lzopversion, lzoplibversion) = struct.unpack('>HH', headerbytes)
+	if lzopversion >= 0x0940:
+		## version needed to extract, method and level
+		headerbytes += lzopfile.read(4)
+	else:
+		## method
+		headerbytes += lzopfile.read(1)
+	## flags
+	flagbytes = lzopfile.read(4)
+	if len(flagbytes) != 4:
+		return False
+	headerbytes += flagbytes
+	lzopflags = struct.unpack('>I', flagbytes)[0]
+	if lzopflags & 0x800 != 0:
+		## filter
+		headerbytes += lzopfile.read(4)
+	## mode and mtime
+	headerbytes += lzopfile.read(8)
+	if lzopversion >= 0x0940:
+		headerbytes += lzopfile.read(4)
+	namelength = lzopfile.read(1)
+	if len(namelength) != 1:
+		return False
+	headerbytes += namelength
+	headerbytes += lzopfile.read(ord(namelength))
+	checksumbytes = lzopfile.read(4)
+	if len(checksumbytes) != 4:
+		return False
+	if lzopflags & 0x1000 != 0:
+		checksum = zlib.crc32(headerbytes) & 0xffffffff
+	else:
+		checksum = zlib.adler32(headerbytes) & 0xffffffff
+	return struct.unpack('>I', checksumbytes)[0] == checksum
+
 def unpackLzop(filename, offset, tempdir=None):
 	## first unpack things, write things to a file and return
 	## the directory if the file is not empty
 	## Assumes (for now) that lzop is in the path
+
+	## first verify the checksum of the header, so false positives
+	## do not have to be carved first.
+	lzopview = fileview.FileView(filename, offset)
+	validheader = verifyLzopHeader(lzopview)
+	lzopview.close()
+	if not validheader:
+		return (None, None)
+
 	tmpdir = unpacksetup(tempdir)
 	tmpfile = tempfile.mkstemp(dir=tmpdir, suffix='.lzo')
 	os.fdopen(tmpfile[0]).close()
@@ -2471,6 +2470,162 @@ def unpackLzop(filename, offset, tempdir=None):
 
 ## To unpack XZ a header and a footer need to be found
 ## http://tukaani.org/xz/xz-file-format.txt
+## Check the header of an XZ stream (12 bytes): magic, stream flags and the
+## CRC32 of the stream flags. Returns the stream flags, or None if the
+## header is not valid.
+def checkXZHeader(streamheader):
+	if len(streamheader) != 12:
+		return None
+	if streamheader[:6] != fsmagic.fsmagic['xz']:
+		return None
+	streamflags = streamheader[6:8]
+	## the first byte is reserved, the second byte is the check type
+	if streamflags[0] != '\x00' or ord(streamflags[1]) & 0xf0 != 0:
+		return None
+	if struct.unpack('<I', streamheader[8:12])[0] != zlib.crc32(streamflags) & 0xffffffff:
+		return None
+	return streamflags
+
+## read a variable length integer from an XZ index. Returns a tuple (value,
+## position after the integer) or None.
+def readXZVarint(data, position):
+	value = 0
+	for i in range(0, 9):
+		if position + i >= len(data):
+			return None
+		byte = ord(data[position + i])
+		value |= (byte & 0x7f) << (i * 7)
+		if byte & 0x80 == 0:
+			return (value, position + i + 1)
+	return None
+
+## encode a variable length integer for an XZ index
+def writeXZVarint(value):
+	encoded = ''
+	while value >= 0x80:
+		encoded += chr((value & 0x7f) | 0x80)
+		value >>= 7
+	return encoded + chr(value)
+
+## Parse the stream footer (ending at 'trail', which is the offset of the
+## footer magic) and the index of an XZ stream starting at 'offset'. Returns a
+## list with a tuple (offset, unpadded size, uncompressed size) for every block
+## in the stream, or None if the footer or index are not valid, or if the
+## blocks in the index do not exactly fill the space between the stream header
+## and the index.
+def parseXZIndex(datafile, offset, trail, streamflags):
+	if trail - 10 < offset + 12:
+		return None
+	datafile.seek(trail - 10)
+	streamfooter = datafile.read(12)
+	if len(streamfooter) != 12 or streamfooter[10:12] != fsmagic.fsmagic['xztrailer']:
+		return None
+	if streamfooter[8:10] != streamflags:
+		return None
+	if struct.unpack('<I', streamfooter[0:4])[0] != zlib.crc32(streamfooter[4:10]) & 0xffffffff:
+		return None
+	## the backward size is the size of the index
+	backwardsize = (struct.unpack('<I', streamfooter[4:8])[0] + 1) * 4
+	indexoffset = trail - 10 - backwardsize
+	if indexoffset < offset + 12:
+		return None
+	datafile.seek(indexoffset)
+	xzindex = datafile.read(backwardsize)
+	if len(xzindex) != backwardsize or xzindex[0] != '\x00':
+		return None
+	if struct.unpack('<I', xzindex[-4:])[0] != zlib.crc32(xzindex[:-4]) & 0xffffffff:
+		return None
+
+	res = readXZVarint(xzindex, 1)
+	if res == None:
+		return None
+	(recordcount, position) = res
+	xzblocks = []
+	blockoffset = offset + 12
+	for i in range(0, recordcount):
+		res = readXZVarint(xzindex, position)
+		if res == None:
+			return None
+		(unpaddedsize, position) = res
+		res = readXZVarint(xzindex, position)
+		if res == None:
+			return None
+		(uncompressedsize, position) = res
+		xzblocks.append((blockoffset, unpaddedsize, uncompressedsize))
+		## blocks are padded to a multiple of four bytes
+		blockoffset += unpaddedsize + (4 - unpaddedsize % 4) % 4
+	if blockoffset != indexoffset:
+		return None
+	## the rest of the index is padding
+	if position > backwardsize - 4 or xzindex[position:-4] != '\x00' * (backwardsize - 4 - position):
+		return None
+	return xzblocks
+
+## Decompress a single block of an XZ stream, which is turned into a complete
+## XZ stream with just the one block, using the stream header of the original
+## stream and a new index and stream footer.
+def unpackXZBlock((filename, streamheader, blockoffset, unpaddedsize, uncompressedsize)):
+	datafile = open(filename, 'rb')
+	datafile.seek(blockoffset)
+	blockdata = datafile.read(unpaddedsize + (4 - unpaddedsize % 4) % 4)
+	datafile.close()
+	xzindex = '\x00' + writeXZVarint(1) + writeXZVarint(unpaddedsize) + writeXZVarint(uncompressedsize)
+	xzindex += '\x00' * ((4 - len(xzindex) % 4) % 4)
+	xzindex += struct.pack('<I', zlib.crc32(xzindex) & 0xffffffff)
+	streamfooter = struct.pack('<I', len(xzindex)/4 - 1) + streamheader[6:8]
+	streamfooter = struct.pack('<I', zlib.crc32(streamfooter) & 0xffffffff) + streamfooter + fsmagic.fsmagic['xztrailer']
+	return lzma.decompress(streamheader + blockdata + xzindex + streamfooter, format=lzma.FORMAT_XZ)
+
+## Decompress an XZ stream in process and write the data to a file. Streams
+## with several blocks are decompressed in parallel, with the blocks written
+## in order, using a pool of 'poolsize' processes. Returns False if the stream
+## could not be decompressed.
+def unpackXZStream(filename, offset, xzsize, xzblocks, outfilename, poolsize):
+	datafile = open(filename, 'rb')
+	datafile.seek(offset)
+	streamheader = datafile.read(12)
+	outfile = open(outfilename, 'wb')
+	unpackingerror = False
+	if len(xzblocks) > 1 and poolsize > 1:
+		datafile.close()
+		blocktasks = map(lambda x: (filename, streamheader) + x, xzblocks)
+		pool = None
+		try:
+			pool = multiprocessing.Pool(processes=poolsize)
+			for uncompresseddata in pool.imap(unpackXZBlock, blocktasks, 1):
+				outfile.write(uncompresseddata)
+		except Exception, e:
+			unpackingerror = True
+		finally:
+			if pool != None:
+				pool.terminate()
+	else:
+		## decompress the stream in chunks
+		decompressor = lzma.LZMADecompressor(format=lzma.FORMAT_XZ)
+		datafile.seek(offset)
+		bytesread = 0
+		while bytesread < xzsize:
+			xzdata = datafile.read(min(lzmachunksize, xzsize - bytesread))
+			if xzdata == '':
+				unpackingerror = True
+				break
+			bytesread += len(xzdata)
+			try:
+				outfile.write(decompressor.decompress(xzdata))
+			except Exception, e:
+				unpackingerror = True
+				break
+		if not unpackingerror and not decompressor.eof:
+			unpackingerror = True
+		datafile.close()
+	outfile.close()
+
+	## the size of the uncompressed data should match the index
+	if not unpackingerror:
+		if os.stat(outfilename).st_size != sum(map(lambda x: x[2], xzblocks)):
+			unpackingerror = True
+	return not unpackingerror
+
 def searchUnpackXZ(filename, tempdir=None, blacklist=[], offsets={}, scanenv={}, debug=False):
 	hints = {}
 	if not 'xz' in offsets:
@@ -2482,16 +2637,6 @@ def searchUnpackXZ(filename, tempdir=None, blacklist=[], offsets={}, scanenv={},
 	if offsets['xztrailer'] == []:
 		return ([], blacklist, [], hints)
 
-	dotest = True
-	## check version of XZ, as older versions do not support -l
-	p = subprocess.Popen(['xz', '-V'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-	(stanout, stanerr) = p.communicate()
-	if p.returncode != 0:
-		return ([], blacklist, [], hints)
-
-	if '4.999.9beta' in stanout:
-		dotest = False
-
 	diroffsets = []
 	newtags = []
 	counter = 1
@@ -2507,10 +2652,10 @@ def searchUnpackXZ(filename, tempdir=None, blacklist=[], offsets={}, scanenv={},
 		blacklistoffset = extractor.inblacklist(offset, blacklist)
 		if blacklistoffset != None:
 			continue
-		## bytes 7 and 8 in the stream are "streamflags"
 		datafile.seek(offset)
-		data = datafile.read(8)
-		streamflags = data[6:8]
+		streamflags = checkXZHeader(datafile.read(12))
+		if streamflags == None:
+			continue
 		for trail in offsets['xztrailer']:
 			## check if the trailer is in the blacklist
 			blacklistoffset = extractor.inblacklist(trail, blacklist)
@@ -2519,20 +2664,17 @@ def searchUnpackXZ(filename, tempdir=None, blacklist=[], offsets={}, scanenv={},
 			## only check offsets that make sense
 			if trail < offset:
 				continue
-			## The "streamflag" bytes should also be present just before the
-			## trailer according to the XZ file format documentation.
-			datafile.seek(trail-2)
-			data = datafile.read(2)
-			if data != streamflags:
+			## The stream footer and index tell exactly where the
+			## blocks in the stream are, so the stream can be checked
+			## without unpacking it.
+			xzblocks = parseXZIndex(datafile, offset, trail, streamflags)
+			if xzblocks == None:
 				continue
 
 			xzsize = trail+2 - offset
-			datafile.seek(offset)
-			data = datafile.read(xzsize)
-			## TODO: the two bytes before that are the so called "backward size"
 
 			tmpdir = dirsetup(tempdir, filename, "xz", counter)
-			res = unpackXZ(filename, offset, xzsize, template, dotest, tmpdir)
+			res = unpackXZ(filename, offset, xzsize, xzblocks, template, unpackpoolsize(scanenv), tmpdir)
 			if res != None:
 				diroffsets.append((res, offset, xzsize))
 				blacklist.append((offset, trail+2))
@@ -2549,33 +2691,33 @@ def searchUnpackXZ(filename, tempdir=None, blacklist=[], offsets={}, scanenv={},
 	datafile.close()
 	return (diroffsets, blacklist, newtags, hints)
 
-def unpackXZ(filename, offset, xzsize, template, dotest, tempdir=None):
+def unpackXZ(filename, offset, xzsize, xzblocks, template, poolsize, tempdir=None):
 	tmpdir = unpacksetup(tempdir)
-	tmpfile = tempfile.mkstemp(dir=tmpdir)
-	os.fdopen(tmpfile[0]).close()
-
-	unpackFile(filename, offset, tmpfile[1], tmpdir, length=xzsize)
-
-	if dotest:
-		## test integrity of the file
-		p = subprocess.Popen(['xz', '-l', tmpfile[1]], stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True)
-		(stanout, stanerr) = p.communicate()
-		if p.returncode != 0:
-			os.unlink(tmpfile[1])
-			return None
-	## unpack
 	outtmpfile = tempfile.mkstemp(dir=tmpdir)
-	p = subprocess.Popen(['xzcat', tmpfile[1]], stdout=outtmpfile[0], stderr=subprocess.PIPE, close_fds=True)
-	(stanout, stanerr) = p.communicate()
-	os.fsync(outtmpfile[0])
 	os.fdopen(outtmpfile[0]).close()
+
+	if haslzma:
+		if not unpackXZStream(filename, offset, xzsize, xzblocks, outtmpfile[1], poolsize):
+			os.unlink(outtmpfile[1])
+			if tempdir == None:
+				os.rmdir(tmpdir)
+			return None
+	else:
+		## unpack with xzcat
+		tmpfile = tempfile.mkstemp(dir=tmpdir)
+		os.fdopen(tmpfile[0]).close()
+		unpackFile(filename, offset, tmpfile[1], tmpdir, length=xzsize)
+		outfile = open(outtmpfile[1], 'wb')
+		p = subprocess.Popen(['xzcat', tmpfile[1]], stdout=outfile, stderr=subprocess.PIPE, close_fds=True)
+		(stanout, stanerr) = p.communicate()
+		os.fsync(outfile.fileno())
+		outfile.close()
+		os.unlink(tmpfile[1])
 	if os.stat(outtmpfile[1]).st_size == 0:
 		os.unlink(outtmpfile[1])
-		os.unlink(tmpfile[1])
 		if tempdir == None:
 			os.rmdir(tmpdir)
 		return None
-	os.unlink(tmpfile[1])
 
 	wholefile = False
 	if offset == 0 and offset+xzsize == os.stat(filename).st_size:
@@ -3843,11 +3985,29 @@ def searchUnpackExt2fs(filename, tempdir=None, blacklist=[], offsets={}, scanenv
 	datafile.close()
 	return (diroffsets, blacklist, newtags, hints)
 
-## Unpack an ext2 file system using e2tools and some custom written code from BAT's own ext2 module
+## Unpack an ext2 file system using BAT's own ext2 module. If the file system
+## uses features that the ext2 module does not support fall back to e2tools.
 def unpackExt2fs(filename, offset, ext2length, tempdir=None, unpackenv={}, blacklist=[]):
-	## first unpack things, write data to a file and return
-	## the directory if the file is not empty
 	tmpdir = unpacksetup(tempdir)
+
+	## First read the file system directly from the file, without carving
+	## it. If no length is known read until the next blacklist entry, like
+	## unpackFile() would do.
+	viewlength = ext2length
+	if ext2length == 0 and blacklist != []:
+		lowest = extractor.lowestnextblacklist(offset, blacklist)
+		if lowest != 0:
+			viewlength = lowest - offset
+	ext2view = fileview.FileView(filename, offset, viewlength)
+	ext2size = ext2.unpackext2fs(ext2view, tmpdir)
+	ext2view.close()
+	if ext2size != None:
+		if ext2length != 0:
+			ext2size = ext2length
+		return (tmpdir, ext2size)
+
+	## then unpack things with e2tools, write data to a file and return
+	## the directory if the file is not empty
 	tmpfile = tempfile.mkstemp(dir=tmpdir)
 	os.fdopen(tmpfile[0]).close()
 
@@ -3934,6 +4094,144 @@ def searchUnpackKnownGzip(filename, tempdir=None, scanenv={}, debug=False):
 			return (diroffsets, blacklist, newtags, hints)
 	return ([], [], [], {})
 
+## amount of bytes read to parse a gzip header. The header can contain
+## extra fields (at most 65535 bytes), a file name and a comment.
+gzipheadersize = 131072
+
+## Parse the header of a gzip member (RFC 1952) from a buffer with the
+## data at the start of the member. Returns None if the header is not
+## valid, or a tuple (size of the header, file name).
+def parseGzipHeader(gzipheader):
+	if len(gzipheader) < 11:
+		return None
+	if gzipheader[:3] != fsmagic.fsmagic['gzip']:
+		return None
+	gzipflags = ord(gzipheader[3])
+	## some sanity checks for gzip flags:
+	## encrypted files are not supported
+	## flags 6 and 7 are reserved and should not be set
+	## (see gzip.h in gzip sources and RFC 1952)
+	if gzipflags & 0xe0 != 0:
+		return None
+	localoffset = 10
+	## FEXTRA: extra fields, preceded by their length
+	if gzipflags & 0x04 != 0:
+		if len(gzipheader) < localoffset + 2:
+			return None
+		extralength = struct.unpack('<H', gzipheader[localoffset:localoffset+2])[0]
+		localoffset += 2 + extralength
+	## FNAME: a file name, terminated by NUL
+	gzipname = None
+	if gzipflags & 0x08 != 0:
+		nameend = gzipheader.find('\x00', localoffset)
+		if nameend == -1:
+			return None
+		gzipname = gzipheader[localoffset:nameend]
+		localoffset = nameend + 1
+	## FCOMMENT: a comment, terminated by NUL
+	if gzipflags & 0x10 != 0:
+		commentend = gzipheader.find('\x00', localoffset)
+		if commentend == -1:
+			return None
+		localoffset = commentend + 1
+	## FHCRC: CRC16 of the header
+	if gzipflags & 0x02 != 0:
+		localoffset += 2
+	if localoffset >= len(gzipheader):
+		return None
+
+	## simple check for deflate: according to RFC 1951 block
+	## type 3 is an error
+	if (ord(gzipheader[localoffset]) >> 1) & 3 == 3:
+		return None
+	return (localoffset, gzipname)
+
+## amount of bytes that is read at once when decompressing gzip data, which
+## is also the maximum amount of uncompressed data kept in memory at once
+gzipchunksize = 1048576
+
+## Decompress the deflate data of a gzip member, starting at 'deflateoffset',
+## and write it to 'outfile' while decompressing. Returns None if the data is
+## not valid, or the size of the deflate data plus the trailer.
+def inflateGzipMember(gzipfile, deflateoffset, outfile):
+	gzipfile.seek(deflateoffset)
+	deflateobj = zlib.decompressobj(-zlib.MAX_WBITS)
+	crc32 = zlib.crc32('')
+	uncompressedsize = 0
+	readsize = 0
+	while deflateobj.unused_data == '':
+		deflatedata = gzipfile.read(gzipchunksize)
+		if deflatedata == '':
+			## the data ended before the end of the deflate stream
+			return None
+		readsize += len(deflatedata)
+		while deflatedata != '':
+			try:
+				uncompresseddata = deflateobj.decompress(deflatedata, gzipchunksize)
+			except Exception, e:
+				return None
+			outfile.write(uncompresseddata)
+			crc32 = zlib.crc32(uncompresseddata, crc32)
+			uncompressedsize += len(uncompresseddata)
+			## At the end of the deflate stream the data after the
+			## stream is in 'unused_data', but it can also still be in
+			## 'unconsumed_tail' if an earlier call stopped because
+			## of the maximum length, so stop here.
+			if deflateobj.unused_data != '':
+				break
+			deflatedata = deflateobj.unconsumed_tail
+	deflatesize = readsize - len(deflateobj.unused_data)
+
+	## The trailer of a valid gzip member is the CRC32 followed by the
+	## size of uncompressed data (modulo 2^32)
+	gzipfile.seek(deflateoffset + deflatesize)
+	gzipcrc32andsize = gzipfile.read(8)
+	if len(gzipcrc32andsize) != 8:
+		return None
+	if gzipcrc32andsize != struct.pack('<II', crc32 & 0xffffffff, uncompressedsize % pow(2,32)):
+		return None
+	return deflatesize + 8
+
+## Unpack gzip data at an offset in a file to 'outfilename'. Members of the
+## gzip data that directly follow each other are concatenated, like gunzip
+## does. If 'endoffset' is set no members starting at or after 'endoffset' are
+## unpacked. Returns None if the data is not valid gzip data (and removes the
+## output file) or a tuple (size of the gzip data, file name in the header).
+def carveGzip(filename, offset, outfilename, endoffset=None):
+	gzipfile = open(filename, 'rb')
+	outfile = open(outfilename, 'wb')
+	gzipsize = 0
+	gzipname = None
+	validsize = 0
+	while True:
+		if gzipsize != 0 and endoffset != None and offset + gzipsize >= endoffset:
+			break
+		gzipfile.seek(offset + gzipsize)
+		headerres = parseGzipHeader(gzipfile.read(gzipheadersize))
+		if headerres == None:
+			break
+		(headersize, membername) = headerres
+		membersize = inflateGzipMember(gzipfile, offset + gzipsize + headersize, outfile)
+		if membersize == None:
+			break
+		if gzipsize == 0:
+			gzipname = membername
+		gzipsize += headersize + membersize
+		validsize = outfile.tell()
+	## remove any data of a member that is not valid
+	outfile.flush()
+	outfile.truncate(validsize)
+	outfile.close()
+	gzipfile.close()
+	if gzipsize == 0:
+		os.unlink(outfilename)
+		return None
+	return (gzipsize, gzipname)
+
+## wrapper for carveGzip, for use with multiprocessing
+def carveGzipTask((filename, offset, outfilename, endoffset)):
+	return (offset, carveGzip(filename, offset, outfilename, endoffset))
+
 def searchUnpackGzip(filename, tempdir=None, blacklist=[], offsets={}, scanenv={}, debug=False):
 	hints = {}
 	if not 'gzip' in offsets:
@@ -3947,173 +4245,73 @@ def searchUnpackGzip(filename, tempdir=None, blacklist=[], offsets={}, scanenv={
 	template = None
 	if 'TEMPLATE' in scanenv:
 		template = scanenv['TEMPLATE']
-	for offset in offsets['gzip']:
+
+	gzipoffsets = []
+	for offset in sorted(offsets['gzip']):
 		blacklistoffset = extractor.inblacklist(offset, blacklist)
 		if blacklistoffset != None:
 			continue
-
-		## some sanity checks for gzip flags:
-		## multi-part gzip (continuation) is not supported
-		## encrypted files are not supported
-		## flags 6 and 7 are reserved and should not be set
-		## (see gzip.h in gzip sources and RFC 1952)
-		## 1. check if "FEXTRA" is set. If so, don't continue searching for the name
-		## 2. check if "FNAME" is set. If so, it follows immediately after MTIME
-		## TODO: also process if FEXTRA is set
-		gzipfile = open(filename, 'rb')
-		gzipfile.seek(offset+3)
-		gzipbyte = gzipfile.read(1)
-		gzipfile.close()
-		hasnameset = False
-		hascrc16 = False
-		hascomment = False
-		if (ord(gzipbyte) >> 1 & 1) == 1:
-			hascrc16 = True
-		if (ord(gzipbyte) >> 2 & 1) == 1:
-			## continuation
-			## TODO: extra fields, deal with this properly
-			continue
-		if (ord(gzipbyte) >> 3 & 1) == 1:
-			hasnameset = True
-		if (ord(gzipbyte) >> 4 & 1) == 1:
-			hascomment = True
-		if (ord(gzipbyte) >> 5 & 1) == 1:
-			## encrypted
-			continue
-		if (ord(gzipbyte) >> 6 & 1) == 1:
-			## reserved
-			continue
-		if (ord(gzipbyte) >> 7 & 1) == 1:
-			## reserved
-			continue
-
-		gzipfile = open(filename, 'rb')
-		localoffset = offset+10
-		renamename = None
-		comment = None
-		if hasnameset:
-			renamename = ''
-			gzipfile.seek(localoffset)
-			gzipbyte = gzipfile.read(1)
-			localoffset += 1
-			while gzipbyte != '\0':
-				renamename += gzipbyte
-				gzipbyte = gzipfile.read(1)
-				localoffset += 1
-		if hascomment:
-			comment = ''
-			gzipfile.seek(localoffset)
-			gzipbyte = gzipfile.read(1)
-			localoffset += 1
-			while gzipbyte != '\0':
-				comment += gzipbyte
-				gzipbyte = gzipfile.read(1)
-				localoffset += 1
-		if hascrc16:
-			localoffset += 2
-		gzipfile.seek(localoffset)
-		compresseddataheader = gzipfile.read(1)
-
-		## simple check for deflate
-		bfinal = (ord(compresseddataheader) >> 0 & 1)
-		btype1 = (ord(compresseddataheader) >> 1 & 1)
-		btype2 = (ord(compresseddataheader) >> 2 & 1)
-		if btype1 == 1 and btype2 == 1:
-			## according to RFC 1951 this is an error
-			gzipfile.close()
-			continue
-
-		## Because gzip is a header followed by deflate data it is
-		## possible to do some sanity checking by first decompressing
-		## some data.
-		## try to uncompress raw deflate data, first one block of
-		## a bit less than 10 meg
-		## http://www.zlib.net/manual.html#Advanced
-		gzipfile.seek(localoffset)
-		readsize = 10000000
-		deflatedata = gzipfile.read(readsize)
-		deflateobj = zlib.decompressobj(-zlib.MAX_WBITS)
-		deflatesize = 0
+		gzipoffsets.append(offset)
+
+	## If there are many gzip offsets (for example a firmware with a lot of
+	## compressed web pages) these are first all unpacked in parallel to a
+	## temporary directory. The results for offsets that turn out to be
+	## inside gzip data found at an earlier offset are thrown away.
+	## To not unpack the same data over and over again (for example for gzip
+	## data with many members, where every member is found as an offset) the
+	## data for an offset is only unpacked up to the next offset.
+	gzipresults = {}
+	gzipendoffsets = dict(zip(gzipoffsets, gzipoffsets[1:] + [None]))
+	gzipparallel = int(scanenv.get('GZIP_PARALLEL_MINIMUM', 100))
+	gzippoolsize = unpackpoolsize(scanenv)
+	if len(gzipoffsets) >= gzipparallel and gzippoolsize > 1:
+		if tempdir == None:
+			gzipworkdir = tempfile.mkdtemp()
+		else:
+			gzipworkdir = tempfile.mkdtemp(dir=os.path.dirname(filename))
+		gziptasks = map(lambda x: (filename, x, os.path.join(gzipworkdir, "%d.gz.out" % x), gzipendoffsets[x]), gzipoffsets)
+		pool = None
 		try:
-			uncompresseddata = deflateobj.decompress(deflatedata)
-			## check if there is some uncompressed data left. For a completely
-			## uncompressed ## file there should be some data left (8 bytes, namely
-			## CRC32 and file size). If there is no data left, then it means that
-			## decompression is not yet complete.
-			if deflateobj.unused_data != "":
-				deflatesize = len(deflatedata) - len(deflateobj.unused_data)
-		except:
-			gzipfile.close()
+			pool = multiprocessing.Pool(processes=gzippoolsize)
+			gzipresults = dict(pool.map(carveGzipTask, gziptasks, 1))
+		except Exception, e:
+			gzipresults = {}
+		finally:
+			if pool != None:
+				pool.terminate()
+	else:
+		gzipworkdir = None
+
+	for offset in gzipoffsets:
+		blacklistoffset = extractor.inblacklist(offset, blacklist)
+		if blacklistoffset != None:
 			continue
 
 		tmpdir = dirsetup(tempdir, filename, "gzip", counter)
 		tmpfile = tempfile.mkstemp(dir=tmpdir)
 		os.fdopen(tmpfile[0]).close()
-
-		outgzipfile = open(tmpfile[1], 'wb')
-		outgzipfile.write(uncompresseddata)
-		outgzipfile.flush()
-		## The size of the *raw* deflate data is gzipsize,
-		## followed by the crc32 of the uncompresed data
-		## and the size
-		unpackfailure = False
-		if deflatesize == 0:
-			while deflateobj.unused_data == "":
-				localoffset += readsize
-				deflatedata = gzipfile.read(readsize)
-				if deflatedata == '':
-					break
-				try:
-					uncompresseddata = deflateobj.decompress(deflatedata)
-					outgzipfile.write(uncompresseddata)
-					outgzipfile.flush()
-				except:
-					## something weird is going on
-					unpackfailure = True
-					break
-			deflatesize = len(deflatedata) - len(deflateobj.unused_data)
-		deflateobj.flush()
-		outgzipfile.close()
-
-		if unpackfailure:
-			gzipfile.close()
-			os.unlink(tmpfile[1])
-			os.rmdir(tmpdir)
-			continue
-
-		## The trailer of a valid gzip file is the CRC32 followed by file
-		## size of uncompressed data
-		crc32 = gzipcrc32(tmpfile[1])
-
-		gzipfile.seek(localoffset + deflatesize)
-		gzipcrc32andsize = gzipfile.read(8)
-
-		if len(gzipcrc32andsize) != 8:
-			gzipfile.close()
-			os.unlink(tmpfile[1])
-			os.rmdir(tmpdir)
-			continue
-
-		if gzipcrc32andsize[0:4] != struct.pack('<I', crc32):
-			gzipfile.close()
-			os.unlink(tmpfile[1])
-			os.rmdir(tmpdir)
-			continue
-		filesize = os.stat(tmpfile[1]).st_size % pow(2,32)
-		if gzipcrc32andsize[4:8] != struct.pack('<I', filesize):
-			gzipfile.close()
-			os.unlink(tmpfile[1])
+		if offset in gzipresults:
+			res = gzipresults[offset]
+			if res == None:
+				os.unlink(tmpfile[1])
+			elif gzipendoffsets[offset] != None and offset + res[0] >= gzipendoffsets[offset]:
+				## the data was unpacked up to or past the next offset,
+				## where another member of the same gzip data might
+				## start, so unpack it again without a limit
+				res = carveGzip(filename, offset, tmpfile[1])
+			else:
+				shutil.move(os.path.join(gzipworkdir, "%d.gz.out" % offset), tmpfile[1])
+		else:
+			res = carveGzip(filename, offset, tmpfile[1])
+		if res == None:
 			os.rmdir(tmpdir)
 			continue
+		(gzipsize, renamename) = res
 
-		## the size of the gzip data is the size of the deflate data,
-		## plus 4 bytes for crc32 and 4 bytes for file size, plus
-		## the gzip header.
-		gzipsize = deflatesize + 8 + (localoffset - offset)
 		diroffsets.append((tmpdir, offset, gzipsize))
 		blacklist.append((offset, offset + gzipsize))
 		counter = counter + 1
-		if hasnameset and renamename != None:
+		if renamename != None:
 			mvname = os.path.basename(renamename)
 			if not os.path.exists(os.path.join(tmpdir, mvname)):
 				try:
@@ -4131,7 +4329,7 @@ def searchUnpackGzip(filename, tempdir=None, blacklist=[], offsets={}, scanenv={
 
 			## if the file has not been renamed already try to see
 			## if it needs to be renamed.
-			if not(hasnameset and renamename != None):
+			if renamename == None:
 				## rename the file, like gunzip does
 				if filename.lower().endswith('.gz'):
 					filenamenoext = os.path.basename(filename)[:-3]
@@ -4145,8 +4343,9 @@ def searchUnpackGzip(filename, tempdir=None, blacklist=[], offsets={}, scanenv={
 						gzpath = os.path.join(tmpdir, filenamenoext)
 						if not os.path.exists(gzpath):
 							shutil.move(tmpfile[1], gzpath)
-		gzipfile.close()
 
+	if gzipworkdir != None:
+		shutil.rmtree(gzipworkdir)
 	return (diroffsets, blacklist, newtags, hints)
 
 def searchUnpackCompress(filename, tempdir=None, blacklist=[], offsets={}, scanenv={}, debug=False):
@@ -4278,6 +4477,156 @@ def searchUnpackKnownBzip2(filename, tempdir=None, scanenv={}, debug=False):
 			return (diroffsets, blacklist, newtags, hints)
 	return ([], [], [], {})
 
+## rename the file with the data unpacked from a bzip2 file, like bunzip2 does
+def renameBzip2(filename, unpackedfile, tmpdir):
+	if filename.lower().endswith('.bz2'):
+		filenamenoext = os.path.basename(filename)[:-4]
+		if len(filenamenoext) > 0:
+			bz2path = os.path.join(tmpdir, filenamenoext)
+			if not os.path.exists(bz2path):
+				shutil.move(unpackedfile, bz2path)
+	## slightly different for tbz2
+	elif filename.lower().endswith('.tbz2'):
+		filenamenoext = os.path.basename(filename)[:-5] + ".tar"
+		if len(filenamenoext) > 4:
+			bz2path = os.path.join(tmpdir, filenamenoext)
+			if not os.path.exists(bz2path):
+				shutil.move(unpackedfile, bz2path)
+
+## markers in bzip2 data: the start of every block and the end of the stream
+## (48 bits each). Blocks are not aligned to bytes, so the markers can start
+## at any bit.
+bzip2blockmagic = 0x314159265359
+bzip2endmagic = 0x177245385090
+
+## Find the positions (in bits) of a 48 bit marker in data, between two
+## byte offsets. For every possible bit offset the marker is shifted and
+## the bytes that are completely part of the marker are searched for, after
+## which the bits in the first and last byte are checked.
+def findBitMarker(data, marker, startoffset, endoffset, firstonly=False):
+	positions = []
+	for shift in range(0, 8):
+		if shift == 0:
+			window = binascii.unhexlify('%012x' % marker)
+			mask = '\xff' * 6
+		else:
+			window = binascii.unhexlify('%014x' % (marker << (8 - shift)))
+			mask = binascii.unhexlify('%014x' % (((1 << 48) - 1) << (8 - shift)))
+		## the bytes in the window that only contain bits of the marker
+		if shift == 0:
+			searchstart = 0
+			searchbytes = window
+		else:
+			searchstart = 1
+			searchbytes = window[1:6]
+		position = data.find(searchbytes, startoffset + searchstart, endoffset)
+		while position != -1:
+			windowoffset = position - searchstart
+			if windowoffset + len(window) > endoffset:
+				break
+			if ord(data[windowoffset]) & ord(mask[0]) == ord(window[0]) and ord(data[windowoffset + len(window) - 1]) & ord(mask[-1]) == ord(window[-1]):
+				positions.append(windowoffset * 8 + shift)
+				if firstonly:
+					break
+			position = data.find(searchbytes, position + 1, endoffset)
+	positions.sort()
+	if firstonly:
+		return positions[:1]
+	return positions
+
+## read a number of bits from data, starting at a bit position
+def readBits(data, bitposition, bitlength):
+	startbyte = bitposition / 8
+	endbyte = (bitposition + bitlength + 7) / 8
+	value = int(binascii.hexlify(data[startbyte:endbyte]), 16)
+	value >>= endbyte * 8 - (bitposition + bitlength)
+	return value & ((1 << bitlength) - 1)
+
+## Decompress a single bzip2 block, which is turned into a complete bzip2
+## stream with just the one block. For a stream with one block the combined
+## CRC of the stream is the CRC of the block.
+def unpackBzip2Block((filename, blocksize, startbit, endbit)):
+	bzfile = open(filename, 'rb')
+	bzfile.seek(startbit / 8)
+	blockdata = bzfile.read((endbit + 7) / 8 - startbit / 8)
+	bzfile.close()
+	blocklength = endbit - startbit
+	blockbits = readBits(blockdata, startbit % 8, blocklength)
+	blockcrc = (blockbits >> (blocklength - 80)) & 0xffffffff
+	streamlength = blocklength + 80
+	padding = (8 - streamlength % 8) % 8
+	streambits = ((((blockbits << 48) | bzip2endmagic) << 32) | blockcrc) << padding
+	streamdata = 'BZh' + blocksize + binascii.unhexlify('%0*x' % ((streamlength + padding) / 4, streambits))
+	return bz2.decompress(streamdata)
+
+## Decompress a bzip2 stream with multiple processes: the stream is split into
+## blocks, which are decompressed in parallel and written in order. Only
+## streams of at least 'minimumsize' bytes are decompressed. Returns None if
+## the stream is smaller or if it could not be split or decompressed, or the
+## size of the bzip2 stream.
+def unpackBzip2Parallel(filename, offset, outfilename, poolsize, minimumsize):
+	bzfile = open(filename, 'rb')
+	bzdata = mmap.mmap(bzfile.fileno(), 0, access=mmap.ACCESS_READ)
+	bzfile.close()
+	blocksize = bzdata[offset+3]
+
+	## First find the end of the stream, then the blocks. The end of the
+	## stream is first searched for in the first 'minimumsize' bytes, so
+	## for small streams the rest of the file is not searched.
+	searchend = min(len(bzdata), offset + minimumsize)
+	if findBitMarker(bzdata, bzip2endmagic, offset + 4, searchend, True) != []:
+		bzdata.close()
+		return None
+	endbits = findBitMarker(bzdata, bzip2endmagic, max(offset + 4, searchend - 6), len(bzdata), True)
+	if endbits == []:
+		bzdata.close()
+		return None
+	endbit = endbits[0]
+	if endbit + 80 > len(bzdata) * 8:
+		bzdata.close()
+		return None
+	blockbits = findBitMarker(bzdata, bzip2blockmagic, offset + 4, endbit / 8 + 7)
+	blockbits = filter(lambda x: x < endbit, blockbits)
+	if blockbits == [] or blockbits[0] != (offset + 4) * 8:
+		bzdata.close()
+		return None
+
+	## check if the blocks are correct using the combined CRC in the
+	## stream, computed from the CRCs of the blocks, before decompressing
+	combinedcrc = 0
+	for blockbit in blockbits:
+		combinedcrc = ((combinedcrc << 1) | (combinedcrc >> 31)) & 0xffffffff
+		combinedcrc ^= readBits(bzdata, blockbit + 48, 32)
+	streamcrc = readBits(bzdata, endbit + 48, 32)
+	bzdata.close()
+	if combinedcrc != streamcrc:
+		return None
+
+	blocktasks = []
+	for i in range(0, len(blockbits)):
+		if i == len(blockbits) - 1:
+			blocktasks.append((filename, blocksize, blockbits[i], endbit))
+		else:
+			blocktasks.append((filename, blocksize, blockbits[i], blockbits[i+1]))
+
+	## the blocks are decompressed in parallel, but written in order
+	outfile = open(outfilename, 'wb')
+	pool = None
+	unpackingerror = False
+	try:
+		pool = multiprocessing.Pool(processes=poolsize)
+		for uncompresseddata in pool.imap(unpackBzip2Block, blocktasks, 1):
+			outfile.write(uncompresseddata)
+	except Exception, e:
+		unpackingerror = True
+	finally:
+		if pool != None:
+			pool.terminate()
+	outfile.close()
+	if unpackingerror:
+		return None
+	return (endbit + 80 + 7) / 8 - offset
+
 ## search and unpack bzip2 compressed files
 def searchUnpackBzip2(filename, tempdir=None, blacklist=[], offsets={}, scanenv={}, debug=False):
 	hints = {}
@@ -4290,6 +4639,12 @@ def searchUnpackBzip2(filename, tempdir=None, blacklist=[], offsets={}, scanenv=
 	counter = 1
 	newtags = []
 	bzip2datasize = 10000000
+	filesize = os.stat(filename).st_size
+
+	## big bzip2 streams (from the start of the stream to the end of stream
+	## marker) are split into blocks, which are decompressed in parallel
+	bzip2parallel = int(scanenv.get('BZIP2_PARALLEL_MINIMUM', 10485760))
+	bzip2poolsize = unpackpoolsize(scanenv)
 	for offset in offsets['bz2']:
 		blacklistoffset = extractor.inblacklist(offset, blacklist)
 		if blacklistoffset != None:
@@ -4328,6 +4683,25 @@ def searchUnpackBzip2(filename, tempdir=None, blacklist=[], offsets={}, scanenv=
 			if blockbytes[5] != '\x59':
 				continue
 
+		if filesize - offset >= bzip2parallel and bzip2poolsize > 1:
+			tmpdir = dirsetup(tempdir, filename, "bzip2", counter)
+			tmpfile = tempfile.mkstemp(dir=tmpdir)
+			os.fdopen(tmpfile[0]).close()
+			bzip2size = unpackBzip2Parallel(filename, offset, tmpfile[1], bzip2poolsize, bzip2parallel)
+			if bzip2size != None:
+				diroffsets.append((tmpdir, offset, bzip2size))
+				blacklist.append((offset, offset + bzip2size))
+				if offset == 0 and bzip2size == filesize:
+					renameBzip2(filename, tmpfile[1], tmpdir)
+					newtags.append('compressed')
+					newtags.append('bzip2')
+				counter = counter + 1
+				continue
+			## the stream could not be decompressed in parallel, so
+			## decompress it in the regular way
+			os.unlink(tmpfile[1])
+			os.rmdir(tmpdir)
+
 		## extra sanity check: try to uncompress a few blocks of data
 		bzfile = open(filename, 'rb')
 		bzfile.seek(offset)
@@ -4358,20 +4732,7 @@ def searchUnpackBzip2(filename, tempdir=None, blacklist=[], offsets={}, scanenv=
 			diroffsets.append((tmpdir, offset, bzip2size))
 			blacklist.append((offset, offset + bzip2size))
 			if offset == 0 and (bzip2size == os.stat(filename).st_size):
-				## rename the file, like bunzip does
-				if filename.lower().endswith('.bz2'):
-					filenamenoext = os.path.basename(filename)[:-4]
-					if len(filenamenoext) > 0:
-						bz2path = os.path.join(tmpdir, filenamenoext)
-						if not os.path.exists(bz2path):
-							shutil.move(tmpfile[1], bz2path)
-				## slightly different for tbz2
-				elif filename.lower().endswith('.tbz2'):
-					filenamenoext = os.path.basename(filename)[:-5] + ".tar"
-					if len(filenamenoext) > 4:
-						bz2path = os.path.join(tmpdir, filenamenoext)
-						if not os.path.exists(bz2path):
-							shutil.move(tmpfile[1], bz2path)
+				renameBzip2(filename, tmpfile[1], tmpdir)
 				newtags.append('compressed')
 				newtags.append('bzip2')
 			counter = counter + 1
@@ -4417,18 +4778,7 @@ def searchUnpackBzip2(filename, tempdir=None, blacklist=[], offsets={}, scanenv=
 				diroffsets.append((tmpdir, offset, bytesread))
 				blacklist.append((offset, offset + bytesread))
 				if offset == 0 and (bytesread == os.stat(filename).st_size):
-					## rename the file, like bunzip does
-					if filename.lower().endswith('.bz2'):
-						filenamenoext = os.path.basename(filename)[:-4]
-						bz2path = os.path.join(tmpdir, filenamenoext)
-						if not os.path.exists(bz2path):
-							shutil.move(tmpfile[1], bz2path)
-					## slightly different for tbz2
-					elif filename.lower().endswith('.tbz2'):
-						filenamenoext = os.path.basename(filename)[:-5] + ".tar"
-						bz2path = os.path.join(tmpdir, filenamenoext)
-						if not os.path.exists(bz2path):
-							shutil.move(tmpfile[1], bz2path)
+					renameBzip2(filename, tmpfile[1], tmpdir)
 					newtags.append('compressed')
 					newtags.append('bzip2')
 				counter = counter + 1
@@ -4948,7 +5298,6 @@ def unpackZip(filename, offset, cutoff, endofcentraldir, commentsize, memorycuto
 	filesize = os.stat(filename).st_size
 
 	inmemory = False
-	havetmpfile = False
 	if offset != 0 or cutoff != filesize:
 		inmemory = True
 
@@ -4968,15 +5317,12 @@ def unpackZip(filename, offset, cutoff, endofcentraldir, commentsize, memorycuto
 			openzipfile.close()
 			memfile = StringIO.StringIO(zipdata)
 		else:
-			tmpfile = tempfile.mkstemp(dir=tempdir)
-			os.fdopen(tmpfile[0]).close()
-
+			## read big ZIP files directly from the file with a view
+			## instead of carving them first
 			if cutoff != 0:
-				unpackFile(filename, offset, tmpfile[1], tmpdir, length=ziplen)
+				memfile = fileview.FileView(filename, offset, ziplen)
 			else:
-				unpackFile(filename, offset, tmpfile[1], tmpdir)
-			havetmpfile = True
-			memfile = tmpfile[1]
+				memfile = fileview.FileView(filename, offset)
 	try:
 		memzipfile = zipfile.ZipFile(memfile, 'r')
 		infolist = memzipfile.infolist()
@@ -4996,35 +5342,26 @@ def unpackZip(filename, offset, cutoff, endofcentraldir, commentsize, memorycuto
 				## data is encrypted
 				memzipfile.close()
 				if inmemory:
-					if not havetmpfile:
-						memfile.close()
-					if not havetmpfile:
-						## write out the data if it is not already there
-						tmpdir = unpacksetup(tempdir)
-						tmpfile = tempfile.mkstemp(dir=tempdir)
-						os.fdopen(tmpfile[0]).close()
-
-						datafile = open(tmpfile[1], 'wb')
-						datafile.write(zipdata)
-						datafile.close()
+					memfile.close()
+					## write out the data, as it cannot be unpacked
+					tmpdir = unpacksetup(tempdir)
+					tmpfile = tempfile.mkstemp(dir=tempdir)
+					os.fdopen(tmpfile[0]).close()
+					if cutoff != 0:
+						carve.carveFile(filename, offset, tmpfile[1], ziplen)
+					else:
+						carve.carveFile(filename, offset, tmpfile[1])
 
 				return (tmpdir, ['encrypted'])
-		if not havetmpfile:
-			tmpdir = unpacksetup(tempdir)
 		for i in infolist:
 			if weirdzip and i.filename in weirdzipnames:
 				os.mkdir(os.path.join(tmpdir, i.filename))
 			else:
 				memzipfile.extract(i, tmpdir)
 		memzipfile.close()
-		if havetmpfile:
-			os.unlink(tmpfile[1])
 	except Exception, e:
 		if inmemory:
-			if havetmpfile:
-				os.unlink(tmpfile[1])
-			else:
-				memfile.close()
+			memfile.close()
 		for i in os.listdir(tmpdir):
 			try:
 				os.unlink(os.path.join(tmpdir, i))
@@ -5033,8 +5370,7 @@ def unpackZip(filename, offset, cutoff, endofcentraldir, commentsize, memorycuto
 				shutil.rmtree(os.path.join(tmpdir, i))
 		return (None, [])
 	if inmemory:
-		if not havetmpfile:
-			memfile.close()
+		memfile.close()
 	return (tmpdir, [])
 
 def searchUnpackKnownZip(filename, tempdir=None, scanenv={}, debug=False):
@@ -5424,63 +5760,75 @@ def searchUnpackLZMA(filename, tempdir=None, blacklist=[], offsets={}, scanenv={
 
 	lzma_tmpdir = scanenv.get('UNPACK_TEMPDIR', None)
 
+	## first check the headers of all the candidates
+	candidates = []
 	for offset in lzmaoffsets:
 		blacklistoffset = extractor.inblacklist(offset, blacklist)
 		if blacklistoffset != None:
 			continue
 		if filesize - offset < 13:
 			continue
-		## According to http://svn.python.org/projects/external/xz-5.0.3/doc/lzma-file-format.txt the first
-		## 13 bytes of the LZMA file are the header. It consists of properties (1 byte), dictionary
-		## size (4 bytes), and a field to store the size of the uncompressed data (8 bytes).
-		##
-		## The properties field is not fixed, but computed during compression and could be any value
-		## between 0x00 and 0xe0. In practice only a handful of values are really used, 0x5d being the most
-		## common one, because it is the default :-)
-		##
-		## The dictionary size can be any 32 bit integer, but again only a handful of values are widely
-		## used. LZMA utils uses 2^n, with 16 <= n <= 25 (default 23). XZ utils uses 2^n or 2^n+2^(n-1).
-		## For XZ utils n seems to be be 12 <= n <= 30 (default 23). Setting these requires tweaking
-		## command line parameters which is unlikely to happen very often.
-		##
-		## The following checks are based on some real life data, plus some theoretical values
-		## but could use refinement.
-		## Values were computed based on dictionary size 2^n or 2^n+2^(n-1), with 16 <= n <= 25
-		if not lzma_try_all:
-			lzma_file.seek(offset + 3)
-			lzmacheckbyte = lzma_file.read(2)
-			if lzmacheckbyte not in ['\x01\x00', '\x02\x00', '\x03\x00', '\x04\x00', '\x06\x00', '\x08\x00', '\x10\x00', '\x20\x00', '\x30\x00', '\x40\x00', '\x60\x00', '\x80\x00', '\x80\x01', '\x0c\x00', '\x18\x00', '\x00\x00', '\x00\x01', '\x00\x02', '\x00\x03', '\x00\x04', '\xc0\x00']:
-				continue
+		lzma_file.seek(offset)
+		lzmaheader = lzma_file.read(13)
+		headerres = checkLZMAHeader(lzmaheader, lzma_try_all)
+		if headerres == None:
+			continue
+		(lzmasizeknown, lzmasize) = headerres
+		candidates.append((offset, lzmasizeknown, lzmasize))
+
+	## If the LZMA module is available the candidates are first probed by
+	## decompressing just the first bytes of the stream, which quickly
+	## rejects most false positives. If there are many candidates this is
+	## done in parallel.
+	probes = {}
+	if haslzma:
+		lzmaparallel = int(scanenv.get('LZMA_PARALLEL_MINIMUM', 100))
+		probetasks = map(lambda x: (filename, x[0]), candidates)
+		proberesults = None
+		lzmapoolsize = unpackpoolsize(scanenv)
+		if len(probetasks) >= lzmaparallel and lzmapoolsize > 1:
+			pool = None
+			try:
+				pool = multiprocessing.Pool(processes=lzmapoolsize)
+				proberesults = pool.map(probeLZMAtask, probetasks, 1)
+			except Exception, e:
+				proberesults = None
+			finally:
+				if pool != None:
+					pool.terminate()
+		if proberesults == None:
+			proberesults = map(lambda x: probeLZMAtask(x), probetasks)
+		probes = dict(zip(map(lambda x: x[0], candidates), proberesults))
+
+	for (offset, lzmasizeknown, lzmasize) in candidates:
+		## the blacklist might have changed since the headers were checked
+		blacklistoffset = extractor.inblacklist(offset, blacklist)
+		if blacklistoffset != None:
+			continue
 
-		## sanity checks to see if the size is set.
-		lzmafile = open(filename, 'rb')
-		lzmafile.seek(offset+5)
-		lzmasizebytes = lzmafile.read(8)
-		lzmafile.close()
-		if len(lzmasizebytes) != 8:
-			continue
-
-		## A few more sanity checks: first check if the file is a stream
-		## of unknown size, or if it has a file size set (for the
-		## uncompressed file).
-		## If it has a file size set, then check if the value of the size
-		## actually makes sense.
-		## Then read some data and try to decompress it. Because LZMA is a
-		## stream it will uncompress some data. If no data can be decompressed
-		## at all, it is not a valid LZMA stream.
-		lzmasizeknown = False
-		if lzmasizebytes != '\xff\xff\xff\xff\xff\xff\xff\xff':
-			lzmasize = struct.unpack('<Q', lzmasizebytes)[0]
-			## XZ Utils rejects files with uncompressed size of 256 GiB
-			if lzmasize > 274877906944:
+		if haslzma:
+			if not probes[offset]:
 				continue
-			## if the size is 0, why even bother?
-			if lzmasize == 0:
+			tmpdir = dirsetup(tempdir, filename, "lzma", counter)
+			res = unpackLZMAStream(filename, offset, template, tmpdir, lzmasizeknown, lzmalimit)
+			if res == None:
+				os.rmdir(tmpdir)
 				continue
-			lzmasizeknown = True
+			(compressedsize, endofstream) = res
+			if endofstream:
+				diroffsets.append((tmpdir, offset, compressedsize))
+				if offset == 0 and compressedsize == filesize:
+					newtags.append('compressed')
+					newtags.append('lzma')
+			else:
+				diroffsets.append((tmpdir, offset, 0))
+			blacklist.append((offset, offset+compressedsize))
+			counter += 1
+			continue
 
-		## either read all bytes that are left in the file or a minimum
-		## amount of bytes, whichever is the smallest
+		## the lzma program is used to find out whether or not the
+		## data is valid LZMA data. Either read all bytes that are left
+		## in the file or a minimum amount of bytes, whichever is the smallest
 		minlzmadatatoread = 10000000
 		lzmabytestoread = min(filesize-offset, minlzmadatatoread)
 
@@ -5579,6 +5927,166 @@ def searchUnpackLZMA(filename, tempdir=None, blacklist=[], offsets={}, scanenv={
 	lzma_file.close()
 	return (diroffsets, blacklist, newtags, hints)
 
+## Check the header of a possible LZMA stream. Returns None if the header
+## is not valid, or a tuple (size known, size of the uncompressed data).
+def checkLZMAHeader(lzmaheader, lzma_try_all=False):
+	if len(lzmaheader) != 13:
+		return None
+	## According to http://svn.python.org/projects/external/xz-5.0.3/doc/lzma-file-format.txt the first
+	## 13 bytes of the LZMA file are the header. It consists of properties (1 byte), dictionary
+	## size (4 bytes), and a field to store the size of the uncompressed data (8 bytes).
+	##
+	## The properties field is not fixed, but computed during compression and could be any value
+	## between 0x00 and 0xe0. In practice only a handful of values are really used, 0x5d being the most
+	## common one, because it is the default :-)
+	##
+	## The dictionary size can be any 32 bit integer, but again only a handful of values are widely
+	## used. LZMA utils uses 2^n, with 16 <= n <= 25 (default 23). XZ utils uses 2^n or 2^n+2^(n-1).
+	## For XZ utils n seems to be be 12 <= n <= 30 (default 23). Setting these requires tweaking
+	## command line parameters which is unlikely to happen very often.
+	##
+	## The following checks are based on some real life data, plus some theoretical values
+	## but could use refinement.
+	## Values were computed based on dictionary size 2^n or 2^n+2^(n-1), with 16 <= n <= 25
+	if not lzma_try_all:
+		lzmacheckbyte = lzmaheader[3:5]
+		if lzmacheckbyte not in ['\x01\x00', '\x02\x00', '\x03\x00', '\x04\x00', '\x06\x00', '\x08\x00', '\x10\x00', '\x20\x00', '\x30\x00', '\x40\x00', '\x60\x00', '\x80\x00', '\x80\x01', '\x0c\x00', '\x18\x00', '\x00\x00', '\x00\x01', '\x00\x02', '\x00\x03', '\x00\x04', '\xc0\x00']:
+			return None
+
+	## A few more sanity checks: first check if the file is a stream
+	## of unknown size, or if it has a file size set (for the
+	## uncompressed file).
+	## If it has a file size set, then check if the value of the size
+	## actually makes sense.
+	lzmasizebytes = lzmaheader[5:13]
+	if lzmasizebytes == '\xff\xff\xff\xff\xff\xff\xff\xff':
+		return (False, None)
+	lzmasize = struct.unpack('<Q', lzmasizebytes)[0]
+	## XZ Utils rejects files with uncompressed size of 256 GiB
+	if lzmasize > 274877906944:
+		return None
+	## if the size is 0, why even bother?
+	if lzmasize == 0:
+		return None
+	return (True, lzmasize)
+
+## amount of bytes of a possible LZMA stream that is decompressed to
+## see if it is a valid LZMA stream
+lzmaprobesize = 8192
+
+## amount of bytes that is decompressed at once when unpacking LZMA
+lzmachunksize = 65536
+
+## amount of bytes that is decompressed at once when unpacking the data
+## of an LZMA stream just before an error, to keep as much data as possible
+lzmarecoversize = 16
+
+## Decompress the first bytes of a possible LZMA stream in process. Returns
+## False if the data is not valid LZMA data. Streams that have an error in
+## the first bytes are rejected, even if some data could be unpacked.
+def probeLZMA(filename, offset):
+	lzmafile = open(filename, 'rb')
+	lzmafile.seek(offset)
+	lzmadata = lzmafile.read(lzmaprobesize)
+	lzmafile.close()
+	decompressor = lzma.LZMADecompressor(format=lzma.FORMAT_ALONE)
+	try:
+		decompressor.decompress(lzmadata)
+	except Exception, e:
+		return False
+	return True
+
+## wrapper for probeLZMA, for use with multiprocessing
+def probeLZMAtask((filename, offset)):
+	return probeLZMA(filename, offset)
+
+## Decompress the data of an LZMA stream up to an error in the data in
+## small steps. The decompressor cannot be used anymore after an error, so
+## the stream is decompressed again from the start, but the data that was
+## unpacked before is not written again. Returns a tuple (compressed size,
+## uncompressed size) of the data that was unpacked in small steps.
+def recoverLZMAStream(filename, offset, outfile, goodsize, failedsize):
+	decompressor = lzma.LZMADecompressor(format=lzma.FORMAT_ALONE)
+	lzmafile = open(filename, 'rb')
+	lzmafile.seek(offset)
+	compressedsize = 0
+	unpackedsize = 0
+	try:
+		bytesread = 0
+		while bytesread < goodsize:
+			lzmadata = lzmafile.read(min(lzmachunksize, goodsize - bytesread))
+			decompressor.decompress(lzmadata)
+			bytesread += len(lzmadata)
+		lzmadata = lzmafile.read(failedsize)
+		for i in range(0, len(lzmadata), lzmarecoversize):
+			unpackeddata = decompressor.decompress(lzmadata[i:i+lzmarecoversize])
+			outfile.write(unpackeddata)
+			unpackedsize += len(unpackeddata)
+			compressedsize += len(lzmadata[i:i+lzmarecoversize])
+	except Exception, e:
+		pass
+	lzmafile.close()
+	return (compressedsize, unpackedsize)
+
+## Unpack an LZMA stream in process. The data is written to disk while it is
+## decompressed, so it is never completely in memory. Returns None if the
+## stream is not valid, or a tuple (compressed size, end of stream found). If
+## the end of the stream was not found the data up to the first error was
+## unpacked, like 'lzma -cd' does.
+def unpackLZMAStream(filename, offset, template, tmpdir, lzmasizeknown, minbytesize=1):
+	if template != None:
+		outfilename = os.path.join(tmpdir, template)
+		outfile = open(outfilename, 'wb')
+	else:
+		outtmpfile = tempfile.mkstemp(dir=tmpdir)
+		outfilename = outtmpfile[1]
+		outfile = os.fdopen(outtmpfile[0], 'wb')
+
+	decompressor = lzma.LZMADecompressor(format=lzma.FORMAT_ALONE)
+	lzmafile = open(filename, 'rb')
+	lzmafile.seek(offset)
+	compressedsize = 0
+	unpackedsize = 0
+	endofstream = False
+	while True:
+		lzmadata = lzmafile.read(lzmachunksize)
+		if lzmadata == '':
+			break
+		try:
+			unpackeddata = decompressor.decompress(lzmadata)
+		except Exception, e:
+			## keep the data in this chunk up to the error
+			(recoveredsize, recoveredunpackedsize) = recoverLZMAStream(filename, offset, outfile, compressedsize, len(lzmadata))
+			compressedsize += recoveredsize
+			unpackedsize += recoveredunpackedsize
+			break
+		outfile.write(unpackeddata)
+		unpackedsize += len(unpackeddata)
+		compressedsize += len(lzmadata)
+		if decompressor.eof:
+			compressedsize -= len(decompressor.unused_data)
+			endofstream = True
+			break
+	lzmafile.close()
+	outfile.close()
+
+	if not endofstream:
+		## If the size of the uncompressed data is recorded in the
+		## header, then all data should have been unpacked.
+		valid = not lzmasizeknown and unpackedsize >= minbytesize and unpackedsize != 0
+		## If there is a very big difference (thousandfold) between
+		## the unpacked data and the compressed data it is a false
+		## positive for sure.
+		## TODO: make lzmacutoff configurable
+		lzmacutoff = 1000
+		if valid and unpackedsize < lzmacutoff:
+			if compressedsize/unpackedsize > 1000:
+				valid = False
+		if not valid:
+			os.unlink(outfilename)
+			return None
+	return (compressedsize, endofstream)
+
 ## tries to unpack stuff using lzma -cd. If it is successful, it will
 ## return a directory for further processing, otherwise it will return None.
 ## Newer versions of XZ (>= 5.0.0) have an option to test and list archives.
@@ -281,30 +281,11 @@ def extractC(filepath, tags, scanenv, filesize, stringcutoff, linuxkernel, black
 			## Parts of the file were already scanned, so
 			## carve the right parts from the file first
 			datafile = open(filepath, 'rb')
-			lastindex = 0
 			databytes = ""
-			datafile.seek(lastindex)
-			## make a copy and add a bogus value for the last
-			## byte to a temporary blacklist to make the loop work
-			## well.
-			blacklist_tmp = copy.deepcopy(blacklist)
-			## oh, this is an ugly hack. The blacklisting code really
-			## should be fixed.
-			blacklist_tmp.sort()
-
-			blacklist_tmp.append((filesize,filesize))
-			for i in blacklist_tmp:
-				if i[0] == lastindex:
-					lastindex = i[1] - 1
-					datafile.seek(lastindex)
-					continue
-				if i[0] > lastindex:
-					## just concatenate the bytes
-					data = datafile.read(i[0] - lastindex)
-					databytes = databytes + data
-					## set lastindex to the next
-					lastindex = i[1] - 1
-					datafile.seek(lastindex)
+			for (lower, upper) in extractor.blacklistgaps(0, filesize, blacklist):
+				## just concatenate the bytes
+				datafile.seek(lower)
+				databytes = databytes + datafile.read(upper - lower)
 			datafile.close()
 			if len(databytes) == 0:
 				return None
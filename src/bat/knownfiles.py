@@ -0,0 +1,125 @@
+#!/usr/bin/python
+
+## Binary Analysis Tool
+## Licensed under Apache 2.0, see LICENSE file for details
+
+'''
+This module contains a filter for known files: files that never have to be
+scanned, such as files from stock distributions, or files that were checked
+earlier. The SHA256 checksums of these files are stored in the 'blacklist'
+table in the database.
+
+Instead of querying the database for every file that is scanned all the
+checksums are written once to a file, which is mapped in memory by all the
+scan processes (read only, so the memory is shared). The file contains:
+
+1. a header with the parameters of the filter
+2. a Bloom filter, to quickly find out that a file is not known
+3. a sorted table with all the checksums (binary), which is searched if the
+Bloom filter reports a possible match, so there are no false positives
+'''
+
+import os, mmap, struct, binascii
+
+## magic and layout of the header: magic, amount of bits in the Bloom
+## filter, amount of bit positions per checksum, amount of checksums
+headermagic = 'BATKNOWN'
+headerformat = '<8sQII'
+headersize = struct.calcsize(headerformat)
+
+## size of a binary SHA256 checksum
+checksumsize = 32
+
+## bits in the Bloom filter per checksum. With 10 bits per checksum and 7 bit
+## positions per checksum about 1% of the files that are not known need to be
+## looked up in the sorted table.
+bitsperchecksum = 10
+bitpositions = 7
+
+## SHA256 checksums are random enough to use parts of the checksum directly
+## as the positions in the Bloom filter.
+def positions(checksum, bloombits):
+	return map(lambda x: x % bloombits, struct.unpack('<7I', checksum[:28]))
+
+## Write the filter for a list of SHA256 checksums (hexadecimal) to a file.
+def writeknownfiles(checksums, filtername):
+	binchecksums = set()
+	for checksum in checksums:
+		try:
+			binchecksum = binascii.unhexlify(checksum)
+		except TypeError, e:
+			continue
+		if len(binchecksum) != checksumsize:
+			continue
+		binchecksums.add(binchecksum)
+	binchecksums = sorted(binchecksums)
+
+	## the Bloom filter is a multiple of 8 bits
+	bloombits = max(64, len(binchecksums) * bitsperchecksum)
+	bloombits += (8 - bloombits % 8) % 8
+	bloomfilter = bytearray(bloombits/8)
+	for binchecksum in binchecksums:
+		for position in positions(binchecksum, bloombits):
+			bloomfilter[position/8] |= 1 << (position%8)
+
+	filterfile = open(filtername, 'wb')
+	filterfile.write(struct.pack(headerformat, headermagic, bloombits, bitpositions, len(binchecksums)))
+	filterfile.write(str(bloomfilter))
+	for binchecksum in binchecksums:
+		filterfile.write(binchecksum)
+	filterfile.close()
+	return len(binchecksums)
+
+## Write the filter for all the checksums in the 'blacklist' table
+def buildknownfiles(cursor, filtername):
+	cursor.execute("select distinct checksum from blacklist")
+	checksums = []
+	while True:
+		res = cursor.fetchmany(10000)
+		if res == []:
+			break
+		checksums += map(lambda x: x[0], res)
+	return writeknownfiles(checksums, filtername)
+
+class KnownFiles(object):
+	def __init__(self, filtername):
+		filterfile = open(filtername, 'rb')
+		self.data = mmap.mmap(filterfile.fileno(), 0, access=mmap.ACCESS_READ)
+		filterfile.close()
+		(magic, self.bloombits, bloompositions, self.count) = struct.unpack(headerformat, self.data[:headersize])
+		if magic != headermagic or bloompositions != bitpositions:
+			self.data.close()
+			raise ValueError("not a valid known files filter")
+		self.tableoffset = headersize + self.bloombits/8
+
+	## look up a checksum (hexadecimal)
+	def __contains__(self, checksum):
+		try:
+			binchecksum = binascii.unhexlify(checksum)
+		except TypeError, e:
+			return False
+		if len(binchecksum) != checksumsize:
+			return False
+
+		## first check the Bloom filter
+		for position in positions(binchecksum, self.bloombits):
+			if not ord(self.data[headersize + position/8]) & (1 << (position%8)):
+				return False
+
+		## then search the sorted table
+		low = 0
+		high = self.count
+		while low < high:
+			middle = (low + high)/2
+			offset = self.tableoffset + middle * checksumsize
+			tablechecksum = self.data[offset:offset+checksumsize]
+			if tablechecksum == binchecksum:
+				return True
+			if tablechecksum < binchecksum:
+				low = middle + 1
+			else:
+				high = middle
+		return False
+
+	def close(self):
+		self.data.close()
@@ -0,0 +1,128 @@
+#!/usr/bin/python
+
+## Binary Analysis Tool
+## Licensed under Apache 2.0, see LICENSE file for details
+
+'''
+This module contains a cache for results of leaf scans, that is kept on disk
+and shared between scans. Many files (for example a particular build of
+BusyBox) are found in a lot of firmwares, so storing the results of the leaf
+scans means that these only have to be computed once.
+
+Results are stored per file (SHA256), leaf scan and a fingerprint of the
+configuration of the leaf scan (module, method, environment, etc.) and of the
+configuration of the prerun and unpack scans, plus the tags and the blacklist
+that were given to the leaf scan. If the configuration changes, the old
+results are no longer used.
+
+Leaf scans that use the database will return outdated results if the database
+is updated, so the cache should be cleared when that happens.
+
+When the cache grows larger than the maximum size the results that were least
+recently used (using the modification time of the files) are removed.
+'''
+
+import os, os.path, hashlib, cPickle, tempfile, errno
+
+## Create a fingerprint for the configuration of a leaf scan and the
+## configuration of the scans that were run before it (prerun and unpack
+## scans), as these determine which files and tags the leaf scan gets.
+def configfingerprint(scanconfig, unpackscans=[]):
+	def serialize(value):
+		if isinstance(value, dict):
+			return "{%s}" % ",".join(map(lambda x: "%s:%s" % (repr(x), serialize(value[x])), sorted(value.keys())))
+		if isinstance(value, (list, tuple)):
+			return "[%s]" % ",".join(map(lambda x: serialize(x), value))
+		return repr(value)
+	def cleanconfig(config):
+		fingerprintconfig = {}
+		for i in config:
+			## these do not influence the result of a scan
+			if i in ['debug', 'cachefingerprint']:
+				continue
+			fingerprintconfig[i] = config[i]
+		return fingerprintconfig
+	fingerprintconfig = {'scan': cleanconfig(scanconfig), 'unpackscans': map(lambda x: cleanconfig(x), unpackscans)}
+	return hashlib.sha256(serialize(fingerprintconfig)).hexdigest()
+
+class LeafCache(object):
+	def __init__(self, cachedir, maximumsize):
+		self.cachedir = cachedir
+		self.maximumsize = maximumsize
+
+	## The key for a result. Blacklist entries can also record the name of
+	## the scan that added them, but only the offsets influence leaf scans.
+	def cachefile(self, checksum, scanname, fingerprint, tags, blacklist):
+		blacklistkey = ":".join(map(lambda x: "%d-%d" % x, sorted(set(map(lambda x: (x[0], x[1]), blacklist)))))
+		key = hashlib.sha256("%s\x00%s\x00%s\x00%s" % (scanname, fingerprint, ":".join(sorted(set(tags))), blacklistkey)).hexdigest()
+		return os.path.join(self.cachedir, checksum[:2], "%s-%s.pickle" % (checksum, key))
+
+	## Look up the result of a leaf scan. Returns a tuple (found, result),
+	## as None is a valid result for a leaf scan.
+	def get(self, checksum, scanname, fingerprint, tags, blacklist):
+		try:
+			cachefile = self.cachefile(checksum, scanname, fingerprint, tags, blacklist)
+			resultfile = open(cachefile, 'rb')
+			res = cPickle.load(resultfile)
+			resultfile.close()
+		except Exception, e:
+			return (False, None)
+		## record that the result was used, for eviction
+		try:
+			os.utime(cachefile, None)
+		except Exception, e:
+			pass
+		return (True, res)
+
+	## Store the result of a leaf scan. The result is first written to a
+	## temporary file, which is then renamed, so other processes never
+	## see partial results.
+	def put(self, checksum, scanname, fingerprint, tags, blacklist, res):
+		try:
+			cachefile = self.cachefile(checksum, scanname, fingerprint, tags, blacklist)
+		except Exception, e:
+			return
+		try:
+			os.makedirs(os.path.dirname(cachefile))
+		except OSError, e:
+			if e.errno != errno.EEXIST:
+				return
+		try:
+			(fd, tmpfile) = tempfile.mkstemp(dir=os.path.dirname(cachefile), suffix='.tmp')
+			resultfile = os.fdopen(fd, 'wb')
+			cPickle.dump(res, resultfile, 2)
+			resultfile.close()
+			os.rename(tmpfile, cachefile)
+		except Exception, e:
+			## results that cannot be pickled are simply not cached
+			try:
+				os.unlink(tmpfile)
+			except:
+				pass
+
+	## Remove the least recently used results until the cache is smaller
+	## than the maximum size. This should only be called by one process.
+	def evict(self):
+		cachefiles = []
+		totalsize = 0
+		for i in os.walk(self.cachedir):
+			for p in i[2]:
+				if not p.endswith('.pickle'):
+					continue
+				try:
+					st = os.stat(os.path.join(i[0], p))
+				except OSError, e:
+					continue
+				cachefiles.append((st.st_mtime, st.st_size, os.path.join(i[0], p)))
+				totalsize += st.st_size
+		if totalsize <= self.maximumsize:
+			return
+		cachefiles.sort()
+		for (mtime, size, cachefile) in cachefiles:
+			if totalsize <= self.maximumsize:
+				break
+			try:
+				os.unlink(cachefile)
+			except OSError, e:
+				pass
+			totalsize -= size
@@ -24,21 +24,110 @@ spent, plus there might be false positives (mostly LZMA).
 '''
 
 import sys, os, subprocess, os.path, shutil, stat, struct, zlib, binascii
-import tempfile, re, magic, hashlib, HTMLParser, math
+import tempfile, re, magic, hashlib, HTMLParser, math, mmap, string
 import fsmagic, extractor, javacheck, elfcheck
 
+## Try to load the pyahocorasick module if available. It is used to search
+## for all markers in a single pass over the data. If it is not available the
+## markers are searched for one by one, which means that the cost of the
+## marker search grows with the amount of markers that are used.
+try:
+	import ahocorasick
+	ahocorasickscan = True
+except Exception, e:
+	ahocorasickscan = False
+
+## Aho-Corasick automatons are expensive to build, so they are cached and
+## built only once per process for each combination of markers.
+markerautomatons = {}
+
+## build (or fetch from the cache) an Aho-Corasick automaton for a list of
+## (key, marker) tuples. For every marker the automaton returns the length of
+## the marker and the keys that share the marker.
+def markerAutomaton(bufkeys):
+	automatonkey = tuple(sorted(set(bufkeys)))
+	if automatonkey in markerautomatons:
+		return markerautomatons[automatonkey]
+	markerstokeys = {}
+	for (key, bufkey) in automatonkey:
+		if bufkey in markerstokeys:
+			markerstokeys[bufkey].append(key)
+		else:
+			markerstokeys[bufkey] = [key]
+	automaton = ahocorasick.Automaton()
+	for bufkey in markerstokeys:
+		automaton.add_word(bufkey, (len(bufkey), markerstokeys[bufkey]))
+	automaton.make_automaton()
+	markerautomatons[automatonkey] = automaton
+	return automaton
+
+## generator that returns all (key, offset) tuples for the markers found in
+## databuffer, either in a single pass using an Aho-Corasick automaton, or by
+## searching for each marker separately.
+def markerMatches(databuffer, bufkeys, automaton=None):
+	if automaton != None:
+		for (endindex, (markerlength, keys)) in automaton.iter(databuffer):
+			res = endindex - markerlength + 1
+			for key in keys:
+				yield (key, res)
+		return
+	for (key, bufkey) in bufkeys:
+		res = databuffer.find(bufkey)
+		while res != -1:
+			yield (key, res)
+			res = databuffer.find(bufkey, res+1)
+
+## bytes after the start of a marker that are needed to verify some of the
+## markers in verifyMarker()
+markerverifylength = 8
+
+## size of the buffers that are used if the file cannot be memory mapped, or
+## if the markers are searched with an Aho-Corasick automaton.
+markerbuffersize = 2000000
+
+## regular expression to find the first non-printable character
+nonprintablere = re.compile('[^%s]' % re.escape(string.printable))
+
+## hardcode a few checks for markers that are found very often to avoid
+## possibly passing around many offsets to many methods. 'data' is either
+## a string or a memory mapped file, 'pos' is the offset of the marker in
+## 'data' and 'datasize' is the amount of bytes available in 'data'.
+def verifyMarker(key, data, pos, datasize):
+	if key == 'jpeg':
+		if pos + 3 > datasize:
+			return False
+		return data[pos+2] == '\xff'
+	elif key == 'compress':
+		if pos + 3 > datasize:
+			return False
+		compressbits = ord(data[pos+2]) & 0x1f
+		return compressbits >= 9 and compressbits <= 16
+	elif key == 'ttf':
+		if pos + 8 > datasize:
+			return False
+		(numberoftables, searchrange) = struct.unpack('>HH', data[pos+4:pos+8])
+		if numberoftables == 0:
+			return False
+		## sanity check, see specification
+		return pow(2, int(math.log(numberoftables, 2)+4)) == searchrange
+	return True
+
 ## method to search for all the markers in magicscans
 ## Although it is in this method it is actually not a pre-run scan, so perhaps
 ## it should be moved to bruteforcescan.py instead.
+## Only markers that start in the range [offset, offset + length) are reported,
+## but markers that start in the range and end after it are found as well, so
+## callers that split a file in chunks do not have to let chunks overlap. If
+## length is 0 the file is searched until the end.
+## By default the file is memory mapped and all the markers and the data
+## needed to verify them are read directly from the mapped file. If the file
+## cannot be memory mapped it is read in buffers instead.
 ## This method returns a tuple with three results:
 ## * offsets :: a dictionary with offsets per marker
 ## * offsettokeys :: a dictionary that maps an offset to a marker
 ## * isascii :: a flag to indicate that the data found was ASCII
 ## data only or not
-def genericMarkerSearch(filename, magicscans, optmagicscans, offset=0, length=0, debug=False):
-	datafile = open(filename, 'rb')
-	databuffer = []
-
+def genericMarkerSearch(filename, magicscans, optmagicscans, offset=0, length=0, debug=False, usemmap=True, filedata=None):
 	## dictionary with offsets per marker
 	offsets = {}
 
@@ -48,11 +137,6 @@ def genericMarkerSearch(filename, magicscans, optmagicscans, offset=0, length=0,
 	## flag that indicates if the data is ASCII
 	isascii = True
 
-	datafile.seek(offset)
-	if length == 0:
-		databuffer = datafile.read(2000000)
-	else:
-		databuffer = datafile.read(length)
 	marker_keys = magicscans + optmagicscans
 	bufkeys = []
 	for key in marker_keys:
@@ -65,65 +149,84 @@ def genericMarkerSearch(filename, magicscans, optmagicscans, offset=0, length=0,
 
 	## don't read the file if there are no keys to process
 	if bufkeys == []:
-		datafile.close()
 		return (offsets, offsettokeys, isascii)
 
-	datafile2 = open(filename, 'rb')
-	while databuffer != '':
-		if isascii:
-			if not extractor.isPrintables(databuffer):
-				isascii = False
-		for bkey in bufkeys:
-			(key, bufkey) = bkey
-			if not bufkey in databuffer:
-				continue
-			res = databuffer.find(bufkey)
-			while res != -1:
-				## hardcode a few checks to avoid possibly passing
-				## around many offsets to many methods
-				if key == 'jpeg':
-					datafile2.seek(offset+res+2)
-					checkkey = datafile2.read(1)
-					if len(checkkey) == 1:
-						if checkkey == '\xff':
-							offsets[key].add(offset + res)
-				elif key == 'compress':
-					datafile2.seek(offset+res+2)
-					compressdata = datafile2.read(1)
-					if len(compressdata) == 1:
-						compressbits = ord(compressdata) & 0x1f
-						if compressbits >= 9 and compressbits <= 16:
-							offsets[key].add(offset + res)
-				elif key == 'ttf':
-					datafile2.seek(offset+res+4)
-					fontbytes = datafile2.read(2)
-					if len(fontbytes) == 2:
-						numberoftables = struct.unpack('>H', fontbytes)[0]
-						if numberoftables != 0:
-							## followed by searchrange
-							fontbytes = datafile2.read(2)
-							if len(fontbytes) == 2:
-								searchrange = struct.unpack('>H', fontbytes)[0]
-								## sanity check, see specification
-								if pow(2, int(math.log(numberoftables, 2)+4)) == searchrange:
-									offsets[key].add(offset + res)
-				else:
-					offsets[key].add(offset + res)
-				res = databuffer.find(bufkey, res+1)
-		if length != 0:
-			break
-		## move the offset 1999950
-		datafile.seek(offset + 1999950)
-		## read 2000000 bytes with a 50 bytes overlap with the previous
-		## read so we don't miss any pattern. This needs to be updated
-		## as soon as patterns >= 50 are used.
-		databuffer = datafile.read(2000000)
-		if len(databuffer) >= 50:
-			offset = offset + 1999950
+	filesize = os.stat(filename).st_size
+	if length == 0:
+		searchend = filesize
+	else:
+		searchend = min(filesize, offset + length)
+
+	## the amount of bytes after the start of a marker that need to be
+	## available to find and verify the longest marker.
+	markerspan = max(map(lambda x: len(x[1]), bufkeys)) + markerverifylength
+
+	## search all markers in one pass if possible
+	automaton = None
+	if ahocorasickscan:
+		automaton = markerAutomaton(bufkeys)
+
+	datafile = None
+	mappeddata = None
+	if filedata != None and len(filedata) == filesize:
+		## the caller already read the data of the whole file, which
+		## can be searched in the same way as a mapped file.
+		mappeddata = filedata
+	else:
+		datafile = open(filename, 'rb')
+		if usemmap and offset < searchend:
+			try:
+				mappeddata = mmap.mmap(datafile.fileno(), 0, access=mmap.ACCESS_READ)
+			except Exception, e:
+				mappeddata = None
+
+	if mappeddata != None:
+		if nonprintablere.search(mappeddata, offset, searchend) != None:
+			isascii = False
+		if automaton == None:
+			## search directly in the mapped file, without copying any data
+			for (key, bufkey) in bufkeys:
+				findend = min(filesize, searchend + len(bufkey) - 1)
+				res = mappeddata.find(bufkey, offset, findend)
+				while res != -1:
+					if verifyMarker(key, mappeddata, res, filesize):
+						offsets[key].add(res)
+					res = mappeddata.find(bufkey, res+1, findend)
 		else:
-			offset = offset + len(databuffer)
-	datafile2.close()
-	datafile.close()
+			## the automaton needs a string, so search in windows of
+			## the mapped file and verify in the mapped file.
+			for windowstart in xrange(offset, searchend, markerbuffersize):
+				windowend = min(searchend, windowstart + markerbuffersize)
+				databuffer = mappeddata[windowstart:min(filesize, windowend + markerspan)]
+				for (key, res) in markerMatches(databuffer, bufkeys, automaton):
+					if windowstart + res >= windowend:
+						continue
+					if verifyMarker(key, mappeddata, windowstart + res, filesize):
+						offsets[key].add(windowstart + res)
+		if datafile != None:
+			mappeddata.close()
+	else:
+		## read the data in buffers that overlap with 'markerspan' bytes
+		## so markers at the end of a buffer are not missed and can be
+		## verified using the data in the buffer.
+		bufferoffset = offset
+		while bufferoffset < searchend:
+			bufferend = min(searchend, bufferoffset + markerbuffersize)
+			datafile.seek(bufferoffset)
+			databuffer = datafile.read(bufferend - bufferoffset + markerspan)
+			if databuffer == '':
+				break
+			if isascii:
+				if nonprintablere.search(databuffer, 0, bufferend - bufferoffset) != None:
+					isascii = False
+			for (key, res) in markerMatches(databuffer, bufkeys, automaton):
+				if bufferoffset + res >= bufferend:
+					continue
+				if verifyMarker(key, databuffer, res, len(databuffer)):
+					offsets[key].add(bufferoffset + res)
+			bufferoffset = bufferend
+	if datafile != None:
+		datafile.close()
 
 	for key in marker_keys:
 		offsets[key] = list(offsets[key])
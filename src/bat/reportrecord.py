@@ -0,0 +1,265 @@
+#!/usr/bin/python
+
+## Binary Analysis Tool
+## Licensed under Apache 2.0, see LICENSE file for details
+
+'''
+This module contains a compact representation of the reports of files
+(unpackreports) and of tags.
+
+Tags are registered in a process wide registry, which gives every tag its own
+bit. A list of tags can then be represented as an integer (a bit mask), so
+checking if a file has any of the tags in a list (for example 'noscan' and
+'scanonly' in the configuration of a scan) is a single integer operation.
+
+UnpackReport stores the fields of a report in slots instead of in a dictionary,
+stores tags as a bit mask and shares directory names (which are the same for
+all files in a directory) and 'magic' between reports. It behaves like a
+dictionary, so scans do not need to be changed: the value for 'tags' is a list
+that updates the bit mask of the report when it is changed. The order of tags
+is not kept and a tag is only stored once.
+
+When pickled a report is turned into a regular dictionary, so pickles (for
+example scandata.pickle) can be read without this module.
+'''
+
+## registry of tags and bits
+tagbits = {}
+tagnames = []
+
+def tagbit(tag):
+	if not tag in tagbits:
+		tagbits[tag] = 1 << len(tagnames)
+		tagnames.append(tag)
+	return tagbits[tag]
+
+## turn a list of tags into a bit mask
+def tagmask(tags):
+	mask = 0
+	for tag in tags:
+		mask |= tagbit(tag)
+	return mask
+
+## turn a bit mask into a list of tags
+def masktags(mask):
+	tags = []
+	bit = 0
+	while mask != 0:
+		if mask & 1:
+			tags.append(tagnames[bit])
+		mask >>= 1
+		bit += 1
+	return tags
+
+## bit masks for the values of 'scanonly' and 'noscan' in
+## configurations of scans, so they are split only once
+scanmaskcache = {}
+
+def scanmasks(scan):
+	key = (scan['scanonly'], scan['noscan'])
+	if not key in scanmaskcache:
+		scanonlymask = 0
+		if scan['scanonly'] != None:
+			scanonlymask = tagmask(scan['scanonly'].split(':'))
+		noscanmask = 0
+		if scan['noscan'] != None:
+			noscanmask = tagmask(scan['noscan'].split(':'))
+		scanmaskcache[key] = (scanonlymask, noscanmask)
+	return scanmaskcache[key]
+
+## A list of tags belonging to a report. Any change to the list is
+## also made to the bit mask of the report.
+class TagList(list):
+	def __init__(self, report):
+		list.__init__(self, masktags(report.tagmask))
+		self.report = report
+
+	def update(self):
+		self.report.tagmask = tagmask(self)
+
+	def append(self, tag):
+		list.append(self, tag)
+		self.report.tagmask |= tagbit(tag)
+
+	def extend(self, tags):
+		list.extend(self, tags)
+		self.update()
+
+	def insert(self, index, tag):
+		list.insert(self, index, tag)
+		self.report.tagmask |= tagbit(tag)
+
+	def remove(self, tag):
+		list.remove(self, tag)
+		self.update()
+
+	def pop(self, index=-1):
+		tag = list.pop(self, index)
+		self.update()
+		return tag
+
+	def __iadd__(self, tags):
+		list.extend(self, tags)
+		self.update()
+		return self
+
+	def __setitem__(self, index, tag):
+		list.__setitem__(self, index, tag)
+		self.update()
+
+	def __delitem__(self, index):
+		list.__delitem__(self, index)
+		self.update()
+
+	def __setslice__(self, i, j, tags):
+		list.__setslice__(self, i, j, tags)
+		self.update()
+
+	def __delslice__(self, i, j):
+		list.__delslice__(self, i, j)
+		self.update()
+
+	## a copy is a regular list
+	def __reduce__(self):
+		return (list, (list(self),))
+
+## names of the fields that are stored in slots
+reportfields = ['name', 'path', 'realpath', 'relativename', 'magic', 'size', 'checksum', 'sha256', 'sha1', 'md5', 'tlsh', 'crc32', 'scans', 'scandate']
+
+## fields for which the values are shared between reports
+internfields = set(['path', 'realpath', 'magic'])
+
+## marker for fields that are not set
+unset = object()
+
+class UnpackReport(object):
+	__slots__ = reportfields + ['tagmask', 'hastags', 'extra']
+
+	def __init__(self, report={}):
+		for field in reportfields:
+			object.__setattr__(self, field, unset)
+		self.tagmask = 0
+		self.hastags = False
+		self.extra = None
+		for key in report:
+			self[key] = report[key]
+
+	def __getitem__(self, key):
+		if key == 'tags':
+			if not self.hastags:
+				raise KeyError(key)
+			return TagList(self)
+		if key in reportfields:
+			value = getattr(self, key)
+			if value is unset:
+				raise KeyError(key)
+			return value
+		if self.extra == None:
+			raise KeyError(key)
+		return self.extra[key]
+
+	def __setitem__(self, key, value):
+		if key == 'tags':
+			self.tagmask = tagmask(value)
+			self.hastags = True
+		elif key in reportfields:
+			if key in internfields and type(value) == str:
+				value = intern(value)
+			setattr(self, key, value)
+		else:
+			if self.extra == None:
+				self.extra = {}
+			self.extra[key] = value
+
+	def __delitem__(self, key):
+		if not key in self:
+			raise KeyError(key)
+		if key == 'tags':
+			self.tagmask = 0
+			self.hastags = False
+		elif key in reportfields:
+			setattr(self, key, unset)
+		else:
+			del self.extra[key]
+
+	def __contains__(self, key):
+		if key == 'tags':
+			return self.hastags
+		if key in reportfields:
+			return getattr(self, key) is not unset
+		if self.extra == None:
+			return False
+		return key in self.extra
+
+	has_key = __contains__
+
+	def keys(self):
+		keys = filter(lambda x: getattr(self, x) is not unset, reportfields)
+		if self.hastags:
+			keys.append('tags')
+		if self.extra != None:
+			keys += self.extra.keys()
+		return keys
+
+	def __iter__(self):
+		return iter(self.keys())
+
+	def __len__(self):
+		return len(self.keys())
+
+	def items(self):
+		return map(lambda x: (x, self[x]), self.keys())
+
+	def iteritems(self):
+		return iter(self.items())
+
+	def values(self):
+		return map(lambda x: self[x], self.keys())
+
+	def get(self, key, default=None):
+		if key in self:
+			return self[key]
+		return default
+
+	def setdefault(self, key, default=None):
+		if not key in self:
+			self[key] = default
+		return self[key]
+
+	def pop(self, key, *default):
+		if not key in self:
+			if default != ():
+				return default[0]
+			raise KeyError(key)
+		value = self[key]
+		del self[key]
+		return value
+
+	def update(self, report):
+		for key in report:
+			self[key] = report[key]
+
+	## a copy is a regular dictionary, with the tags as a list
+	def todict(self):
+		report = dict(self.items())
+		if 'tags' in report:
+			report['tags'] = list(report['tags'])
+		return report
+
+	def __eq__(self, other):
+		if isinstance(other, UnpackReport):
+			other = other.todict()
+		return self.todict() == other
+
+	def __ne__(self, other):
+		return not self == other
+
+	def __repr__(self):
+		return repr(self.todict())
+
+	def __deepcopy__(self, memo):
+		import copy
+		return UnpackReport(copy.deepcopy(self.todict(), memo))
+
+	def __reduce__(self):
+		return (dict, (self.todict(),))
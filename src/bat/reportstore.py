@@ -0,0 +1,168 @@
+#!/usr/bin/python
+
+## Binary Analysis Tool
+## Licensed under Apache 2.0, see LICENSE file for details
+
+'''
+This module contains a store for the unpack reports of a scan (one report per
+file), which can be used instead of a dictionary. For binaries with hundreds
+of thousands of files keeping all reports in memory takes a lot of memory.
+
+The reports are stored in a SQLite database and loaded when they are accessed.
+A limited amount of reports is kept in memory. Scans often change reports
+in place, for example by adding a tag:
+
+unpackreports[filename]['tags'].append('sometag')
+
+so reports that are in memory are written back to the database when they are
+removed from memory (and when sync() is called), but only if they changed.
+This means that references to reports should not be kept for a long time:
+changes made to a report after it was removed from memory are lost.
+'''
+
+import sqlite3, cPickle, collections, UserDict
+
+class ReportStore(UserDict.DictMixin):
+	def __init__(self, dbname, cachesize=10000):
+		self.dbname = dbname
+		self.cachesize = max(1, cachesize)
+		self.conn = sqlite3.connect(dbname)
+		self.conn.text_factory = str
+		self.cursor = self.conn.cursor()
+		self.cursor.execute("pragma synchronous=off")
+		self.cursor.execute("pragma journal_mode=memory")
+		self.cursor.execute("create table if not exists unpackreports(name text primary key, report blob)")
+		## reports that are in memory, with the data as it was last
+		## written to the database, in order of last use
+		self.cache = collections.OrderedDict()
+
+	def writeback(self, name):
+		(report, reportdata) = self.cache[name]
+		newreportdata = cPickle.dumps(report, 2)
+		if newreportdata != reportdata:
+			self.cursor.execute("insert or replace into unpackreports (name, report) values (?, ?)", (name, sqlite3.Binary(newreportdata)))
+			self.cache[name] = (report, newreportdata)
+
+	def addtocache(self, name, report, reportdata):
+		self.cache[name] = (report, reportdata)
+		while len(self.cache) > self.cachesize:
+			oldname = iter(self.cache).next()
+			self.writeback(oldname)
+			del self.cache[oldname]
+
+	def __getitem__(self, name):
+		if name in self.cache:
+			## move the report to the end, as it was used last
+			cacheentry = self.cache.pop(name)
+			self.cache[name] = cacheentry
+			return cacheentry[0]
+		self.cursor.execute("select report from unpackreports where name=?", (name,))
+		res = self.cursor.fetchone()
+		if res == None:
+			raise KeyError(name)
+		reportdata = str(res[0])
+		report = cPickle.loads(reportdata)
+		self.addtocache(name, report, reportdata)
+		return report
+
+	def __setitem__(self, name, report):
+		if name in self.cache:
+			del self.cache[name]
+		reportdata = cPickle.dumps(report, 2)
+		self.cursor.execute("insert or replace into unpackreports (name, report) values (?, ?)", (name, sqlite3.Binary(reportdata)))
+		self.addtocache(name, report, reportdata)
+
+	def __delitem__(self, name):
+		if name in self.cache:
+			del self.cache[name]
+		self.cursor.execute("delete from unpackreports where name=?", (name,))
+		if self.cursor.rowcount == 0:
+			raise KeyError(name)
+
+	def __contains__(self, name):
+		if name in self.cache:
+			return True
+		self.cursor.execute("select 1 from unpackreports where name=?", (name,))
+		return self.cursor.fetchone() != None
+
+	has_key = __contains__
+
+	def __len__(self):
+		self.cursor.execute("select count(*) from unpackreports")
+		return self.cursor.fetchone()[0]
+
+	## all reports are always in the database, although possibly an
+	## older version, so the names can be read from the database
+	def keys(self):
+		self.cursor.execute("select name from unpackreports")
+		return map(lambda x: x[0], self.cursor.fetchall())
+
+	def __iter__(self):
+		return iter(self.keys())
+
+	def iteritems(self):
+		for name in self.keys():
+			yield (name, self[name])
+
+	## write all changed reports to the database
+	def sync(self):
+		for name in self.cache.keys():
+			self.writeback(name)
+		self.conn.commit()
+
+	def close(self):
+		self.sync()
+		self.cursor.close()
+		self.conn.close()
+
+## A view of the reports of a scan without the reports of some files, for
+## example files for which stored results were reused and which were not
+## unpacked. Reports can be changed through the view.
+class ReportView(UserDict.DictMixin):
+	def __init__(self, unpackreports, hiddennames):
+		self.unpackreports = unpackreports
+		self.hiddennames = hiddennames
+
+	def __getitem__(self, name):
+		if name in self.hiddennames:
+			raise KeyError(name)
+		return self.unpackreports[name]
+
+	def __setitem__(self, name, report):
+		self.unpackreports[name] = report
+
+	def __delitem__(self, name):
+		if name in self.hiddennames:
+			raise KeyError(name)
+		del self.unpackreports[name]
+
+	def __contains__(self, name):
+		return not name in self.hiddennames and name in self.unpackreports
+
+	has_key = __contains__
+
+	def keys(self):
+		return filter(lambda x: not x in self.hiddennames, self.unpackreports.keys())
+
+	def __iter__(self):
+		return iter(self.keys())
+
+	def __len__(self):
+		return len(self.keys())
+
+## Write all the reports to a pickle file. For a store the reports are read
+## and written one by one, so they are never all in memory. The result can
+## be read with cPickle.load() as a regular dictionary.
+def dumpreports(unpackreports, picklefile):
+	if not isinstance(unpackreports, ReportStore):
+		cPickle.dump(unpackreports, picklefile)
+		return
+	## a pickle with an empty dictionary, followed by a SETITEM
+	## for every report. Every key and report is pickled separately
+	## without the protocol header and the end marker.
+	picklefile.write('\x80\x02}')
+	for name in unpackreports:
+		picklefile.write(cPickle.dumps(name, 2)[2:-1])
+		picklefile.write(cPickle.dumps(unpackreports[name], 2)[2:-1])
+		picklefile.write('s')
+	picklefile.write('.')
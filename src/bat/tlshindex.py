@@ -0,0 +1,97 @@
+#!/usr/bin/python
+
+## Binary Analysis Tool
+## Licensed under Apache 2.0, see LICENSE file for details
+
+'''
+This module contains methods to find the closest match for a TLSH checksum in
+the batresult table without computing the TLSH distance for every file that
+was stored before.
+
+The body of a TLSH checksum (the part after the header with the checksum, the
+length and the quartile ratios) is split into a number of bands. For every file
+that is stored in the batresult table the bands are stored in the batresult_tlsh
+table (see maintenance/storeresults.py). Files that are similar have a small
+distance, so it is likely that at least one of their bands is the same. Only
+files that share a band (or that have the same file name, which is what was used
+before) are compared with tlsh.diff().
+
+This is an approximation: two files with a distance under the threshold, but
+without a single identical band (and a different name) are not found.
+'''
+
+## TLSH is only needed to compute distances, not for computing the bands
+try:
+	import tlsh
+except Exception, e:
+	pass
+
+## the amount of bands. More bands means smaller bands, which means that
+## more similar files are found, but also that more candidates are checked.
+bandcount = 16
+
+## length of the header of a TLSH checksum (in hexadecimal characters)
+tlshheaderlength = 6
+
+## Split a TLSH checksum into bands. Every band is prefixed with its number
+## so the same data in different bands is not seen as identical.
+def tlshbands(tlshchecksum):
+	if tlshchecksum == None:
+		return []
+	## newer versions of TLSH prefix checksums with a version
+	if tlshchecksum.startswith('T1'):
+		tlshchecksum = tlshchecksum[2:]
+	body = tlshchecksum[tlshheaderlength:]
+	bandsize = len(body)/bandcount
+	if bandsize == 0:
+		return []
+	bands = []
+	for i in range(0, bandcount):
+		bands.append("%02d%s" % (i, body[i*bandsize:(i+1)*bandsize]))
+	return bands
+
+## Store the bands of a TLSH checksum for a file in the batresult table
+def storebands(cursor, checksum, tlshchecksum):
+	for band in tlshbands(tlshchecksum):
+		cursor.execute("insert into batresult_tlsh (band, checksum) values (%s, %s)", (band, checksum))
+
+## Check if the batresult_tlsh table exists. Databases that were created
+## with older versions of storeresults.py do not have this table.
+def hasbandtable(cursor):
+	cursor.execute("select table_name from information_schema.tables where table_type='BASE TABLE' and table_schema='public'")
+	tablenames = map(lambda x: x[0], cursor.fetchall())
+	return 'batresult_tlsh' in tablenames
+
+## Find the closest match for a TLSH checksum. Returns a tuple (pathname,
+## parentname, distance) for the file with the smallest distance, if the
+## distance is below the threshold, or None. If the batresult_tlsh table
+## is not used only files with the same name are compared.
+def closestmatch(cursor, tlshchecksum, filename, threshold, usebands=True):
+	bands = tlshbands(tlshchecksum)
+	if usebands and bands != []:
+		cursor.execute("select tlsh, pathname, parentname, parentchecksum from batresult where checksum in (select checksum from batresult_tlsh where band in %s) or filename=%s", (tuple(bands), filename))
+	else:
+		cursor.execute("select tlsh, pathname, parentname, parentchecksum from batresult where filename=%s", (filename,))
+	res = cursor.fetchall()
+
+	## many files are stored more than once, so compute
+	## the distance for every TLSH checksum only once.
+	distances = {}
+	closestfile = None
+	tlshminimum = threshold
+	for r in res:
+		(candidatetlsh, pathname, parentname, parentchecksum) = r
+		if candidatetlsh == None:
+			continue
+		if not candidatetlsh in distances:
+			try:
+				distances[candidatetlsh] = tlsh.diff(tlshchecksum, candidatetlsh)
+			except Exception, e:
+				distances[candidatetlsh] = None
+		tlshdistance = distances[candidatetlsh]
+		if tlshdistance == None:
+			continue
+		if tlshdistance < tlshminimum:
+			tlshminimum = tlshdistance
+			closestfile = (pathname, parentname, tlshdistance)
+	return closestfile
@@ -34,6 +34,9 @@ create index kernelmodule_parameter_description_checksum_index on kernelmodule_p
 create index kernelmodule_version_checksum_index on kernelmodule_version(checksum);
 create index batresult_checksum_index on batresult(checksum);
 create index batresult_filename_index on batresult(filename);
+create index batresult_tlsh_band_index on batresult_tlsh(band);
+create index batresult_tlsh_checksum_index on batresult_tlsh(checksum);
+create index batresult_report_checksum_index on batresult_report(checksum);
 create index blacklist_checksum_index on blacklist(checksum);
 create index rpm_checksum_index on rpm(checksum);
 create index rpm_rpmname_index on rpm(rpmname);
@@ -15,6 +15,8 @@ drop table kernelmodule_parameter_description;
 drop table kernelmodule_version;
 
 drop table batresult;
+drop table batresult_tlsh;
+drop table batresult_report;
 drop table blacklist;
 drop table rpm;
 drop table archivealias;
@@ -15,6 +15,8 @@ create table if not exists kernelmodule_parameter_description(checksum text, mod
 create table if not exists kernelmodule_version(checksum text, modulename text, version text);
 
 create table if not exists batresult(checksum text, filename text, tlsh text, pathname text, parentname text, parentchecksum text);
+create table if not exists batresult_tlsh(band text, checksum text);
+create table if not exists batresult_report(checksum text, report bytea);
 create table if not exists blacklist(checksum text, filename text, origin text);
 create table if not exists rpm(rpmname text, checksum text, downloadurl text);
 create table if not exists archivealias(checksum text, archivename text, origin text, downloadurl text, website text);
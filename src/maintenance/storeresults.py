@@ -8,13 +8,85 @@
 Script to upload BAT results into the BAT database. Works on a directory with scan results.
 '''
 
-import sys, os, os.path, json, gzip, cPickle
+import sys, os, os.path, json, gzip, cPickle, copy
 from optparse import OptionParser
 import ConfigParser
 
 ## import the PostgreSQL connection module
 import psycopg2
 
+## bands of TLSH checksums, used to quickly find similar files
+from bat import tlshindex
+
+## read the leaf reports of a file from the result directory, either
+## gzip compressed or regular
+def readfilereport(resultdirectory, checksum):
+	if os.path.exists(os.path.join(resultdirectory, 'filereports', '%s-filereport.pickle') % checksum):
+		leaf_file = open(os.path.join(resultdirectory, 'filereports', '%s-filereport.pickle') % checksum)
+	elif os.path.exists(os.path.join(resultdirectory, 'filereports', '%s-filereport.pickle.gz') % checksum):
+		leaf_file = gzip.open(os.path.join(resultdirectory, 'filereports', '%s-filereport.pickle.gz') % checksum)
+	else:
+		return None
+	leafreports = cPickle.load(leaf_file)
+	leaf_file.close()
+	return leafreports
+
+## Create a report for a file that can be reused by BAT when the same file
+## is scanned again. Names of files that were unpacked from the file are
+## stored relative to the name of the file, as the name will be different
+## in another scan. Duplicates are not stored, as the original is stored.
+## Files that were unpacked and that have no checksum (symbolic links, empty
+## files) are stored inline, as these have no stored report of their own.
+def makestoredreport(relativename, unpackreports, resultdirectory):
+	unpackreport = copy.deepcopy(unpackreports[relativename])
+	if not 'sha256' in unpackreport:
+		return None
+	if 'duplicate' in unpackreport.get('tags', []):
+		return None
+
+	## the files that were unpacked from this file
+	children = {}
+	inlinechildren = {}
+	if 'scans' in unpackreport:
+		for unpackscan in unpackreport['scans']:
+			scanreports = []
+			for childname in unpackscan['scanreports']:
+				if not childname.startswith(relativename):
+					return None
+				if not childname in unpackreports:
+					return None
+				suffix = childname[len(relativename):]
+				if 'sha256' in unpackreports[childname]:
+					children[suffix] = unpackreports[childname]['sha256']
+				else:
+					## files without a checksum should not contain
+					## any other files
+					if unpackreports[childname].get('scans', []) != []:
+						return None
+					inlinechildren[suffix] = cleanreport(unpackreports[childname])
+				scanreports.append(suffix)
+			unpackscan['scanreports'] = scanreports
+
+	unpackreport = cleanreport(unpackreport)
+
+	## the leaf reports are needed when the report is reused
+	filereport = readfilereport(resultdirectory, unpackreport['checksum'])
+	if filereport == None:
+		return None
+	if 'tags' in filereport:
+		filereport['tags'] = filter(lambda x: x != 'toplevel', filereport['tags'])
+	return {'unpackreport': unpackreport, 'children': children, 'inlinechildren': inlinechildren, 'filereport': filereport}
+
+## remove everything that is specific to this scan from a report
+def cleanreport(unpackreport):
+	unpackreport = copy.deepcopy(unpackreport)
+	for i in ['relativename', 'realpath', 'scandate']:
+		if i in unpackreport:
+			del unpackreport[i]
+	if 'tags' in unpackreport:
+		unpackreport['tags'] = filter(lambda x: x != 'toplevel', unpackreport['tags'])
+	return unpackreport
+
 def main(argv):
 	config = ConfigParser.ConfigParser()
 
@@ -128,10 +200,32 @@ def main(argv):
 		if 'tlsh' in i:
 			tlshchecksum = i['tlsh']
 		cursor.execute("insert into batresult (checksum, filename, tlsh, pathname, parentname, parentchecksum) values (%s, %s, %s, %s, %s, %s)", (i['sha256'], i['name'], tlshchecksum, storepath, toplevelelem['name'], toplevelchecksum))
+		## store the bands of the TLSH checksum once per file
+		if tlshchecksum != None:
+			cursor.execute("select checksum from batresult_tlsh where checksum=%s limit 1", (i['sha256'],))
+			if cursor.fetchone() == None:
+				tlshindex.storebands(cursor, i['sha256'], tlshchecksum)
 
 	## commit all the pending data
 	conn.commit()
 
+	## store the reports of every file, so BAT can reuse these when the
+	## same file is scanned again. This needs the pickle with all the
+	## unpacking results (see 'packpickles' in the BAT configuration).
+	if os.path.exists(os.path.join(options.resultdirectory, 'scandata.pickle')):
+		picklefile = open(os.path.join(options.resultdirectory, 'scandata.pickle'), 'rb')
+		unpackreports = cPickle.load(picklefile)
+		picklefile.close()
+		for relativename in unpackreports:
+			storedreport = makestoredreport(relativename, unpackreports, options.resultdirectory)
+			if storedreport == None:
+				continue
+			cursor.execute("select checksum from batresult_report where checksum=%s", (unpackreports[relativename]['sha256'],))
+			if cursor.fetchone() != None:
+				continue
+			cursor.execute("insert into batresult_report (checksum, report) values (%s, %s)", (unpackreports[relativename]['sha256'], psycopg2.Binary(cPickle.dumps(storedreport, 2))))
+		conn.commit()
+
 	## now check to see if any interesting security information like passwords were found
 	if 'passwords' in toplevelelem['tags']:
 		## first check if there is a pickle for the top level file,